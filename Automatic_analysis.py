@@ -14,6 +14,7 @@ from statistics import mean, median
 from os import listdir
 import seaborn as sb #plot swarmplot
 from math import inf #Allow for infinity value
+from protocol_schema import parseProtocol #Read the protocol from the header of results files
 
 class driveFile:
     def __init__(self): #Initializing contructor
@@ -204,33 +205,30 @@ class GUI:
             if(self.tree.set(node, "MIME Type") in "text/plain"):
                 if(genotype and run_number and day): #This text node is only valid if parent directories contained genotype, run, and day metadata
                     file_string = self.driveDir.getFileAsString(self.tree.set(node, "ID")) #Download the file from Google Drive
-                    cage = None
+                    protocol = parseProtocol(file_string)
                     test_day = day.replace("Night", "Day")
                     if "Refresh" in test_day:
                         test_day = "Day #4"
+                    cage = search(r"CAGE ([1-4])[A-B]", protocol.driveID or "") #Search for the cage number in the file
                     preset_day = None
-                    for line in file_string:
-                        if not cage:
-                            cage = search(r"USB drive ID: CAGE [1-4][A-B]", line) #Search for the cage number in the file
-                        if test_day in line:
-                            preset_day = day #Verify that day in file metadata matches directory day
-                        if(cage and preset_day):
-                            cage = cage.group(0)[19:-1]
-                            #Build nested dict and store file
+                    if test_day in (protocol.preset or "") + (protocol.metadata or ""):
+                        preset_day = day #Verify that day in file metadata matches directory day
+                    if(cage and preset_day):
+                        cage = cage.group(1)
+                        #Build nested dict and store file
+                        try:
+                            self.file_dic[genotype]
                             try:
-                                self.file_dic[genotype]
+                                self.file_dic[genotype][run_number]
                                 try:
-                                    self.file_dic[genotype][run_number]
-                                    try:
-                                        self.file_dic[genotype][run_number][day][cage] = file_string
-                                    except:
-                                        self.file_dic[genotype][run_number][day] = {cage: file_string}
+                                    self.file_dic[genotype][run_number][day][cage] = file_string
                                 except:
-                                    self.file_dic[genotype][run_number] = {day: {cage: file_string}}
+                                    self.file_dic[genotype][run_number][day] = {cage: file_string}
                             except:
-                                self.file_dic[genotype] = {run_number: {day: {cage: file_string}}}
-                            print(genotype + " " + run_number + " " + day + " " + preset_day + " " + cage)
-                            break
+                                self.file_dic[genotype][run_number] = {day: {cage: file_string}}
+                        except:
+                            self.file_dic[genotype] = {run_number: {day: {cage: file_string}}}
+                        print(genotype + " " + run_number + " " + day + " " + preset_day + " " + cage)
 
             #If node is a folder, recursively continue down the file tree, retrieveing folder metadata if available
             elif(self.tree.set(node, "MIME Type") in "application/vnd.google-apps.folder"):
@@ -315,10 +313,13 @@ class analysis:
             reward_door_event_counter = 0 #Number of door events during reward image.  Reset on control image
             reward_start = 0 #Time of prev reward start
             reward_end = 0 #Time of prev reward end
-            reward_timeout = None #Timeout of reward specified in protocol
             exp_duration = None #Total duration of experiment in seconds
-            control_images = []
-            reward_images = []
+
+            #Protocol settings from the header of the results file
+            protocol = parseProtocol(file)
+            reward_timeout = protocol.rewardDuration #Timeout of reward specified in protocol
+            control_images = protocol.controlImages or []
+            reward_images = protocol.rewardImages or []
 
             for line in file:
                 if line.startswith("Wheel - State: High, Time: "):
@@ -388,15 +389,6 @@ class analysis:
                     pass
                 elif line.startswith("Pump - State: Off, Time: "):
                     pass
-                elif not (control_images and reward_images and reward_timeout):
-                    if("Control image set: [" in line):
-                        list_string = search(r"Control image set: \[[^\]]*\]", line).group(0)[20:-1]
-                        control_images = list_string.split(", ")
-                    if("Reward image set: [" in line):
-                        list_string = search(r"Reward image set: \[[^\]]*\]", line).group(0)[19:-1]
-                        reward_images = list_string.split(", ")
-                    if("Maximum duration of reward state (seconds): " in line):
-                        reward_timeout = float(search(r"Maximum duration of reward state \(seconds\): \d+\.?\d+", line).group(0)[44:])
                 elif(not exp_duration):
                     if("Successful termination at: " in line):
                         exp_duration = float(search(r"Successful termination at: \d+\.\d+", line).group(0)[27:])
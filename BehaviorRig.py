@@ -1,12 +1,10 @@
 #!/usr/bin/env python3
 #Shebang to tell computer to use python to interpret program
 
-#Initialize GPIO and pin numbering scheme
-#Based on: https://raspi.tv/2013/how-to-use-interrupts-with-python-on-the-raspberry-pi-and-rpi-gpio-part-3
-import RPi.GPIO as GPIO #Catch GPIO pin interrupts
 import time #track system time
-from multiprocessing import Process, Pipe, Value #Multiprocessing set
+from multiprocessing import Process, Value, Array, Lock #Multiprocessing set
 from multiprocessing.connection import wait #Extract data from pipes when available
+from multiprocessing import shared_memory #Shared memory for passing event records between processes without pickling
 import pygame #Show images and log keypress events
 from pygame.locals import * #Import pyGame constants locally
 import re #regex
@@ -19,7 +17,26 @@ import imp #Allows for modules to be imported into program
 import signal #Allows programs/processes to be terminated
 from datetime import datetime #Allows recording of current date and time
 import hashlib #Allows for calculating hashes of files for data verification
-import random #Select from list randomly
+import random #Draw the seed of the reward schedule
+import heapq #Queue of pending deadlines in the image process
+import threading #Allows GPIO edge callbacks to wake the polling loop
+import json #Save the image store index
+import shutil #Check free space on the SD card for the image store
+import traceback #Report errors raised inside the input process
+from event_log import * #Fixed-size event records shared by the rig processes, and the binary event log writer
+from protocol_schema import readProtocol, RewardSchedule, FIELDS, SECTION_INFO, SECTION_RESULTS #Protocol lines and parser shared with the protocol generators and analysis scripts
+from collections import deque #Thread-safe FIFO for handing captured edges from GPIO callbacks to the input process
+from itertools import cycle #Step through the lists of the reward schedule
+import http.server #Serve live telemetry on localhost
+from concurrent.futures import ThreadPoolExecutor #Run the pre-flight checks side by side
+
+#Initialize GPIO and pin numbering scheme
+#Based on: https://raspi.tv/2013/how-to-use-interrupts-with-python-on-the-raspberry-pi-and-rpi-gpio-part-3
+#Start the rig with BEHAVIOR_RIG_GPIO=sim to replace the GPIO pins with the simulated mouse in GPIO_sim.py
+if os.environ.get("BEHAVIOR_RIG_GPIO", "").lower() == "sim" or "--dry-run" in sys.argv or "--sim-run" in sys.argv:
+    import GPIO_sim as GPIO
+else:
+    import RPi.GPIO as GPIO #Catch GPIO pin interrupts
 
 #Setup variables
 cageNumber = 1
@@ -31,14 +48,26 @@ pyudev = None #Object for importing the pyudev library
 PIPE_PATH = "/home/pi/my_pipe.txt" #Create temporary pipe file for exporting text to lxterminal - must be in user directory
 terminal = None #Instance of the lxterminal process
 mountDir = "/mnt/usb/" #The directory the USB drive will be mounted to
+preflightFile = "/home/pi/preflight.json" #Fingerprints of the pre-flight checks that passed - a check is skipped on the next launch while its fingerprint is unchanged
+configEditLock = threading.Lock() #fileinput in-place edits redirect stdout for the whole process, so only one pre-flight check may edit a config file at a time
+installLock = threading.Lock() #apt-get takes the dpkg lock and fails if another install holds it, so only one pre-flight check may install a package at a time - pip installs into the same system packages, so it waits too
 
 #Experiment variables
-imageDir = "/home/pi/exp_Images/" #Directory to transfer images to on the SD card
+imageDir = "/home/pi/exp_Images/" #Content-addressed image store on the SD card - images are saved as <hash>.png so they are only copied once
+imageIndexFile = "index.json" #Name of the image store index in imageDir
+ingestWorkers = 4 #Images copied to the image store at the same time, so reading the USB drive and writing the SD card overlap
+ingestReserve = 50 #Space to leave free on the SD card after the protocol images are copied (MB)
 protocolFile = "Protocol.txt" #Name of the protocol file to be used - must have .txt extension
 resultsFile = None #Name of active results file
 resultFileBase = "Results.txt" #Base file name for the results file - must have .txt extension
-imageExt = ".png" #File extension for valid protocol images
-contrastProtocol = None #Whether or not the current protocl is a contrast series
+imageExt = ".png" #File extension of images in the image store - protocol images are checked against protocol_schema.IMAGE_EXT
+imageTable = [] #List of (name, hash) for every image in the protocol - event records refer to images by their index in this list
+imagePaths = {} #Path in the image store of each image in the protocol
+dryRun = False #Whether the rig is checking a protocol on a virtual clock with a simulated mouse instead of running an experiment
+binaryLog = False #Whether to also write a compact binary event log (.bin) next to the results file
+protocol = None #Parsed protocol of the current experiment - a protocol_schema.Protocol, see retrieveExperiment(driveLabel)
+schedule = None #Reward schedule of the current experiment - a protocol_schema.RewardSchedule drawn from the seed in the results file header
+scheduleLength = 10000 #Draws in each list of the reward schedule, unless the protocol sets "Reward schedule length:" - a longer experiment repeats the schedule
 
 #GPIO variables
 #Arduino pins for testing
@@ -50,23 +79,40 @@ contrastProtocol = None #Whether or not the current protocl is a contrast series
 pinWheel = 11 #TTL input from mouse wheel
 pinDoor = 13 #TTL input from mouse door to reward
 pinPump = 22 #TTL output to pump trigger
-pinStrip = 29 #TTL output to power strip
+pinStrip = 29 #TTL output to power strip - shared by both cages of a two-cage Pi
+
+#Second cage run by this Pi as cage cageNumber + 1, with its own input channels, pump, monitor and USB drive - None runs one cage per Pi
+#The input and log processes are shared by both cages, and each cage has its own image process and results file.  For example:
+#secondCage = {"inputChannels": [{"name": "Wheel", "pin": 16, "role": "wheel", "bounce": 1}, {"name": "Door", "pin": 18, "role": "door", "bounce": 1}],
+#              "pinPump": 32, "displayIndex": 1, "mountDir": "/mnt/usb2/"}
+secondCage = None
+cageGlobals = ["cageNumber", "mountDir", "inputChannels", "pinPump", "displayIndex", "resultsFile", "protocol", "schedule", "imageTable",
+               "imagePaths", "telemetry"] #Module globals that differ between the cages of a two-cage Pi
 
 doorOpen = False #Pin state when door is open
 wheelBounce = 1 #Bounce time between events in which to ignore subsequent events (ms)
 doorBounce = 1 #Bounce time between events in which to ignore subsequent events (ms)
-syncDelay = 0.001 #Sleep delay between GPIO queries to reduce CPU load (s)
-
-#Protocol parameter master dictionary (see retrieveExperiment(driveLabel) for initialization with parsing functions)
-parameterDict = {"USB drive ID:": None, "Control image set:": None, "Reward image set:": None,
-                "Minimum wheel revolutions for reward:": None,  "Maximum wheel revolutions for reward:": None,
-                "Duration of pump \"on\" state (seconds):": None, "Maximum time between wheel events (seconds):": None,
-                "Total duration of the experiment (hours):": None, "Duration of each reward frame (seconds):": None,
-                "Maximum duration of reward state (seconds):": None}
-
-contrastDict = {"Minimum time between contrast increments:": None, "Maximum time between contrast increments:": None,
-                "Minimum contrast ratio (0-100):": None, "Maximum contrast ratio (0-100):": None,
-                "Number of contrast steps:": None}
+#Input channels captured by the input process - "wheel" and "door" run the reward logic and must appear once each, "event" channels such as
+#lick sensors or beam breaks only log their edges.  Bounce is the debounce window of each channel (ms).
+#A wheel with a quadrature encoder uses an "encoderA" and an "encoderB" channel instead of "wheel" - use a bounce of 0 for optical encoders
+inputChannels = [{"name": "Wheel", "pin": pinWheel, "role": "wheel", "bounce": wheelBounce},
+                 {"name": "Door", "pin": pinDoor, "role": "door", "bounce": doorBounce}]
+encoderCountsPerRev = 1024 #Quadrature counts per wheel revolution - every edge on either encoder channel is one count, so 4 per encoder line
+encoderBinInterval = 0.1 #Width of each logged wheel encoder bin (s) - encoder edges are only logged as bins, never one record per edge
+syncDelay = 0.001 #Sleep delay between GPIO queries to reduce CPU load (s) - only used by channels captured in "poll" mode
+stopPollInterval = 0.05 #Time between checks of the stop flag set by the image process, while the input process sleeps waiting for edges (s)
+minPulseWidth = 0.01 #Shortest pulse expected on an input pin (s) - a gap between input loop iterations longer than this could hide a whole pulse
+loopProfileStream = False #Whether to write each suspect gap in the input loop to the results file as it happens, as well as the summary at the end
+keyPollInterval = 0.05 #Time between checks for a keypress in the image process (s)
+displayIndex = 0 #Monitor the image process draws on
+displayVsync = False #Whether to lock image flips to the monitor refresh - image onset is then known to the frame, but each flip waits for the next refresh
+anchorInterval = 600 #Time between wall-clock anchors written to the results file (s)
+logFlushInterval = 0.25 #Maximum time results are held in RAM before being written and synced to the USB drive (s)
+logFlushCount = 64 #Maximum number of results held in RAM before being written and synced to the USB drive
+ringSlots = 4096 #Number of event records each ring buffer between rig processes can hold - must be a power of 2
+telemetryPort = 8765 #Localhost port of the live telemetry endpoint (curl http://127.0.0.1:8765) - None turns the endpoint off
+telemetry = None #Live counters shared by the rig processes - created in runExperiment
+captureMode = "interrupt" #How GPIO edges are captured - "interrupt" timestamps edges in RPi.GPIO callbacks, "poll" samples the pin every syncDelay (legacy)
 
 def hasher(file):
     HASH = hashlib.md5() #MD5 is used as it is faster, and this is not a cryptographic task
@@ -83,68 +129,6 @@ def lxprint(a): #Status display
     with open(PIPE_PATH, "a") as p:
         p.write(a + "\r\n")
 
-#Protocol parsing functions
-def matchString(key, line, refString):
-    #Search for refernce string in line from protocol file
-    if refString in line:
-        lxprint(key + " reference \"" + refString + "\" matches protocol \"" + line + "\"...")
-        return line
-    else:
-        lxprint("ERROR in " + key + " reference \"" + refString + "\" does not match protocol \"" + line + "\"...")
-        return None
-
-def parseList(key, line, refArray):
-    refArray = []
-
-    #Search for a list in the line string
-    listArray = [None] #Initialize the protocol list array
-    line = "".join(line.split()) #This removes all white space - split cuts on \r\n\t and " ", then join puts the remaining bits back into a string
-    listMatch = re.search("\[.*\]", line)
-
-    #If there is a valid list string, parse the string
-    if listMatch:
-        listString = listMatch.group(0)
-        listString = listString[1:-1] #Remove first and last character - "[ ]"
-        listArray = listString.split(",")
-
-        if not (len(listArray) == 1 and listArray[0] == ""): #Parse images if array is not empty
-            for i in listArray:
-                if not i.endswith(imageExt):
-                    lxprint("ERROR: Invalid extension in " + key[:-1] + ", \"" + i + "\" is not \"" + imageExt + "\"...")
-                    return None
-
-            #If loop completes, then image list is valid
-            refArray = listArray
-
-        elif key == "Reward image set:":
-            refArray = []
-            lxprint("ERROR: No reward images found, there must be at least one reward image specified...")
-            return None
-
-        else:
-            refArray = []
-
-    lxprint(key[:-1] + " parsed: " + str(refArray))
-    return refArray
-
-def parseNum(key, line, refNum):
-    #Float search string from: https://stackoverflow.com/questions/4703390/how-to-extract-a-floating-number-from-a-string
-    numeric_const_pattern = '[-+]? (?: (?: \d* \. \d+ ) | (?: \d+ \.? ) )(?: [Ee] [+-]? \d+ ) ?'
-    rx = re.compile(numeric_const_pattern, re.VERBOSE)
-
-    listMatch = rx.search(line)
-    if listMatch:
-        number = float(listMatch.group(0))
-        if(number >= 0):
-            lxprint(key[:-1] + " parsed: " + str(number))
-            return number
-        else:
-            lxprint("ERROR: " + key + " \"" + str(parameterDict[key]) + "\" is less than 0 seconds.")
-            return None
-    else:
-        lxprint("ERROR: \"" + key[:-1] + "\" cannot be parsed...")
-        return None
-
 #----------------------------Raspberry Pi Config--------------------------------------------------------------------------------------------------------------------
 def import_package(p):
     global devnull
@@ -164,7 +148,8 @@ def import_package(p):
         checkPip()
 
         #Use .wait() rather than .communicate() as .wait() returns returnCode, while .communicate() returns tuple with stdout and stderr
-        retcode = subprocess.Popen(["(sudo pip3 install " + p + ")"], shell=True, stdout=devnull, stderr=devnull).wait()
+        with installLock:
+            retcode = subprocess.Popen(["(sudo pip3 install " + p + ")"], shell=True, stdout=devnull, stderr=devnull).wait()
 
         if retcode == 0:
             lxprint("Installing " + p + "...")
@@ -191,7 +176,8 @@ def checkPip():
             lxprint("Installing pip, this may take a few minutes...")
 
         #Use .wait() rather than .communicate() as .wait() returns returnCode, while .communicate() returns tuple with stdout and stderr
-        retcode = subprocess.Popen(["(sudo apt-get install -y python-pip)"], shell=True, stdout=devnull, stderr=devnull).wait()
+        with installLock:
+            retcode = subprocess.Popen(["(sudo apt-get install -y python-pip)"], shell=True, stdout=devnull, stderr=devnull).wait()
         if retcode != 100:
             lxprint("Cannot install pip, aborting program. Check internet connection?")
             quit()
@@ -213,7 +199,8 @@ def configXscreen():
         if retcode != 1:
             lxprint("Installing xScreensaver, this may take a few minutes...")
             #Use .wait() rather than .communicate() as .wait() returns returnCode, while .communicate() returns tuple with stdout and stderr
-            retcode = subprocess.Popen(["(sudo apt-get install -y xscreensaver)"], shell=True, stdout=devnull, stderr=devnull).wait()
+            with installLock:
+                retcode = subprocess.Popen(["(sudo apt-get install -y xscreensaver)"], shell=True, stdout=devnull, stderr=devnull).wait()
             if retcode != 100:
                 lxprint("Error in installing xscreensaver.  Check internet connection?")
                 quit()
@@ -257,7 +244,7 @@ def configXscreen():
     #Inplace means data is moved to backup, and outputs (such as print) are directed to input file
     #Backup allows a backup to be generated with the specified extension
     try:
-        with fileinput.input(files=("/home/pi/.xscreensaver"), inplace=True, backup=".bak") as f:
+        with configEditLock, fileinput.input(files=("/home/pi/.xscreensaver"), inplace=True, backup=".bak") as f:
             for line in f:
                 line = line.rstrip() #removes trailing white spaces (print() will add newline back on)
                 #r"..." means raw string, where \ are used as escape characters
@@ -323,7 +310,7 @@ def disableAutomount():
     #If config file doesn't exist, toggle demo to generate a config file
     if f.is_file():
         try:
-            with fileinput.input(files=("/home/pi/.config/pcmanfm/LXDE-pi/pcmanfm.conf"), inplace=True, backup=".bak") as f:
+            with configEditLock, fileinput.input(files=("/home/pi/.config/pcmanfm/LXDE-pi/pcmanfm.conf"), inplace=True, backup=".bak") as f:
                 for line in f:
                     line = line.rstrip() #removes trailing white spaces (print() will add newline back on)
                     #r"..." means raw string, where \ are used as escape characters
@@ -346,7 +333,8 @@ def disableAutomount():
         reboot = True
         lxprint("Installing \"eject\"...")
         try:
-            dummy = subprocess.Popen(["(sudo apt-get install -y eject)"], shell=True, stdout=devnull, stderr=devnull).wait()
+            with installLock:
+                dummy = subprocess.Popen(["(sudo apt-get install -y eject)"], shell=True, stdout=devnull, stderr=devnull).wait()
         except:
             lxprint("ERROR: could not install \"eject\", please check internet connection.")
             quit()
@@ -425,6 +413,53 @@ def autorestart():
             lxprint("Error: autostart config file could not be found.")
             quit()
 
+def fingerprint(paths=[], commands=[], extra=[]):
+    #Fingerprint of what a pre-flight check verified - the hash of each file it reads or edits, and the location and modification time of each command it runs
+    parts = []
+    for path in paths:
+        parts.append(path + " " + (hasher(path) if os.path.isfile(path) else "missing"))
+    for command in commands:
+        location = shutil.which(command)
+        parts.append(command + " " + (location + " " + str(os.stat(location).st_mtime_ns) if location else "missing"))
+    parts += [str(e) for e in extra]
+    return hashlib.md5("\n".join(parts).encode()).hexdigest()
+
+def bootFingerprint():
+    #Files raspi-config reads for the boot, autologin and overscan settings, and the autostart line of this program
+    return fingerprint(["/boot/config.txt", "/etc/lightdm/lightdm.conf", "/etc/systemd/system/getty@tty1.service.d/autologin.conf", "/etc/xdg/lxsession/LXDE-pi/autostart"],
+                       ["raspi-config"], [os.path.realpath("/etc/systemd/system/default.target")] + sys.argv)
+
+def xscreenFingerprint():
+    return fingerprint(["/home/pi/.xscreensaver"], ["xscreensaver-command"])
+
+def automountFingerprint():
+    return fingerprint(["/home/pi/.config/pcmanfm/LXDE-pi/pcmanfm.conf"], ["eject"])
+
+def loadPreflight():
+    global preflightFile
+    try:
+        with open(preflightFile, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError): #No cache yet, or a damaged one - every check runs
+        return {}
+
+def savePreflight(cache):
+    global preflightFile
+    try:
+        with open(preflightFile + ".tmp", "w") as f:
+            json.dump(cache, f, indent=1)
+        os.replace(preflightFile + ".tmp", preflightFile) #A power cut can never leave a half written cache
+    except OSError:
+        lxprint("WARNING: Pre-flight cache could not be saved, every check will run on the next launch")
+
+def runPreflight(name, check, fingerprintCheck, cache):
+    #Run one pre-flight check unless its fingerprint matches the cache - returns (name, result, duration (s), whether it ran, fingerprint after the check)
+    start = time.monotonic()
+    if fingerprintCheck and cache.get(name) == fingerprintCheck():
+        return name, None, time.monotonic() - start, False, cache[name]
+    result = check()
+    return name, result, time.monotonic() - start, True, fingerprintCheck() if fingerprintCheck else None
+
 #Check setup and run experimient if logged in as pi
 def checkPiConfig():
     global reboot
@@ -436,16 +471,37 @@ def checkPiConfig():
         f = Path(temp_file)
         if f.is_file():
             subprocess.call("sudo rm " + temp_file, shell=True)
-        configBoot()
-        if not configXscreen():
-            lxprint("Please re-install xScreensaver by opening terminal and typing:")
-            lxprint("sudo apt-get install xscreensaver")
-        else:
-            lxprint("Screen configuration successful...")
-        pyudev = import_package("pyudev")
-        disableAutomount()
+
+        #Each check that still needs running runs in its own thread - they spend their time waiting on subprocesses
+        #The read-only queries run side by side, while installs wait on installLock and config edits on configEditLock
+        #pyudev has no fingerprint as the module itself is needed, and importing an installed package is quick
+        cache = loadPreflight()
+        checks = [("configBoot", configBoot, bootFingerprint), ("configXscreen", configXscreen, xscreenFingerprint),
+                  ("disableAutomount", disableAutomount, automountFingerprint), ("pyudev", lambda: import_package("pyudev"), None)]
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(checks)) as pool:
+            futures = [pool.submit(runPreflight, name, check, fingerprintCheck, cache) for name, check, fingerprintCheck in checks]
+            results = [future.result() for future in futures] #Re-raises the SystemExit of a check that called quit()
+        timing = []
+        for name, result, duration, ran, checkFingerprint in results:
+            if name == "pyudev":
+                pyudev = result
+            elif name == "configXscreen" and ran:
+                if not result:
+                    lxprint("Please re-install xScreensaver by opening terminal and typing:")
+                    lxprint("sudo apt-get install xscreensaver")
+                else:
+                    lxprint("Screen configuration successful...")
+            elif not ran:
+                lxprint(name + " is unchanged since it last passed...")
+            if checkFingerprint:
+                cache[name] = checkFingerprint
+            timing.append(name + ": " + "{:.3f}".format(duration) + " s" + ("" if ran else " (cached)"))
+        lxprint("Pre-flight timing - " + ", ".join(timing) + ", Total: " + "{:.3f}".format(time.monotonic() - start) + " s")
         if reboot == True:
             autorestart()
+        else: #Only cache a configuration that is complete - after a reboot every check runs again
+            savePreflight(cache)
 
     elif os.geteuid() == 0:
         autorestart()
@@ -454,87 +510,89 @@ def checkPiConfig():
         lxprint("Invalid user ID: " + str(os.geteuid))
 
 #---------------------------------USB Drive-----------------------------------------------------------------------------------------------------------------------------------------------
+def cageSettings():
+    #Snapshot of the globals that differ between cages - a cage is loaded by selecting its hardware and running retrieveExperiment, then taking a snapshot
+    global cageGlobals
+    return {key: globals()[key] for key in cageGlobals}
+
+def selectCage(cage):
+    #Make a cage's settings the module globals, so code written for one cage runs for this cage
+    globals().update(cage)
+
+def cageHardware():
+    #Settings of each cage run by this Pi before its protocol is loaded - the first cage uses the module globals, the second cage overrides them with secondCage
+    global secondCage
+    hardware = [cageSettings()]
+    if secondCage:
+        hardware.append(dict(hardware[0], cageNumber=hardware[0]["cageNumber"] + 1, **secondCage))
+    return hardware
+
+def driveLabel(device):
+    #File system label of a block device - udev replaces white space with "_" in ID_FS_LABEL, so the label is decoded from ID_FS_LABEL_ENC, which escapes it as "\x20"
+    label = device.get('ID_FS_LABEL_ENC')
+    if label is None:
+        return device.get('ID_FS_LABEL', "").replace("_", " ")
+    return re.sub(r"\\x([0-9a-fA-F]{2})", lambda match: chr(int(match.group(1), 16)), label)
+
 def checkForUSB():
     global mountDir
+    hardware = cageHardware() #Each cage waits for the USB drive labelled with its cage number
+    loaded = {} #Settings of each cage whose protocol is loaded, by cage number
+    drives = [] #Devices of the mounted drives, ejected once the experiment is over
     lxprint("Please insert USB drive:")
     context = pyudev.Context()
     monitor = pyudev.Monitor.from_netlink(context)
-    monitor.filter_by(subsystem='usb')
-    connected = False
-    labelName = None
-    while True:
-        time.sleep(0.2)
-        #Search for whether a USB drive has been connected to the Pi
-        for device in iter(monitor.poll, None):
-            #If a USB drive is connected, then check for location of drive
-            if device.action == 'add' and not connected:
-                test = 0;
-                timeStep = 0.1 #Time between checks for connected device
-                waitTime = 5 #Time out if device is not found
-                deviceFound = False #Flag for if a USB device was found
-                deviceValid = False #Flag for if USB device is valid (correct label and format)
-                deviceFormat = False #Flag for if device has correct partition format (contains a partition #1)
-                while test < waitTime:
-                    test += timeStep
-                    time.sleep(timeStep)
-                    out, err = subprocess.Popen("lsblk -l -o name,label", shell=True, stdout=subprocess.PIPE).communicate() #Name returns partition directory, label returns partition name
-                    outString = out.decode()
-                    if re.search(r"sd[a-z]{1,3}", outString) and not deviceFound:
-                        lxprint("USB device found...")
-                        connected = True
-                        deviceFound = True
-                    if deviceFound and re.search(r"CAGE " + str(cageNumber) + "[A-B]", outString):
-                        lxprint("Valid USB device...")
-                        labelName = re.search(r"CAGE " + str(cageNumber) + "[A-B]", outString).group(0)
-                        deviceValid = True
-                        break
-                    else:
-                        continue
-
-                if test >= waitTime:
-                    if deviceFound:
-                        labelName = re.search(r"CAGE [1-9][A-B]", outString)
-                        if labelName:
-                            lxprint("ERROR: This drive is for " + labelName.group(0)[:-1] + ", please disconnect.")
-
-                        else:
-                            lxprint("ERROR: USB drive is not a protocol drive, please disconnect.")
-                    else:
-                        lxprint("ERROR: USB device was not found.  Please reconnect.")
-                    break
-
-                #Retrieve the drive location
-                dirSearch = re.search("sd[a-z]{1,3}1", outString)
-                if not dirSearch:
-                    dirSearch = re.search("sd[a-z]{1,3}", outString)
-                if dirSearch:
-                    if deviceValid:
-                        USBdir = "/dev/" + dirSearch.group(0)
-
-                        #Mount the USB drive
-                        subprocess.call("sudo mkdir -p " + mountDir, shell=True) #Create directory to which to mount the USB drive if it doesn't exist
-                        subprocess.call("sudo mount -o uid=pi,gid=pi " + USBdir + " " + mountDir, shell=True) #Mount USB to directory in user "pi"
-                        if(retrieveExperiment(labelName)):
-                            lxprint("SUCCESS!")
-                            lxprint("Starting experiment...")
-                            runExperiment()
-                        else:
-                            lxprint("FAILURE!")
-                        ##########################################DEBUG - block auto unmount
-                        if toggleDebug:
-                            input("Press enter...")
-                        subprocess.call("sudo eject " + USBdir, shell=True) #Install eject using command sudo apt-get install eject
-                        lxprint("USB drive is unmounted.  It is safe to remove the drive...")
-                    else:
-                        lxprint("USB drive is unmounted.  It is safe to remove the drive...")
-
+    monitor.filter_by(subsystem='block') #Each partition is reported with its file system label as soon as the kernel has read the partition table
+    monitor.filter_by(subsystem='usb') #Unplugging the drive is reported by its USB device
+    monitor.start()
+    for device in iter(monitor.poll, None):
+        #A new partition, or a drive formatted without a partition table - a partitioned drive has no file system of its own and is skipped
+        if device.action == 'add' and device.subsystem == 'block' and device.get('ID_FS_TYPE'):
+            detected = time.monotonic()
+            lxprint("USB device found...")
+            labelName = driveLabel(device)
+            labelSearch = re.fullmatch(r"CAGE (" + "|".join(str(cage["cageNumber"]) for cage in hardware if cage["cageNumber"] not in loaded) + ")[A-B]", labelName) #Drives still needed
+            if not labelSearch:
+                if re.fullmatch(r"CAGE [1-9][A-B]", labelName):
+                    lxprint("ERROR: This drive is for " + labelName[:-1] + ", please disconnect.")
                 else:
-                    lxprint("ERROR: USB device is no longer found.  Please reconnect.")
-
-            #if a USB drive is disconnected, print result
-            if device.action == 'remove':
-                lxprint("USB drive has been removed...")
-                return
+                    lxprint("ERROR: USB drive is not a protocol drive, please disconnect.")
+                continue
+
+            lxprint("Valid USB device...")
+            USBdir = device.device_node
+            cage = next(cage for cage in hardware if cage["cageNumber"] == int(labelSearch.group(1)))
+            selectCage(cage) #Mount the drive and load the protocol for this cage
+
+            #Mount the USB drive
+            subprocess.call("sudo mkdir -p " + mountDir, shell=True) #Create directory to which to mount the USB drive if it doesn't exist
+            subprocess.call("sudo mount -o uid=pi,gid=pi " + USBdir + " " + mountDir, shell=True) #Mount USB to directory in user "pi"
+            drives.append(USBdir)
+            if(retrieveExperiment(labelName)):
+                lxprint("SUCCESS!")
+                lxprint("USB drive found to protocol parsed: " + "{:.0f}".format((time.monotonic() - detected)*1000) + " ms")
+                loaded[cage["cageNumber"]] = cageSettings()
+                if len(loaded) < len(hardware): #Wait for the drive of the other cage, so both cages start together
+                    lxprint("Please insert USB drive for the other cage:")
+                    continue
+                lxprint("Starting experiment...")
+                runExperiment(cages=[loaded[cage["cageNumber"]] for cage in hardware])
+            else:
+                lxprint("FAILURE!")
+            ##########################################DEBUG - block auto unmount
+            if toggleDebug:
+                input("Press enter...")
+            for USBdir in drives:
+                subprocess.call("sudo eject " + USBdir, shell=True) #Install eject using command sudo apt-get install eject
+            lxprint("USB drive is unmounted.  It is safe to remove the drive...")
+            selectCage(hardware[0]) #Return to the first cage's settings for the next experiment
+            loaded = {}
+            drives = []
+
+        #if a USB drive is disconnected, print result
+        if device.action == 'remove' and device.subsystem == 'usb' and device.device_type == 'usb_device':
+            lxprint("USB drive has been removed...")
+            return
 
 def retrieveExperiment(driveLabel):
     global mountDir
@@ -543,549 +601,2127 @@ def retrieveExperiment(driveLabel):
     global resultsFile
     global resultsFileBase
     global imageExt
-    global parameterDict
-    global contrastDict
-    global contrastProtocol
-
-    #Re-initialize the parameter dictionary with the appropriate parsing functions
-    parameterDict = {"USB drive ID:": matchString, "Control image set:": parseList, "Reward image set:": parseList,
-                "Minimum wheel revolutions for reward:": parseNum,  "Maximum wheel revolutions for reward:": parseNum,
-                "Duration of pump \"on\" state (seconds):": parseNum, "Maximum time between wheel events (seconds):": parseNum,
-                "Total duration of the experiment (hours):": parseNum, "Duration of each reward frame (seconds):": parseNum,
-                "Maximum duration of reward state (seconds):": parseNum}
-
-    contrastDict = {"Minimum time between contrast increments:": None, "Maximum time between contrast increments:": None,
-                    "Minimum contrast ratio (0-100):": None, "Maximum contrast ratio (0-100):": None,
-                    "Number of contrast steps:": None}
+    global protocol
+    global schedule
+    global scheduleLength
+    global imageTable
+    global imagePaths
 
     f = Path(mountDir + protocolFile)
     #Extract experiment protocol and make sure it is valid
-    lines = None #Export of protocol to RAM so it can be added as a header to the results file
     if f.is_file():
         #Append date to protocol file to flag it as being used and prevent accidental reuse
         protocolHash = hasher(mountDir + protocolFile)
         newProtocolFile = re.sub(".txt", " - " + str(datetime.now())[:10] + " " + protocolHash + ".txt", protocolFile)
         #######################################################DEBUG - toggle protocol rename
-        if toggleDebug:
+        if toggleDebug or dryRun: #A dry run must leave the protocol ready for the real experiment
             newProtocolFile = protocolFile
         else:
             os.rename(mountDir + protocolFile, mountDir + newProtocolFile)
 
-        #Parse the protocol file
-        ref = None #Ref variable to be passed to parsing functions if needed
-        with open(mountDir + newProtocolFile, "r") as exp:
-            lines = exp.readlines()
-            exp.seek(0) #Return back to the start of the file
-            for line in exp:
-                for key, func in parameterDict.items():
-                    if(line.startswith(key)):
-                        if "USB drive ID:" in key:
-                            ref = driveLabel
-                        else:
-                            ref = None
-                        parameterDict[key] = func(key, line.split(key, 1)[1].strip(), ref) #Send key and data afer ":" with leading and trailing whitespace removed
-
-                for key, func in contrastDict.items():
-                    if(line.startswith(key)):
-                        contrastDict[key] = parseNum(key, line.split(key, 1)[1].strip(), None) #Send key and data afer ":" with leading and trailing whitespace removed
-
-
-        #Check dict and flag missing components
-        nValid = 0
-        for key, value in parameterDict.items():
-            if callable(value): #If value is still function = line not found
-                lxprint("Cannot find: \"" + key + "\" in protocol file...")
-            elif value is None:
-                pass
-            else:
-                nValid += 1
-        lxprint(str(nValid) + " of " + str(len(parameterDict)) + " parameter lines parsed...")
-
-        nContrast = 0
-        contrastProtocol = False
-        for key, value in contrastDict.items(): #See if there is a contrast portion in the protocol
-            if value: #If value is not None, then contrast protocol is active
-                contrastProtocol = True
-
-        if contrastProtocol: #If there is a contrast portion, make sure it is complete
-            for key, value in contrastDict.items():
-                if value: #If value is not None, then contrast protocol is active
-                    nContrast += 1
-                else:
-                    lxprint("Cannot find: \"" + key + "\" in contrast section of protocol file...")
-
-            lxprint(str(nContrast) + " of " + str(len(contrastDict)) + " contrast lines parsed...")
-        else:
+        #Parse the protocol file in one pass - lines are kept in RAM so they can be added as a header to the results file
+        protocol, lines = readProtocol(mountDir + newProtocolFile, driveLabel)
+        for field in FIELDS:
+            value = getattr(protocol, field.name)
+            if value is not None and field.section not in (SECTION_INFO, SECTION_RESULTS):
+                lxprint(field.key[:-1] + " parsed: " + str(value))
+        if not protocol.contrast:
             lxprint("Contrast protocol not found...")
+        for error in protocol.errors: #Report every problem with the protocol at once
+            lxprint("ERROR: " + error)
 
         #If all components parsed successfully, check that all images are available
-        if ((nValid == len(parameterDict)) and ((nContrast == len(contrastDict)) == contrastProtocol)): #If all elements passed parsing
-            #Verify that all images in the protocol are included in the file directory
-            if(contrastProtocol == (contrastDict["Number of contrast steps:"] == len(parameterDict["Reward image set:"]))):
-                imageSet = list(set(parameterDict["Control image set:"] + parameterDict["Reward image set:"])) #Create a list of all unique images in the protocol using "set"
-                lxprint("Transferring images to SD card...")
-                subprocess.call("sudo mkdir -p " + imageDir, shell=True) #Create directory to which to transfer images if it doesn't exist
-                for i in imageSet:
-                    f = Path(mountDir + "images/" + i)
-                    if f.is_file():
-                        subprocess.call("sudo cp " + mountDir + "images/" + i + " " + imageDir, shell=True) #Move valid images to the SD card
-                    else:
-                        lxprint("ERROR: File \"" + i + "\" could not be found in \"" + mountDir + "images/\"")
-                        return False
-
-                #Export the protocol to the results file
-                if lines is not None:
-                    resultsFile = re.sub(".txt", " - " + str(datetime.now())[:10] + " " + protocolHash + ".txt", resultFileBase)
-                    lines.insert(0, "Date: " + str(datetime.now()) + "\r\n")
-                with open(mountDir + resultsFile, "w+") as f:
-                    for a in lines:
-                        f.write(a)
-
-                    #Add file hashes
-                    f.write("Protocol hash: " + protocolHash + "\r\n")
-                    f.write("Image hashes: \r\n")
-                    for i in sorted(set(parameterDict["Control image set:"] + parameterDict["Reward image set:"])):
-                        f.write(i + " - " + hasher(imageDir + i) + "\r\n")
-                    f.write("\r\n-------------------------------Start of experiment-----------------------------------------------\r\n\r\n")
-                return True
-            else:
-                lxprint("ERROR: " + str(contrastDict["Number of contrast steps:"]) + " contrast steps not equal to " + str(len(parameterDict["Reward image set:"])) + " reward images.")
+        if not protocol.errors:
+            imageSet = protocol.images()
+            lxprint("Transferring images to SD card...")
+            hashDict = ingestImages(imageSet, mountDir + "images/") #Hashes are computed once here and looked up from memory for the rest of the experiment
+            if hashDict is None:
+                return False
+            imagePaths = {i: imageDir + HASH + imageExt for i, HASH in hashDict.items()}
+
+            #Draw every random choice of the experiment up front - the seed and length are added to the results file header if the protocol did not set them
+            scheduleFields = [field for field in FIELDS if field.name in ("scheduleSeed", "scheduleLength") and getattr(protocol, field.name) is None]
+            if protocol.scheduleSeed is None:
+                protocol.scheduleSeed = random.SystemRandom().randrange(2**32)
+            if protocol.scheduleLength is None:
+                protocol.scheduleLength = scheduleLength
+            start = time.monotonic()
+            schedule = RewardSchedule(protocol)
+            lxprint("Reward schedule - Seed: " + str(protocol.scheduleSeed) + ", Length: " + str(protocol.scheduleLength) + ", Drawn in: " +
+                    "{:.1f}".format((time.monotonic() - start)*1000) + " ms")
+
+            #Export the protocol to the results file
+            resultsFile = re.sub(".txt", " - " + str(datetime.now())[:10] + " " + protocolHash + ".txt", resultFileBase)
+            lines.insert(0, "Date: " + str(datetime.now()) + "\r\n")
+            if not lines[-1].endswith("\n"): #Keep the lines added below off the last protocol line
+                lines[-1] += "\r\n"
+            with open(mountDir + resultsFile, "w+") as f:
+                for a in lines:
+                    f.write(a)
+                for field in scheduleFields:
+                    f.write(field.format(getattr(protocol, field.name)) + "\r\n")
+
+                #Add file hashes
+                f.write("Protocol hash: " + protocolHash + "\r\n")
+                f.write("Image hashes: \r\n")
+                imageTable = [(i, hashDict[i]) for i in sorted(hashDict)]
+                for i, HASH in imageTable:
+                    f.write(i + " - " + HASH + "\r\n")
+                f.write("\r\n-------------------------------Start of experiment-----------------------------------------------\r\n\r\n")
+            return True
 
     else:
         lxprint("ERROR: \"" + protocolFile + "\" not found on USB drive.")
 
     return False
 
-
-#---------------------------------Run experiment-----------------------------------------------------------------------------------------------------------------------------------------------
-def imageProcess(connLog, stopQueue, doorPipe, wheelPipe, expStart):
+def loadImageIndex():
+    #Image store index - "store" maps each hash to the [size, mtime] of the stored copy, "sources" maps "name|size|mtime" of a USB file to its hash
     global imageDir
-    global syncDelay
-    global parameterDict
-    global contrastDict
-    global contrastProtocol
-
-    minContrastTime = contrastDict["Minimum time between contrast increments:"]
-    maxContrastTime = contrastDict["Maximum time between contrast increments:"]
-    nContrastSteps = contrastDict["Number of contrast steps:"]
-    if contrastProtocol:
-        rewardFramePeriod = random.uniform(minContrastTime, maxContrastTime)
-    else:
-        rewardFramePeriod = parameterDict["Duration of each reward frame (seconds):"]
-
+    global imageIndexFile
+    try:
+        with open(imageDir + imageIndexFile, "r") as f:
+            index = json.load(f)
+        if "store" in index and "sources" in index:
+            return index
+    except (OSError, ValueError):
+        pass
+    return {"store": {}, "sources": {}}
+
+def saveImageIndex(index):
+    #Write to a temp file first, so a power failure cannot leave a half written index
+    global imageDir
+    global imageIndexFile
+    with open(imageDir + imageIndexFile + ".tmp", "w") as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(imageDir + imageIndexFile + ".tmp", imageDir + imageIndexFile)
+
+def copyAndHash(source, target):
+    #Copy a file and hash it in the same pass, so each image is only read once - returns (hash, bytes, read time (s), write time (s))
+    HASH = hashlib.md5()
+    nBytes = 0
+    readTime = 0
+    writeTime = 0
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        while True:
+            start = time.monotonic()
+            block = src.read(1048576) #1 MB buffer - large reads suit USB drives
+            readTime += time.monotonic() - start
+            if not block:
+                break
+            HASH.update(block)
+            start = time.monotonic()
+            dst.write(block)
+            writeTime += time.monotonic() - start
+            nBytes += len(block)
+        start = time.monotonic()
+        dst.flush()
+        os.fsync(dst.fileno()) #The copy is on the SD card before it is renamed into the store - this also makes the write time the SD card's, not the page cache's
+        writeTime += time.monotonic() - start
+    return HASH.hexdigest(), nBytes, readTime, writeTime
+
+def ingestImages(imageSet, sourceDir):
+    #Add images to the content-addressed image store on the SD card, returns a dictionary of image name to hash, or None on failure
+    #Each image is only hashed the first time it is seen (keyed by name, size, and mtime on the USB drive) - a new image is copied and hashed in one pass
+    #by a small pool of worker threads, and the copy is discarded if the store already holds the same image
+    global imageDir
+    global imageExt
+    global ingestWorkers
+    global ingestReserve
 
-    def sendLog(image):
-        global imageDir
-        nonlocal rewardFramePeriod
-        #Send image data to log
-        HASH = str(hasher(imageDir + image)) #Get image hash - computing hash takes 2 ms
-        timer = time.time() - expStart #Get experiment time
-        connLog.send("Image - Name: " + image + ", Hash: " + HASH + ", Duration: " + "{:.3f}".format(rewardFramePeriod) + ", Time: " + "{:.3f}".format(time.time() - expStart)) #"{:.3f}".format() returns three places after the decimal point
-        return
+    #Make sure the store exists and is writable by this user - older versions created it with sudo
+    os.makedirs(imageDir, exist_ok=True)
+    if not os.access(imageDir, os.W_OK):
+        subprocess.call("sudo chown -R " + str(os.geteuid()) + ":" + str(os.getegid()) + " " + imageDir, shell=True)
 
-    def displayImage(i):
-        nonlocal pictureDict
-        windowSurfaceObj.blit(pictureDict[i],(0,0))
-        pygame.display.update()
-        sendLog(i)
-        return
+    index = loadImageIndex()
 
-    def preloadImages(array):
-        global imageDir
-        subset = set(array) #Create list of all unique entries
-        pictures = {}
-        for i in subset:
-            pictures[i] = pygame.image.load(imageDir + i)
-        return pictures
-
-    def changeToControl():
-        nonlocal wheelPipe
-        nonlocal pictureDict
-        global parameterDict
-        nonlocal rewardIndex
-        nonlocal wheelWait
-
-        wheelPipe.send(1) #Tell wheel process that reward state ended
-        if parameterDict["Control image set:"]: #If the control array is not empty, switch to a randomly selected control image
-            displayImage(random.choice(parameterDict["Control image set:"]))
+    def storeValid(HASH):
+        #A stored copy is trusted without re-hashing if its size and mtime still match the index
+        if HASH not in index["store"]:
+            return False
+        try:
+            stat = os.stat(imageDir + HASH + imageExt)
+        except OSError:
+            return False
+        return [stat.st_size, stat.st_mtime_ns] == index["store"][HASH]
+
+    def sourceKey(i):
+        stat = os.stat(sourceDir + i)
+        return i + "|" + str(stat.st_size) + "|" + str(stat.st_mtime_ns)
+
+    def ingest(n, i, key):
+        #Runs in the worker pool, which only reads the index - returns (name, key, hash, whether the image was copied, bytes, read time (s), write time (s))
+        lxprint("Copying " + i + " to SD card...")
+        temp = imageDir + "ingest-" + str(n) + ".tmp" #The hash, and so the name in the store, is only known once the copy is done
+        try:
+            HASH, nBytes, readTime, writeTime = copyAndHash(sourceDir + i, temp)
+            if storeValid(HASH): #Same image as one already in the store, under another name or mtime
+                os.remove(temp)
+                lxprint(i + " is already on the SD card...")
+                return i, key, HASH, False, nBytes, readTime, writeTime
+            os.replace(temp, imageDir + HASH + imageExt)
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return i, key, HASH, True, nBytes, readTime, writeTime
+
+    #Find the images that are not in the store yet, and make sure they fit on the SD card before copying any of them
+    hashDict = {}
+    newImages = [] #(name, key) of each image that has to be copied
+    needed = 0 #Bytes to be copied
+    for i in imageSet:
+        if not Path(sourceDir + i).is_file():
+            lxprint("ERROR: File \"" + i + "\" could not be found in \"" + sourceDir + "\"")
+            return None
+        key = sourceKey(i)
+        HASH = index["sources"].get(key)
+        if HASH is not None and storeValid(HASH):
+            lxprint(i + " is already on the SD card...")
+            hashDict[i] = HASH
         else:
-            displayImage(random.choice(parameterDict["Reward image set:"])) #If no control images are available, show a reward image
-        rewardIndex = 0 #Reset the reward frame index
-        wheelWait = False #Reset wheel wait flag
-        return False
+            newImages.append((i, key))
+            needed += os.stat(sourceDir + i).st_size
+    free = shutil.disk_usage(imageDir).free
+    if needed + ingestReserve*1e6 > free:
+        lxprint("ERROR: Not enough space on the SD card for the protocol images - Needed: " + "{:.1f}".format(needed/1e6) + " MB, Free: " +
+                "{:.1f}".format(free/1e6) + " MB, Reserve: " + str(ingestReserve) + " MB")
+        return None
 
-    def clearPipe(p):
-        var = None
-        while p.poll():
-            var = p.recv()
-        return var
+    if newImages:
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=ingestWorkers) as pool:
+                results = list(pool.map(lambda image: ingest(image[0], *image[1]), enumerate(newImages)))
+        except OSError as e:
+            lxprint("ERROR: Images could not be copied to the SD card: " + str(e))
+            return None
+        elapsed = time.monotonic() - start
+        nBytes = 0
+        readTime = 0
+        writeTime = 0
+        nCopied = 0
+        for i, key, HASH, copied, size, readSeconds, writeSeconds in results:
+            if copied:
+                stat = os.stat(imageDir + HASH + imageExt)
+                index["store"][HASH] = [stat.st_size, stat.st_mtime_ns]
+                nCopied += 1
+            index["sources"][key] = HASH
+            hashDict[i] = HASH
+            nBytes += size
+            readTime += readSeconds
+            writeTime += writeSeconds
+
+        #Read and write rates are per stream - a slow USB drive shows up in the read rate, a slow SD card in the write rate
+        lxprint("Image ingest - Copied: " + str(nCopied) + " of " + str(len(newImages)) + " images, " + "{:.1f}".format(nBytes/1e6) + " MB in " +
+                "{:.2f}".format(elapsed) + " s (" + "{:.1f}".format(nBytes/1e6/max(elapsed, 1e-6)) + " MB/s), USB read: " +
+                "{:.1f}".format(nBytes/1e6/max(readTime, 1e-6)) + " MB/s, SD write: " + "{:.1f}".format(nBytes/1e6/max(writeTime, 1e-6)) + " MB/s")
+
+    saveImageIndex(index)
+    return hashDict
 
-    connLog.send("Image starting at: " + "{:.3f}".format(time.time()-expStart))
 
-    #Exit program on any key press
-    run = True
+#---------------------------------Run experiment-----------------------------------------------------------------------------------------------------------------------------------------------
+class ExperimentClock:
+    #Experiment clock shared by all rig processes - based on the monotonic clock so NTP steps and DST changes cannot shift event times
+    #The start point is set once in runExperiment and copied to each process on fork, so all processes share the same time base
+    virtual = False #Whether time only moves when the rig advances it (dry run)
+
+    def __init__(self):
+        self.startNs = time.monotonic_ns() #Monotonic time at the start of the experiment (ns)
+
+    def nowNs(self):
+        #Experiment time (ns)
+        return time.monotonic_ns() - self.startNs
+
+    def now(self):
+        #Experiment time (s)
+        return self.nowNs()/1e9
+
+    def anchor(self):
+        #Pair of experiment time and wall-clock time (ns) so event times can be mapped back to real time
+        expTime = self.nowNs()
+        wallTime = time.time_ns()
+        return expTime, wallTime
+
+class VirtualClock(ExperimentClock):
+    #Experiment clock for dry runs - time stands still until advance() is called, so the rig can jump straight to its next deadline
+    #The time is in shared memory, so the rig processes of the multiprocess runtime all read the same virtual time.  Each process that has
+    #deadlines is a "slot": instead of sleeping it calls wait(), and once every slot is waiting with no record left in the rings it waits on,
+    #time jumps to the earliest deadline of any slot and every waiting slot is woken.
+    virtual = True
+    IDLE = 0 #Slot state index - 1 while the slot is waiting, 2 once it has finished
+    DEADLINE = 1 #Slot state index - earliest deadline of the waiting slot (ns), -1 for none
+    RINGS = 2 #Slot state index - bit mask of the rings the waiting slot wakes on
+    WOKEN = 3 #Slot state index - time the slot was last woken by a step (ns)
+    FIELDS = 4 #Slot state values per slot
+
+    def __init__(self):
+        self.startNs = 0
+        self.time = Value("q", 0, lock=False) #Current experiment time (ns) - shared with the rig processes on fork
+        self.wallStartNs = time.time_ns() #Wall-clock time the dry run started, so anchors still look like real times
+        self.slots = [] #Name of each slot
+        self.rings = [] #Rings between the slots
+
+    def nowNs(self):
+        return self.time.value
+
+    def advance(self, timeNs):
+        #Move time forward - never backwards.  Deadlines can fall between two ns, so round up or a deadline would never expire
+        self.time.value = max(self.time.value, -int(-timeNs//1))
+
+    def anchor(self):
+        return self.time.value, self.wallStartNs + self.time.value
+
+    def share(self, slots, rings):
+        #Set up the slots before the rig processes fork - slots is the name of each process that calls wait(), rings are the rings between them
+        self.slots = slots
+        self.rings = rings
+        self.state = Array("q", self.FIELDS*len(slots), lock=False)
+        for slot in range(len(slots)):
+            self.state[self.FIELDS*slot + self.WOKEN] = -1
+        self.lock = Lock() #Guards the slot state and the step of time
+        self.ticks = [] #Pipe of each slot, written when time moves on
+        for name in slots:
+            readFd, writeFd = os.pipe()
+            os.set_blocking(readFd, False)
+            os.set_blocking(writeFd, False)
+            self.ticks.append((readFd, writeFd))
+
+    def tick(self, slot):
+        try:
+            os.write(self.ticks[slot][1], b"\0")
+        except BlockingIOError: #The slot already has a wake-up waiting
+            pass
+
+    def step(self):
+        #With the lock held - move time to the earliest deadline once every slot still running is waiting and none of them has a record to read
+        #A deadline that has already passed is kept at the current time if its slot has not been woken at this time, so everything due at one time
+        #happens at that time once all slots have settled.  Otherwise time moves on by 1 ns, so a deadline that rounds to the current time cannot stall the run
+        running = [slot for slot in range(len(self.slots)) if self.state[self.FIELDS*slot + self.IDLE] != 2]
+        nowNs = self.time.value
+        deadlines = []
+        for slot in running:
+            if not self.state[self.FIELDS*slot + self.IDLE]:
+                return
+            mask = self.state[self.FIELDS*slot + self.RINGS]
+            if any(mask >> i & 1 and ring.poll() for i, ring in enumerate(self.rings)): #The slot is about to wake on the record
+                return
+            deadline = self.state[self.FIELDS*slot + self.DEADLINE]
+            if deadline >= 0:
+                if deadline <= nowNs:
+                    deadline = nowNs if self.state[self.FIELDS*slot + self.WOKEN] < nowNs else nowNs + 1
+                deadlines.append(deadline)
+        if deadlines:
+            self.advance(min(deadlines))
+            self.wake(running)
+
+    def wake(self, slots):
+        #With the lock held - wake slots, which count as running until they wait again, so time cannot move on before they have seen it
+        for slot in slots:
+            self.state[self.FIELDS*slot + self.IDLE] = 0
+            self.state[self.FIELDS*slot + self.WOKEN] = self.time.value
+            self.tick(slot)
+
+    def wait(self, name, waitList, deadlineNs):
+        #Used by slot name in place of multiprocessing.connection.wait - returns the objects in waitList that are ready, once one is ready
+        #or time has moved on.  deadlineNs is the earliest time the slot needs to wake (ns), or None
+        slot = self.slots.index(name)
+        ready = wait(waitList, timeout=0)
+        if ready:
+            return ready
+        with self.lock:
+            self.state[self.FIELDS*slot + self.IDLE] = 1
+            self.state[self.FIELDS*slot + self.DEADLINE] = -1 if deadlineNs is None else -int(-deadlineNs//1)
+            self.state[self.FIELDS*slot + self.RINGS] = sum(1 << i for i, ring in enumerate(self.rings) if ring in waitList)
+            self.step()
+        tickFd = self.ticks[slot][0]
+        ready = wait(waitList + [tickFd], timeout=None)
+        with self.lock:
+            self.state[self.FIELDS*slot + self.IDLE] = 0
+        if tickFd in ready:
+            try:
+                while os.read(tickFd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            ready.remove(tickFd)
+        return ready
+
+    def finish(self, name):
+        #The slot has stopped - it no longer holds time back, and every other slot is woken to check whether it should stop too
+        if name not in self.slots:
+            return
+        slot = self.slots.index(name)
+        with self.lock:
+            self.state[self.FIELDS*slot + self.IDLE] = 2
+            self.wake([other for other in range(len(self.slots)) if self.state[self.FIELDS*other + self.IDLE] == 1])
+
+def cpuSummary(name, start):
+    #CPU time used by the calling process since start (an os.times() result) - written at the end of each rig process so runtimes can be compared
+    end = os.times()
+    return ("CPU time - Process: " + name + ", User: " + "{:.3f}".format(end.user - start.user) + " s, System: " +
+            "{:.3f}".format(end.system - start.system) + " s")
+
+class LatencyHistogram:
+    #Fixed-size histogram of latencies, so memory use does not grow over a long experiment - percentiles are only accurate to the bin width, which is printed with them
+    def __init__(self, binNs=10000, nBins=10000):
+        self.binNs = binNs #Width of each bin (ns)
+        self.bins = [0]*(nBins + 1) #Last bin counts every latency beyond the range of the histogram
+        self.count = 0
+        self.totalNs = 0
+        self.maxNs = 0
+
+    def add(self, latencyNs):
+        latencyNs = max(0, int(latencyNs))
+        self.bins[min(latencyNs//self.binNs, len(self.bins) - 1)] += 1
+        self.count += 1
+        self.totalNs += latencyNs
+        if latencyNs > self.maxNs:
+            self.maxNs = latencyNs
+
+    def percentile(self, p):
+        #p-th percentile (ns), interpolated linearly within the bin holding it - capped at the largest latency seen
+        target = p/100*self.count
+        total = 0
+        for i, n in enumerate(self.bins):
+            if n and total + n >= target:
+                upper = (i + 1)*self.binNs if i < len(self.bins) - 1 else self.maxNs #The last bin has no upper edge
+                return min(i*self.binNs + (target - total)/n*(upper - i*self.binNs), self.maxNs)
+            total += n
+        return self.maxNs
+
+    def summary(self, name):
+        if not self.count:
+            return name + " (ms) - Count: 0"
+        ms = lambda ns: "{:.3f}".format(ns/1e6)
+        return (name + " (ms) - Count: " + str(self.count) + ", Mean: " + ms(self.totalNs/self.count) + ", p50: " + ms(self.percentile(50)) +
+                ", p95: " + ms(self.percentile(95)) + ", p99: " + ms(self.percentile(99)) + ", Max: " + ms(self.maxNs) + ", Percentile bin: " + ms(self.binNs))
+
+class LoopProfiler:
+    #Per-iteration timing of the input process loop - used to size syncDelay and the bounce times from data
+    #In poll capture mode a pin is only sampled once per iteration, so a gap between iterations longer than the shortest expected pulse is a
+    #"suspect gap" that could have hidden a whole pulse.  In interrupt capture mode edges are still captured during a gap, and the loop sleeps until
+    #the next edge or deadline, so no gap is suspect.
+    def __init__(self, name, minGapNs):
+        self.name = name #Name of the process in the summary
+        self.minGapNs = minGapNs #Shortest gap counted as suspect (ns) - None if no gap is suspect
+        self.interval = LatencyHistogram() #Time between the starts of successive iterations
+        self.handling = LatencyHistogram() #Time spent handling each iteration, not counting the sleep
+        self.lastNs = None #Start of the previous iteration (ns)
+        self.suspectGaps = 0
+        self.maxGapNs = 0 #Longest gap between iterations (ns)
+        self.maxGapTime = 0 #Experiment time the longest gap started (ns)
+
+    def sample(self, nowNs):
+        #Called at the start of each iteration - returns the gap (ns) if it is a suspect gap, otherwise None
+        gap = None
+        if self.lastNs is not None:
+            interval = nowNs - self.lastNs
+            self.interval.add(interval)
+            if interval > self.maxGapNs:
+                self.maxGapNs = interval
+                self.maxGapTime = self.lastNs
+            if self.minGapNs is not None and interval > self.minGapNs:
+                self.suspectGaps += 1
+                gap = interval
+        self.lastNs = nowNs
+        return gap
+
+    def gapLine(self, gapNs):
+        return self.name + " loop suspect gap - Gap: " + "{:.3f}".format(gapNs/1e6) + " ms, Time: " + formatTime(self.lastNs - gapNs)
+
+    def summary(self, captureMode):
+        return [self.interval.summary(self.name + " loop interval"), self.handling.summary(self.name + " loop handling time"),
+                self.name + " loop suspect gaps - Count: " + str(self.suspectGaps) + ", Threshold: " +
+                ("{:.3f}".format(self.minGapNs/1e6) + " ms" if self.minGapNs is not None else "none") + ", Longest: " +
+                "{:.3f}".format(self.maxGapNs/1e6) + " ms at " + formatTime(self.maxGapTime) + ", Capture: " + captureMode]
+
+class RewardLatency:
+    #Collects the time of each hop of a reward event by its correlation ID: wheel edge -> image process -> reward image on screen and door process
+    #Latencies are measured from the wheel edge that completed the revolutions needed for the reward
+    HOP_NAMES = {HOP_WHEEL_SENT: "Wheel sent", HOP_IMAGE_RECEIVED: "Image received", HOP_IMAGE_SHOWN: "Image shown", HOP_PUMP_ARMED: "Pump armed"}
+
+    def __init__(self):
+        self.pending = {} #Hop times (ns) of each reward event that has not yet passed every hop
+        self.histograms = {hop: LatencyHistogram() for hop in self.HOP_NAMES}
+
+    def add(self, record):
+        #Add an EVENT_HOP record - returns the latency line for the reward event once every hop has been seen, otherwise None
+        rewardId = record[4]
+        hops = self.pending.setdefault(rewardId, {})
+        hops[record[2]] = record[3]
+        if HOP_EDGE not in hops or any(hop not in hops for hop in self.HOP_NAMES):
+            return None
+        del self.pending[rewardId]
+        line = "Reward latency - ID: " + str(rewardId)
+        for hop, name in self.HOP_NAMES.items():
+            latency = hops[hop] - hops[HOP_EDGE]
+            self.histograms[hop].add(latency)
+            line += ", " + name + ": " + "{:.3f}".format(latency/1e6) + " ms"
+        return line
+
+    def summary(self):
+        lines = [self.histograms[hop].summary("Reward latency, wheel edge to " + name.lower()) for hop, name in self.HOP_NAMES.items()]
+        if self.pending: #Rewards still in progress at the end of the experiment, or with a hop lost to a ring overflow
+            lines.append("Reward latency - Incomplete reward events: " + str(len(self.pending)))
+        return lines
+
+class RigTelemetry:
+    #Live counters shared by the rig processes and served as JSON by telemetryProcess, so a long run can be watched without reading the results file
+    #Each counter has exactly one writing process and is a 32-bit value in shared memory, so updating it is a single store that never waits on the reader
+    PROCESSES = ["Input", "Image", "Log", "Reactor"] #Rig processes that report their loop time
+    PROCESS_FIELDS = ["pid", "loops", "loopUs", "maxLoopUs"] #Process ID, loop iterations, time spent handling the last iteration and the longest one (us)
+    STATE_FIELDS = ["rewardState", "pumpOn", "wheelCount", "rewardRev", "rewards", "bytesWritten", "atRisk"]
+
+    def __init__(self, channels, inputNames):
+        #channels - dict of every channel code to its name, codes are numbered from 0.  inputNames - names of the input channels.
+        self.channels = channels
+        self.inputNames = inputNames
+        self.fields = ["events " + channels[c] for c in range(len(channels))] + self.STATE_FIELDS #Events are first, so they are indexed by channel code
+        self.fields += ["glitches " + name for name in inputNames]
+        self.fields += [name + " " + field for name in self.PROCESSES for field in self.PROCESS_FIELDS]
+        self.index = {field: i for i, field in enumerate(self.fields)}
+        self.values = Array("I", len(self.fields), lock=False) #Shared with the rig processes on fork
+
+    def set(self, field, value):
+        self.values[self.index[field]] = int(value) & 0xFFFFFFFF
+
+    def get(self, field):
+        return self.values[self.index[field]]
+
+    def countEvent(self, channel):
+        #Count a logged event - called by the process writing the results file
+        self.values[channel] = (self.values[channel] + 1) & 0xFFFFFFFF
+
+    def start(self, process):
+        self.values[self.index[process + " pid"]] = os.getpid()
+
+    def loop(self, process, loopNs):
+        #Record the time a rig loop spent handling one iteration, not counting the time it slept
+        i = self.index[process + " loops"]
+        loopUs = int(loopNs)//1000
+        self.values[i] = (self.values[i] + 1) & 0xFFFFFFFF
+        self.values[i+1] = loopUs
+        if loopUs > self.values[i+2]:
+            self.values[i+2] = loopUs
+
+def processUsage(pid):
+    #CPU time (s) and resident memory (MB) of a process, read from /proc - None if the process is not running
+    try:
+        with open("/proc/" + str(pid) + "/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split() #Process name is in brackets and may contain spaces
+    except (OSError, IndexError):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return (int(fields[11]) + int(fields[12]))/ticks, int(fields[21])*os.sysconf("SC_PAGE_SIZE")/1e6 #utime + stime, rss
+
+def telemetrySnapshot(counters, ringDict, clock):
+    #counters - RigTelemetry of one cage
+    snapshot = {"time": round(clock.now(), 3),
+                "events": {counters.channels[c]: counters.values[c] for c in range(len(counters.channels))},
+                "reward": {field: counters.get(field) for field in ["rewardState", "pumpOn", "wheelCount", "rewardRev", "rewards"]},
+                "glitches": {name: counters.get("glitches " + name) for name in counters.inputNames},
+                "backlog": {ring.name: ring.depth() for key, ring in ringDict.items()},
+                "bytesWritten": counters.get("bytesWritten"),
+                "processes": {}}
+    snapshot["backlog"]["records at risk"] = counters.get("atRisk")
+    for name in counters.PROCESSES:
+        pid = counters.get(name + " pid")
+        if not pid:
+            continue
+        usage = processUsage(pid)
+        snapshot["processes"][name] = {"pid": pid, "loops": counters.get(name + " loops"), "loopMs": counters.get(name + " loopUs")/1000,
+                                       "maxLoopMs": counters.get(name + " maxLoopUs")/1000,
+                                       "cpu": round(usage[0], 2) if usage else None, "rssMB": round(usage[1], 1) if usage else None}
+    return snapshot
+
+def telemetryProcess(cages, ringDict, clock):
+    #Serve the live counters as JSON on localhost - only reads shared state, so a slow or stuck client can never stall the rig
+    #A two-cage Pi serves {"cages": {cage number: counters}}, the shared input and log processes are reported with the first cage
+    global telemetryPort
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) #SDL catches SIGTERM in the forked copy of pygame - restore it so terminate() stops the server
+    os.nice(10) #Run behind the rig processes
+
+    class TelemetryHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if len(cages) == 1:
+                snapshot = telemetrySnapshot(cages[0]["telemetry"], ringDict, clock)
+            else:
+                snapshot = {"cages": {str(cage["cageNumber"]): telemetrySnapshot(cage["telemetry"], ringDict, clock) for cage in cages}}
+            data = json.dumps(snapshot).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args): #Keep requests out of the status display
+            pass
+
+    try:
+        server = http.server.HTTPServer(("127.0.0.1", telemetryPort), TelemetryHandler)
+    except OSError as e:
+        lxprint("WARNING: Telemetry endpoint could not start on port " + str(telemetryPort) + ": " + str(e))
+        return
+    server.serve_forever()
 
+def openDisplay():
+    global displayVsync
+    global displayIndex
     #Get the current reslution of the monitor
     displayObj = pygame.display.Info()
+    screenSize = (displayObj.current_w, displayObj.current_h)
+    displayArgs = {}
+    if displayIndex: #Open the window on another monitor - needs pygame 2
+        screenSize = pygame.display.get_desktop_sizes()[displayIndex]
+        displayArgs["display"] = displayIndex
     ###############################################################DEBUG - toggle fullscreen and mouse cursor
     if toggleDebug:
-        windowSurfaceObj = pygame.display.set_mode((displayObj.current_w, displayObj.current_h))
+        displayFlags = 0
     else:
-        windowSurfaceObj = pygame.display.set_mode((displayObj.current_w, displayObj.current_h), pygame.FULLSCREEN)
+        displayFlags = pygame.FULLSCREEN
+    windowSurfaceObj = None
+    if displayVsync:
+        try: #pygame only supports vsync on SCALED or OPENGL displays
+            windowSurfaceObj = pygame.display.set_mode(screenSize, displayFlags | pygame.SCALED, vsync=1, **displayArgs)
+        except (pygame.error, TypeError): #TypeError - pygame 1 has no vsync argument
+            lxprint("WARNING: Vsync is not available, image flips will not be locked to the monitor refresh")
+    if windowSurfaceObj is None:
+        windowSurfaceObj = pygame.display.set_mode(screenSize, displayFlags, **displayArgs)
+    if not toggleDebug:
         #Hide mouse cursor
         pygame.mouse.set_visible(False)
 
-    #Preload images to RAM
-    pictureDict = preloadImages((parameterDict["Control image set:"] + parameterDict["Reward image set:"]))
+    #Drop all pygame events except keypresses so the event queue never needs draining on the hot path
+    pygame.event.set_blocked(None)
+    pygame.event.set_allowed(pygame.KEYDOWN)
+    return windowSurfaceObj
+
+def preloadImages(windowSurfaceObj, array):
+    global imagePaths
+    subset = set(array) #Create list of all unique entries
+    pictures = {}
+    screenSize = windowSurfaceObj.get_size()
+    for i in subset:
+        #Convert to the display's pixel format once here, so blits during the experiment are plain copies
+        picture = pygame.image.load(imagePaths[i]).convert()
+        if picture.get_size() != screenSize:
+            #Nearest-neighbour scaling keeps the calibrated pixel intensities of the stimulus - smoothscale would blend stripe edges
+            picture = pygame.transform.scale(picture, screenSize)
+        pictures[i] = picture
+    return pictures
+
+def drawImage(windowSurfaceObj, picture):
+    #Put a preloaded image on screen - returns the blit and flip durations (ns)
+    blitStart = time.monotonic_ns()
+    windowSurfaceObj.blit(picture,(0,0))
+    flipStart = time.monotonic_ns()
+    pygame.display.flip() #With vsync on this returns once the frame has been scanned out
+    flipEnd = time.monotonic_ns()
+    return flipStart - blitStart, flipEnd - flipStart
+
+class CageImage:
+    #Image state of one cage - shows the control image, steps through the reward frames, and tells the cage's CageInput when the reward state starts and ends
+    #imageProcess runs it in its own process, reactorProcess runs it in the same loop as the cage's CageInput
+    #connLog - ring to the log process, fromDoor, toDoor, fromWheel and toWheel - rings from and to the cage's CageInput
+    def __init__(self, connLog, fromDoor, toDoor, fromWheel, toWheel, clock):
+        global syncDelay
+        global protocol
+        global schedule
+        global imageTable
+        self.connLog = connLog
+        self.fromDoor = fromDoor
+        self.toDoor = toDoor
+        self.fromWheel = fromWheel
+        self.toWheel = toWheel
+        self.clock = clock
+        self.contrastProtocol = protocol.contrast
+        self.rewardSet = protocol.rewardImages
+        self.imageSet = protocol.controlImages + protocol.rewardImages
+        self.syncDelay = syncDelay*1e9 #Times are converted to ns to match the experiment clock
+
+        #Step through the precomputed reward schedule - no random draws are made while the experiment runs
+        self.framePeriods = cycle(schedule.framePeriods)
+        self.rewardOrders = cycle(schedule.rewardOrders)
+        self.controlImages = cycle(schedule.controlImages)
+        self.rewardFramePeriod = next(self.framePeriods)*1e9
+        self.rewardOrder = protocol.rewardImages #Order of the reward images in the current reward
+        self.imageLookup = {name: i for i, (name, HASH) in enumerate(imageTable)} #Index of each image in the image table - image hashes are looked up by the log process
+
+        #Image state
+        self.rewardState = False
+        self.frameEnd = clock.nowNs() #Track when a reward frame times out
+        self.rewardIndex = 0 #Index of current reward frame
+        self.wheelWait = False #Specific for contrast protocol - state flag for when next reward image is waiting to be triggered by wheel event
+        self.pendingReward = 0 #Correlation ID of the reward event whose first image has not yet been shown
+        self.flushWheel = False #Specific for contrast protocol - wheel flags sent during the reward are still arriving, and are cleared at the "flush" deadline
+        self.deadlines = [] #Heap of (time (ns), kind) of frame and flush deadlines - stale deadlines only cause a harmless extra wake-up
+
+        self.eventLatency = LatencyHistogram() #How long control records wait before they are handled
+        self.blitTime = LatencyHistogram() #Time to copy each image to the display surface
+        self.flipTime = LatencyHistogram() #Time to push each image to the monitor
+        self.windowSurfaceObj = None
+        self.pictureDict = None
+
+    def start(self):
+        #Open the display and preload the images to RAM - the first control image is shown by changeToControl
+        self.connLog.send((EVENT_START, CHANNEL_IMAGE, 0, self.clock.nowNs(), 0, 0))
+        self.windowSurfaceObj = openDisplay()
+        self.pictureDict = preloadImages(self.windowSurfaceObj, self.imageSet)
+
+    def addDeadline(self, deadline, kind):
+        heapq.heappush(self.deadlines, (deadline, kind))
+
+    def deadline(self):
+        #Earliest time the image state needs the loop to wake without a record (ns) - None if it is only waiting for records
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def waitList(self):
+        #Only the rings the current state reads, so a record that is deliberately left unread cannot cause a busy loop
+        if not self.rewardState:
+            return [] if self.flushWheel else [self.fromWheel]
+        elif self.contrastProtocol:
+            return [self.fromDoor, self.fromWheel]
+        return [self.fromDoor]
+
+    def clearPipe(self, ring):
+        #Read all waiting control records and return the last one
+        last = None
+        for record in ring.drain():
+            last = record
+            self.eventLatency.add(self.clock.nowNs() - record[3]) #Time from the control record being sent to it being handled
+        return last
+
+    def sendControl(self, ring, value, rewardId=0):
+        ring.send((EVENT_CONTROL, CHANNEL_IMAGE, value, self.clock.nowNs(), rewardId, 0))
+
+    def sendHop(self, hop, rewardId):
+        #Timestamp a hop of a reward event for the end-to-end latency report
+        self.connLog.send((EVENT_HOP, CHANNEL_IMAGE, hop, self.clock.nowNs(), rewardId, 0))
+
+    def displayImage(self, i):
+        blitNs, flipNs = drawImage(self.windowSurfaceObj, self.pictureDict[i])
+        self.connLog.send((EVENT_IMAGE, CHANNEL_IMAGE, self.imageLookup[i], self.clock.nowNs(), round(self.rewardFramePeriod), 0))
+        if self.pendingReward: #First image of a reward event is now on screen
+            self.sendHop(HOP_IMAGE_SHOWN, self.pendingReward)
+            self.pendingReward = 0
+        self.blitTime.add(blitNs)
+        self.flipTime.add(flipNs)
+        self.connLog.send((EVENT_FRAME, CHANNEL_IMAGE, self.imageLookup[i], self.clock.nowNs(), blitNs, flipNs))
+
+    def changeToControl(self):
+        self.pendingReward = 0 #Reward ended before its image was shown
+        self.sendControl(self.toWheel, 1) #Tell wheel process that reward state ended
+        self.displayImage(next(self.controlImages)) #Switch to the next control image in the schedule - a reward image if no control images are available
+        self.rewardState = False
+        self.rewardIndex = 0 #Reset the reward frame index
+        self.wheelWait = False #Reset wheel wait flag
+
+    def update(self, currentTime):
+        #Handle the records from the cage's CageInput and step through the reward frames
+        while self.deadlines and self.deadlines[0][0] <= currentTime:
+            deadline, kind = heapq.heappop(self.deadlines)
+            if kind == "flush":
+                dummy = self.clearPipe(self.fromWheel) #Clear all remaining wheel flags
+                self.flushWheel = False
+
+        if self.rewardState: #If in reward state monitor door for trigger to control state
+            if self.fromDoor.poll(): #Check if door state has changed
+                dummy = self.clearPipe(self.fromDoor)
+                self.changeToControl()
+                if self.contrastProtocol: #Give the wheel flags sent before the input process sees the end of the reward one sync cycle to arrive, then clear them
+                    self.flushWheel = True
+                    self.addDeadline(currentTime + self.syncDelay, "flush")
+            else:
+                #If in contrast mode, wait until current frame times out, then index to next contrast frame
+                if self.contrastProtocol:
+                    if (self.frameEnd <= currentTime and self.rewardIndex < len(self.rewardSet)): #If frame has timed out, check for next wheel event
+                        if self.wheelWait:
+                            if self.fromWheel.poll():
+                                self.wheelWait = self.clearPipe(self.fromWheel)[2]
+                                if not self.wheelWait:
+                                    self.addDeadline(currentTime, "frame") #Show the next contrast step now
+                        else:
+                            if self.rewardIndex == 0: #If this is the first reward image, take the next shuffled reward image sequence from the schedule
+                                self.rewardOrder = next(self.rewardOrders)
+                            self.displayImage(self.rewardOrder[self.rewardIndex%len(self.rewardOrder)]) #Show next image in reward sequence
+                            self.rewardIndex += 1 #Increment reward index
+                            self.rewardFramePeriod = next(self.framePeriods)*1e9
+                            self.frameEnd = currentTime + self.rewardFramePeriod #Reset frame timer
+                            self.addDeadline(self.frameEnd, "frame")
+                            self.sendControl(self.toDoor, 1) #Reset the reward timeout timer
+                            self.wheelWait = True #Reset flag to wait for wheel event to index next frame
 
-    #initialize varible for tracking image list index
-    imageIndex = 0
+                    else: #If not yet waiting for a wheel event, keep the wheelPipe buffer clear
+                        dummy = self.clearPipe(self.fromWheel)
+                else:
+                    if self.frameEnd <= currentTime: #If frame has expired move to next reward frame
+                        self.displayImage(self.rewardSet[self.rewardIndex%len(self.rewardSet)]) #Show next image in reward sequence
+                        self.rewardIndex += 1 #Increment reward index
+                        self.frameEnd = currentTime + self.rewardFramePeriod #Reset frame timer
+                        self.addDeadline(self.frameEnd, "frame")
 
-    #Record experiemnt end time
-    expEnd = time.time()
+        else: #If in control state, monitor wheel
+            self.frameEnd = currentTime
+            if not self.flushWheel and self.fromWheel.poll(): #Check if wheel state has changed
+                record = self.clearPipe(self.fromWheel)
+                self.pendingReward = record[4] #Correlation ID of the reward event - follows it to the door process and the reward image
+                self.sendHop(HOP_IMAGE_RECEIVED, self.pendingReward)
+                self.sendControl(self.toDoor, 1, self.pendingReward) #Tell door process that wheel has triggered a reward event
+                self.rewardState = True
+                self.addDeadline(currentTime, "frame") #Show the first reward frame on the next cycle
+
+    def summaries(self):
+        #How quickly control records were handled, and how long each image took to reach the monitor
+        return [self.eventLatency.summary("Image loop event wake-up latency"), self.blitTime.summary("Image blit duration"), self.flipTime.summary("Image flip duration")]
+
+def imageProcess(connLog, stopQueue, fromDoor, toDoor, fromWheel, toWheel, clock):
+    global cageNumber
+    global keyPollInterval
+    global protocol
+    global telemetry
+
+    cpuStart = os.times()
+    image = CageImage(connLog, fromDoor, toDoor, fromWheel, toWheel, clock)
+
+    def addDeadline(deadline, kind):
+        #Schedule the loop to wake at the deadline (ns) - stale deadlines only cause a harmless extra wake-up
+        heapq.heappush(deadlines, (deadline, kind))
+
+    def checkKeys():
+        nonlocal run
+        #Only keypress events are let into the pygame queue, so this is cheap enough to run on a timer instead of every loop
+        for event in pygame.event.get(pygame.KEYDOWN):
+            lxprint("Key press")
+            run = False
+        if not clock.virtual: #A dry run is headless - polling keys every keyPollInterval of virtual time would only slow it down
+            addDeadline(currentTime + keyPollInterval*1e9, "keys")
 
-    #Initialize state variabes
-    wheelState = 0
-    rewardState = False
+    telemetry.start("Image")
 
-    #Calculate experiment end time:
-    currentTime = time.time()
-    expEnd = 60*60*parameterDict["Total duration of the experiment (hours):"] + currentTime
-    frameEnd = currentTime #Track when a reward frame times out
-    rewardIndex = 0 #Index of current reward frame
-    wheelWait = False #Specific for contrast protocol - state flag for when next reward image is waiting to be triggered by wheel event
+    #Exit program on any key press
+    run = True
 
-    changeToControl() #Initialize to a control image
+    image.start()
 
-    while run and expEnd > currentTime:
-        time.sleep(syncDelay)
+    #Calculate experiment end time:
+    currentTime = clock.nowNs()
+    expEnd = currentTime + 60*60*protocol.experimentHours*1e9
 
-        #Record time for current cycle
-        currentTime = time.time()
-
-        #Poll for state changes
-        if rewardState: #If in reward state monitor door for trigger to control state
-            if doorPipe.poll(): #Check if door state has changed
-                dummy = clearPipe(doorPipe)
-                rewardState = changeToControl()
-                if(contrastProtocol):
-                    time.sleep(syncDelay)
-                    dummy = clearPipe(wheelPipe) #Clear all remaining wheel flags
-            else:
-                #If in contrast mode, wait until current frame times out, then index to next contrast frame
-                if contrastProtocol:
-                    if (frameEnd < currentTime and rewardIndex < len(parameterDict["Reward image set:"])): #If frame has timed out, check for next wheel event
-                        if wheelWait:
-                            if wheelPipe.poll():
-                                wheelWait = clearPipe(wheelPipe)
-                        else:
-                            if rewardIndex == 0: #If this is the first reward image, randomly shuffle the reward image sequence
-                                random.shuffle(parameterDict["Reward image set:"])
-                            displayImage(parameterDict["Reward image set:"][rewardIndex%len(parameterDict["Reward image set:"])]) #Show next image in reward sequence
-                            rewardIndex += 1 #Increment reward index
-                            rewardFramePeriod = random.uniform(minContrastTime, maxContrastTime)
-                            frameEnd = currentTime + rewardFramePeriod #Reset frame timer
-                            doorPipe.send(1) #Reset the reward timeout timer
-                            wheelWait = True #Reset flag to wait for wheel event to index next frame
+    #Heap of (time (ns), kind) deadlines of the loop - the loop sleeps until the earliest deadline of the loop or the image state, or until a ring has data
+    deadlines = []
+    addDeadline(expEnd, "end")
+    timerLatency = LatencyHistogram() #How late the loop wakes for a deadline
 
-                    else: #If not yet waiting for a wheel event, keep the wheelPipe buffer clear
-                        dummy = clearPipe(wheelPipe)
-                else:
-                    if frameEnd <= currentTime: #If frame has expired move to next reward frame
-                        displayImage(parameterDict["Reward image set:"][rewardIndex%len(parameterDict["Reward image set:"])]) #Show next image in reward sequence
-                        rewardIndex += 1 #Increment reward index
-                        frameEnd = currentTime + rewardFramePeriod #Reset frame timer
+    image.changeToControl() #Initialize to a control image
+    checkKeys()
 
-        else: #If in control state, monitor wheel
-            frameEnd = currentTime
-            if wheelPipe.poll(): #Check if wheel state has changed
-                wheelState = wheelPipe.recv()
-                doorPipe.send(1) #Tell door process that wheel has triggered a reward event
-                rewardState = True
-            else:
-                wheelState = False
+    while run:
+        waitList = image.waitList()
+        deadline = deadlines[0][0]
+        imageDeadline = image.deadline()
+        if imageDeadline is not None and imageDeadline < deadline:
+            deadline = imageDeadline
+        timeout = max(0, (deadline - clock.nowNs())/1e9)
+        if any(r.poll() for r in waitList): #Records already waiting - their doorbell may have been cleared
+            timeout = 0
+        if clock.virtual and timeout > 0: #Dry run - time jumps to the earliest deadline of all rig processes once they are all waiting
+            ready = clock.wait("Image " + str(cageNumber), waitList, deadline)
+        else:
+            ready = wait(waitList, timeout=timeout)
+        for r in ready:
+            r.clearDoorbell()
 
-        #Check for keypress event if available
-        for event in pygame.event.get():
-            if event.type == pygame.KEYDOWN:
-                lxprint("Key press")
+        #Record time for current cycle
+        currentTime = clock.nowNs()
+        loopStart = time.monotonic_ns()
+        if not ready and deadline <= currentTime: #Loop was woken by the deadline
+            timerLatency.add(currentTime - deadline)
+
+        #Handle expired deadlines
+        while deadlines and deadlines[0][0] <= currentTime:
+            deadline, kind = heapq.heappop(deadlines)
+            if kind == "keys":
+                checkKeys()
+            elif kind == "end":
                 run = False
 
-        #If keypress, exit run loop
+        #If keypress or end of experiment, exit run loop
         if not run:
             break
 
+        image.update(currentTime)
+
+        telemetry.set("rewardState", image.rewardState)
+        telemetry.loop("Image", time.monotonic_ns() - loopStart)
+
+    #Report how quickly the loop responded to deadlines and control records, and how long each image took to reach the monitor
+    for summary in [timerLatency.summary("Image loop timer wake-up latency")] + image.summaries() + [cpuSummary("Image", cpuStart)]:
+        lxprint(summary)
+        connLog.send((EVENT_TEXT, CHANNEL_IMAGE, 0, clock.nowNs(), 0, 0, summary))
+
     #Flag other processes to stop
     stopQueue.value = 1
+    if clock.virtual: #Wake the input process to see the flag
+        clock.finish("Image " + str(cageNumber))
     lxprint("Image stop at: " + str(datetime.now()))
 
-def logProcess(connGPIO, connWheel, connImage, stopQueue):
+class EventRing:
+    #Single-producer/single-consumer ring buffer of fixed-size event records in shared memory
+    #The producer never blocks - if the ring is full the record is dropped and counted as an overflow
+    #Every record sent also writes a byte to a non-blocking "doorbell" pipe, so the consumer can sleep on it with multiprocessing.connection.wait
+    #Counters are 32-bit so that each one is written atomically on the Pi's 32-bit processor
+    HEAD = 0 #Counter index - number of slots written by the producer
+    TAIL = 1 #Counter index - number of slots read by the consumer
+    OVERFLOWS = 2 #Counter index - number of records dropped because the ring was full
+    HIGH_WATER = 3 #Counter index - largest number of slots waiting at once
+    COUNTER_BYTES = 32 #Space reserved for the counters at the start of the shared memory block
+
+    def __init__(self, name, slots):
+        self.name = name #Name of the ring used in the log summary
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(create=True, size=self.COUNTER_BYTES + slots*RECORD_SIZE)
+        self.shm.buf[:self.COUNTER_BYTES] = bytes(self.COUNTER_BYTES)
+        self.counters = self.shm.buf[:16].cast("I") #head, tail, overflows, high water mark
+        self.data = self.shm.buf[self.COUNTER_BYTES:]
+        self.readFd, self.writeFd = os.pipe() #Doorbell - shared with the producer and consumer on fork
+        os.set_blocking(self.readFd, False)
+        os.set_blocking(self.writeFd, False)
+
+    def fileno(self):
+        #Allows multiprocessing.connection.wait to block until records are available
+        return self.readFd
+
+    def depth(self):
+        #Number of slots waiting to be read
+        return (self.counters[self.HEAD] - self.counters[self.TAIL]) & 0xFFFFFFFF
+
+    def highWater(self):
+        return self.counters[self.HIGH_WATER]
+
+    def overflows(self):
+        return self.counters[self.OVERFLOWS]
+
+    def send(self, record):
+        #Producer only - add a record to the ring, returns False if the ring was full and the record was dropped
+        data = packRecord(record)
+        nSlots = len(data)//RECORD_SIZE
+        head = self.counters[self.HEAD]
+        depth = self.depth() + nSlots
+        if depth > self.slots:
+            self.counters[self.OVERFLOWS] += 1
+            return False
+        for i in range(nSlots):
+            slot = ((head + i) % self.slots)*RECORD_SIZE
+            self.data[slot:slot+RECORD_SIZE] = data[i*RECORD_SIZE:(i+1)*RECORD_SIZE]
+        self.counters[self.HEAD] = (head + nSlots) & 0xFFFFFFFF #Publish the record only once it is fully written
+        if depth > self.counters[self.HIGH_WATER]:
+            self.counters[self.HIGH_WATER] = depth
+        try:
+            os.write(self.writeFd, b"\0") #Ring doorbell
+        except BlockingIOError: #Doorbell pipe is full, so the consumer already has a wake-up waiting
+            pass
+        return True
+
+    def poll(self):
+        #Consumer only - whether a record is waiting
+        return self.depth() > 0
+
+    def recv(self):
+        #Consumer only - read the oldest record, or None if the ring is empty
+        tail = self.counters[self.TAIL]
+        if tail == self.counters[self.HEAD]:
+            return None
+        slot = (tail % self.slots)*RECORD_SIZE
+        record = RECORD.unpack_from(self.data, slot)
+        nSlots = 1
+        if record[0] == EVENT_TEXT: #Reassemble text from the continuation slots
+            nSlots += -(-record[2]//TEXT_BYTES)
+            text = b""
+            for i in range(1, nSlots):
+                slot = ((tail + i) % self.slots)*RECORD_SIZE
+                text += TEXT_DATA.unpack_from(self.data, slot)[1]
+            record = record + (text[:record[2]].decode("utf-8", "surrogateescape"),)
+        self.counters[self.TAIL] = (tail + nSlots) & 0xFFFFFFFF #Free the slots for the producer
+        return record
+
+    def clearDoorbell(self):
+        #Consumer only - empty the doorbell pipe so multiprocessing.connection.wait blocks until the next record is sent
+        try:
+            while os.read(self.readFd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def drain(self):
+        #Consumer only - clear the doorbell and read all waiting records
+        self.clearDoorbell()
+        records = []
+        while self.poll():
+            records.append(self.recv())
+        return records
+
+    def summary(self):
+        return "Ring - Name: " + self.name + ", Depth: " + str(self.depth()) + ", High water: " + str(self.highWater()) + " of " + str(self.slots) + ", Overflows: " + str(self.overflows())
+
+    def close(self):
+        #Release the shared memory - called by the process that created the ring once all other processes have stopped
+        self.counters.release()
+        self.data.release()
+        self.shm.close()
+        self.shm.unlink()
+        os.close(self.readFd)
+        os.close(self.writeFd)
+
+class LocalRing:
+    #In-process stand-in for an EventRing, used by the reactor runtime to connect a cage's CageInput and CageImage inside one loop
+    #Records are handed over in order without shared memory or a doorbell - the loop checks poll() instead of sleeping on the ring
+    def __init__(self, name):
+        self.name = name
+        self.records = deque()
+
+    def send(self, record):
+        self.records.append(record)
+        return True
+
+    def poll(self):
+        return len(self.records) > 0
+
+    def drain(self):
+        records = list(self.records)
+        self.records.clear()
+        return records
+
+class ResultsWriter:
+    #Keeps the results file open and writes records in batches instead of re-opening the file for every record
+    #Records are flushed and synced to the USB drive once flushInterval seconds have passed since the oldest waiting record,
+    #or once flushCount records are waiting - whichever comes first.  Records waiting in RAM are "at risk" of being lost on power failure.
+    #If binaryPath is given, every record is also written to a binary event log on the same flush schedule.
+    def __init__(self, path, flushInterval, flushCount, binaryPath=None):
+        self.file = open(path, "a")
+        with open(path, "rb") as f: #Keep a copy of the header so it can be stored in the binary log
+            self.header = makeHeader(f.read().decode("utf-8", "surrogateescape"), imageTable, channelNames())
+        self.binary = None #Binary event log writer
+        if binaryPath:
+            self.binary = BinaryEventWriter(binaryPath, self.header)
+        self.flushInterval = flushInterval #Maximum time a record is held in RAM (s)
+        self.flushCount = flushCount #Maximum number of records held in RAM
+        self.buffer = [] #Records waiting to be written
+        self.bufferStart = 0 #Time the oldest waiting record was received (s)
+        self.nRecords = 0 #Total number of records written
+        self.nFlushes = 0 #Total number of flush and sync cycles
+        self.maxAtRisk = 0 #Largest number of records held in RAM at once
+        self.bytesWritten = 0 #Total number of bytes written to the results file and binary log
+
+    def atRisk(self):
+        #Number of records that would be lost if the rig lost power now
+        return len(self.buffer)
+
+    def write(self, record):
+        line = formatRecord(record, self.header)
+        if line is None: #Record is not logged
+            return
+        if self.binary:
+            self.binary.write(record)
+        if not self.buffer:
+            self.bufferStart = time.monotonic()
+        self.buffer.append(line + "\r\n")
+        self.nRecords += 1
+        if len(self.buffer) > self.maxAtRisk:
+            self.maxAtRisk = len(self.buffer)
+        if len(self.buffer) >= self.flushCount:
+            self.flush()
+
+    def timeout(self):
+        #Time remaining until waiting records must be flushed (s) - None if no records are waiting
+        if not self.buffer:
+            return None
+        return max(0, self.bufferStart + self.flushInterval - time.monotonic())
+
+    def poll(self):
+        #Flush waiting records if the flush window has expired
+        if self.buffer and self.timeout() == 0:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            data = "".join(self.buffer)
+            self.buffer = []
+            self.file.write(data)
+            self.file.flush() #Push data from Python to the OS
+            os.fsync(self.file.fileno()) #Push data from the OS to the USB drive
+            if self.binary:
+                self.bytesWritten += sum(len(b) for b in self.binary.buffer)
+                self.binary.flush()
+                os.fsync(self.binary.fileno())
+            self.nFlushes += 1
+            self.bytesWritten += len(data.encode())
+
+    def summary(self):
+        return ("Log writer - Records: " + str(self.nRecords) + ", Flushes: " + str(self.nFlushes) + ", Max records at risk: " + str(self.maxAtRisk) +
+                ", Flush window: " + "{:.3f}".format(self.flushInterval) + " s or " + str(self.flushCount) + " records")
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        if self.binary:
+            self.binary.close()
+
+def openResultsWriter():
     global mountDir
     global resultsFile
-    global syncDelay
-    connArray = []
-    connArray.append(connGPIO)
-    connArray.append(connWheel)
-    connArray.append(connImage)
+    global logFlushInterval
+    global logFlushCount
+    global binaryLog
 ##########################Debug tail - shows results file in real time
     if toggleDebug:
         terminal = subprocess.Popen(["lxterminal -e tail --follow \"" + (mountDir + resultsFile) + "\""], shell=True, stdout=devnull, stderr=devnull)
 
-    run = True
-    while run:
-        time.sleep(syncDelay)
-        #If a data entry is available in the queue, process it
-        #multiprocessing.connection.wait
-        for r in wait(connArray, timeout=0.1):
-            with open(mountDir + resultsFile, "a") as f: #Use with in loop so that data is continuously saved to drive preventing data loss in the event of a device failure
-                try:
-                    data = r.recv()
-                except EOFError:
-                    lxprint("Error reading from pipe: " + str(r))
-                    f.write("Error reading from pipe: " + str(r) + "\r\n")
+    binaryFile = None
+    if binaryLog:
+        binaryFile = mountDir + re.sub(r"\.txt$", ".bin", resultsFile)
+    return ResultsWriter(mountDir + resultsFile, logFlushInterval, logFlushCount, binaryFile)
+
+def logProcess(links, clock):
+    #Writes the results file of every cage run by this Pi, so a second cage costs no extra log process
+    #links - one dict per cage with its settings ("cage") and its rings ("rings"), as built by runExperiment
+    global anchorInterval
+    global telemetry
+    cpuStart = os.times()
+    writers = [] #Results writer of each cage
+    terminate = [None]*len(links) #End of experiment record of each cage - written last
+    rewardLatency = [RewardLatency() for link in links] #End-to-end latency of each reward event in each cage
+    owner = {} #Index of the cage each ring to the log process belongs to
+    for i, link in enumerate(links):
+        for key in ["input_to_log", "image_to_log"]:
+            owner[link["rings"][key]] = i
+    connArray = list(owner)
+
+    def cagePrint(i, line):
+        #Status display - lines are labelled with their cage when the Pi runs more than one
+        lxprint(("Cage " + str(links[i]["cage"]["cageNumber"]) + " " if len(links) > 1 else "") + line)
+
+    def writeAnchor():
+        expTime, wallTime = clock.anchor()
+        for i, writer in enumerate(writers):
+            writer.write((EVENT_ANCHOR, CHANNEL_LOG, 0, expTime, wallTime, 0))
+            links[i]["cage"]["telemetry"].countEvent(CHANNEL_LOG)
+        return expTime + anchorInterval*1e9
+
+    def readPipes(timeout):
+        #multiprocessing.connection.wait - block until a ring has data or the timeout expires, then read everything available
+        for r in wait(connArray, timeout=timeout):
+            i = owner[r]
+            for record in r.drain():
+                if record[0] == EVENT_TERMINATE:
+                    terminate[i] = record
+                elif record[0] == EVENT_HOP:
+                    line = rewardLatency[i].add(record)
+                    if line:
+                        writers[i].write((EVENT_TEXT, CHANNEL_LOG, 0, record[3], 0, 0, line))
                 else:
-                    f.write(str(data) + "\r\n")
+                    writers[i].write(record)
+                    links[i]["cage"]["telemetry"].countEvent(record[1])
 
-        #Stop process on stop command from GUI process
-        if stopQueue.value == 1:
-            run = False
+    try:
+        for link in links: #The header of each results file is built from its cage's settings
+            selectCage(link["cage"])
+            writers.append(openResultsWriter())
+        selectCage(links[0]["cage"]) #The log process reports its own telemetry with the first cage
+        telemetry.start("Log")
+        nextAnchor = writeAnchor() #Time of next wall-clock anchor
+        run = True
+        while run:
+            #Wake when data arrives, or in time to flush waiting records
+            timeout = 0.1
+            for writer in writers:
+                if writer.timeout() is not None and writer.timeout() < timeout:
+                    timeout = writer.timeout()
+            readPipes(timeout)
+            loopStart = time.monotonic_ns()
+            for i, writer in enumerate(writers):
+                writer.poll()
+                links[i]["cage"]["telemetry"].set("bytesWritten", writer.bytesWritten)
+                links[i]["cage"]["telemetry"].set("atRisk", writer.atRisk())
+
+            #Periodically record the wall-clock time so analysis can map experiment time to real time
+            if clock.nowNs() >= nextAnchor:
+                nextAnchor = writeAnchor()
+
+            #Stop process once the end of experiment record of every cage arrives - it is sent after all other processes have stopped
+            if all(terminate):
+                run = False
+            telemetry.loop("Log", time.monotonic_ns() - loopStart)
+
+        #Perform last check of pipes to make sure all data has been gathered
+        readPipes(0)
+        writeAnchor()
+        for i, writer in enumerate(writers):
+            for key, ring in links[i]["rings"].items(): #Report how close each ring came to overflowing
+                if ring.overflows():
+                    lxprint("ERROR: " + ring.summary())
+                writer.write((EVENT_TEXT, CHANNEL_LOG, 0, clock.nowNs(), 0, 0, ring.summary()))
+            for line in rewardLatency[i].summary(): #Reward latency histogram - used to check that rigs, and the two cages of a Pi, are equivalent
+                cagePrint(i, line)
+                writer.write((EVENT_TEXT, CHANNEL_LOG, 0, clock.nowNs(), 0, 0, line))
+            writer.write((EVENT_TEXT, CHANNEL_LOG, 0, clock.nowNs(), 0, 0, cpuSummary("Log", cpuStart)))
+            cagePrint(i, writer.summary())
+            writer.write((EVENT_TEXT, CHANNEL_LOG, 0, clock.nowNs(), 0, 0, writer.summary()))
+            writer.write(terminate[i])
 
-    #Perform last check of pipes to make sure all data has been gathered
-    for r in wait(connArray, timeout=1):
-        with open(mountDir + resultsFile, "a") as f:
-            try:
-                data = r.recv()
-            except EOFError:
-                print ("Error reading from pipe: " + str(r))
-                f.write("Error reading from pipe: " + str(r) + "\r\n")
-            else:
-                f.write(str(data) + "\r\n")
+    finally:
+        for writer in writers:
+            writer.close()
 
     lxprint("Log stop at: " + str(datetime.now()))
 
-def GPIOprocess(pin, connLog, stopQueue, imagePipe, expStart):
-    global pinDoor
-    global pinWheel
-    global pinPump
+class PumpPulse:
+    #Scheduled pump pulse - the pump is switched off at the requested time by a timer thread, instead of whenever the loop next notices the reward has ended
+    #The timer thread only switches the pin and timestamps it - the owning loop logs the pulse, so each ring keeps a single producer
+    #With threaded=False no timer is started, and the owning event loop calls stop() from a deadline instead
+    def __init__(self, pin, clock, threaded=True):
+        self.pin = pin
+        self.clock = clock
+        self.threaded = threaded
+        self.lock = threading.Lock() #The timer thread and the loop may both try to switch the pump off
+        self.timer = None
+        self.onNs = None #Time the pump was switched on (ns)
+        self.offNs = None #Time the pump was switched off (ns)
+        self.requestedNs = 0 #Requested on-time (ns)
+        self.reported = True #Whether the last pulse has been returned by finished()
+        self.overrun = LatencyHistogram() #Measured minus requested on-time of each pulse
+        self.cutShort = 0 #Number of pulses stopped before the requested on-time, such as by the end of the experiment
+
+    def start(self, durationNs):
+        #Switch the pump on for durationNs - returns the time the pump was switched on (ns)
+        with self.lock:
+            GPIO.output(self.pin, GPIO.HIGH)
+            self.onNs = self.clock.nowNs()
+            self.offNs = None
+            self.requestedNs = int(durationNs)
+            self.reported = False
+        if self.threaded:
+            self.timer = threading.Timer(durationNs/1e9, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+        return self.onNs
+
+    def endNs(self):
+        #Time the running pulse is due to end (ns), or None if the pump is off
+        with self.lock:
+            if self.onNs is not None and self.offNs is None:
+                return self.onNs + self.requestedNs
+            return None
+
+    def stop(self):
+        #Switch the pump off now if the pulse is still running
+        with self.lock:
+            if self.onNs is not None and self.offNs is None:
+                GPIO.output(self.pin, GPIO.LOW)
+                self.offNs = self.clock.nowNs()
+        if self.timer and self.timer is not threading.current_thread():
+            self.timer.cancel()
+
+    def finished(self):
+        #Returns (on time, off time, requested on-time) (ns) once for each pulse that has ended, otherwise None
+        with self.lock:
+            if self.reported or self.offNs is None:
+                return None
+            self.reported = True
+            if self.offNs - self.onNs >= self.requestedNs:
+                self.overrun.add(self.offNs - self.onNs - self.requestedNs)
+            else:
+                self.cutShort += 1
+            return self.onNs, self.offNs, self.requestedNs
+
+    def summary(self):
+        return self.overrun.summary("Pump pulse overrun") + ", Cut short: " + str(self.cutShort)
+
+class DebounceFilter:
+    #Non-blocking debounce of one input channel by edge timestamps - replaces sleeping for the bounce time after every edge
+    #An edge is accepted if at least bounce has passed since the last accepted edge, otherwise it is rejected and counted as a glitch.
+    #If the pin settles at a new level inside the bounce window, that level is accepted once the window ends, with the time the pin reached it.
+    def __init__(self, name, bounceNs, level):
+        self.name = name #Name of the channel in the summary
+        self.bounceNs = bounceNs #Bounce window (ns)
+        self.level = level #Last accepted level
+        self.lastNs = None #Time of the last accepted edge (ns)
+        self.rawLevel = level #Last level seen on the pin, accepted or not
+        self.rawNs = 0 #Time the pin reached rawLevel (ns)
+        self.accepted = 0
+        self.glitches = 0 #Number of edges rejected inside a bounce window
+
+    def accept(self, level, timeNs):
+        self.level = level
+        self.lastNs = timeNs
+        self.accepted += 1
+        return [(level, timeNs)]
+
+    def pending(self):
+        #End of the bounce window (ns) if the pin is waiting to settle at a new level, otherwise None
+        if self.rawLevel != self.level:
+            return self.lastNs + self.bounceNs
+        return None
+
+    def settle(self, nowNs):
+        #Accept the level the pin settled at inside the last bounce window once the window has ended - returns the list of accepted (level, time) edges
+        end = self.pending()
+        if end is not None and nowNs >= end:
+            self.glitches -= 1 #The last rejected edge turned out to be a real change of level
+            return self.accept(self.rawLevel, self.rawNs)
+        return []
+
+    def edge(self, level, timeNs):
+        #Filter a raw edge - returns the list of accepted (level, time) edges
+        edgeList = self.settle(timeNs)
+        self.rawLevel = level
+        self.rawNs = timeNs
+        if level != self.level and (self.lastNs is None or timeNs - self.lastNs >= self.bounceNs):
+            return edgeList + self.accept(level, timeNs)
+        self.glitches += 1
+        return edgeList
+
+    def summary(self):
+        return (self.name + " debounce - Bounce: " + "{:.3f}".format(self.bounceNs/1e6) + " ms, Accepted edges: " + str(self.accepted) +
+                ", Rejected glitches: " + str(self.glitches))
+
+class QuadratureDecoder:
+    #Decodes the two channels of a quadrature wheel encoder into a position, and aggregates the counts into fixed-interval bins
+    #Each full forward revolution is reported so the reward logic can keep counting revolutions as with a one pulse per revolution wheel
+    STEP = {(0, 1): 1, (1, 3): 1, (3, 2): 1, (2, 0): 1, (1, 0): -1, (3, 1): -1, (2, 3): -1, (0, 2): -1} #Count for each (A << 1 | B) transition
+
+    def __init__(self, countsPerRev, binNs, levelA, levelB):
+        self.countsPerRev = countsPerRev
+        self.binNs = int(binNs) #Width of each bin (ns)
+        self.state = levelA << 1 | levelB #Current level of both channels
+        self.position = 0 #Net counts since the start
+        self.revPosition = 0 #Position of the last whole revolution
+        self.bin = None #Index of the bin being filled
+        self.forward = 0 #Forward counts in the current bin
+        self.backward = 0 #Backward counts in the current bin
+        self.peakSpeed = 0 #Fastest speed in the current bin (revolutions/s)
+        self.countTimes = deque(maxlen=5) #Times of the last 5 counts (ns) - speed is measured over a whole quadrature cycle of 4 counts
+        self.errors = 0 #Transitions that skipped a state, so the direction is unknown - both channels changed between two edges
+        self.revolutions = 0 #Forward revolutions completed
+
+    def edge(self, phase, level, timeNs):
+        #Decode an edge on channel "A" or "B" - returns the list of completed bins, and the list of times forward revolutions were completed
+        completed = self.bins(timeNs)
+        newState = (level << 1 | (self.state & 1)) if phase == "A" else ((self.state & 2) | level)
+        step = self.STEP.get((self.state, newState), 0)
+        if step == 0 and newState != self.state:
+            self.errors += 1
+        self.state = newState
+        if step == 0:
+            return completed, []
+        if self.bin is None:
+            self.bin = timeNs//self.binNs
+        if step > 0:
+            self.forward += 1
+        else:
+            self.backward += 1
+        self.position += step
+        self.countTimes.append(timeNs)
+        if len(self.countTimes) == 5 and timeNs > self.countTimes[0]:
+            speed = 4/self.countsPerRev/((timeNs - self.countTimes[0])/1e9)
+            if speed > self.peakSpeed:
+                self.peakSpeed = speed
+        revolutionTimes = []
+        if self.position >= self.revPosition + self.countsPerRev:
+            self.revPosition += self.countsPerRev
+            self.revolutions += 1
+            revolutionTimes.append(timeNs)
+        elif self.position <= self.revPosition - self.countsPerRev: #Backward revolutions move the mark back but are not counted
+            self.revPosition -= self.countsPerRev
+        return completed, revolutionTimes
+
+    def binEnd(self):
+        #End time (ns) of the bin being filled, or None if there is no count waiting to be logged
+        return None if self.bin is None else (self.bin + 1)*self.binNs
+
+    def bins(self, nowNs):
+        #Returns the completed bin as a list of (start time (ns), forward, backward, peak speed (rev/s)) once nowNs has passed its end
+        if self.bin is None or nowNs < (self.bin + 1)*self.binNs:
+            return []
+        completed = [(self.bin*self.binNs, self.forward, self.backward, self.peakSpeed)]
+        self.bin = None
+        self.forward = 0
+        self.backward = 0
+        self.peakSpeed = 0
+        self.countTimes.clear() #Do not measure speed across an idle gap
+        return completed
+
+    def summary(self):
+        return ("Wheel encoder - Position: " + str(self.position) + " counts, Revolutions: " + str(self.revolutions) + ", Counts per revolution: " +
+                str(self.countsPerRev) + ", Skipped states: " + str(self.errors))
+
+class PollCapture:
+    #Legacy edge capture - sample the pin once per loop cycle and report any change in level as an edge
+    def __init__(self, pin, bounce, clock, name):
+        self.pin = pin
+        self.clock = clock
+        self.level = GPIO.input(pin) #Last sampled pin level
+        self.debounce = DebounceFilter(name, bounce*1e9, self.level)
+
+    def edges(self):
+        newState = GPIO.input(self.pin)
+        sampleTime = self.clock.nowNs() #Edge is only seen at the sample, so it is timestamped here
+        if newState ^ self.level:
+            self.level = newState
+            return self.debounce.edge(newState, sampleTime)
+        return self.debounce.settle(sampleTime)
+
+class EdgeDoorbell:
+    #Wakes the input process when an edge is captured - the capture callbacks write a byte to a non-blocking pipe, as EventRing does for records,
+    #so the input process can sleep on edges and on the rings from the image process in a single multiprocessing.connection.wait
+    def __init__(self):
+        self.readFd, self.writeFd = os.pipe()
+        os.set_blocking(self.readFd, False)
+        os.set_blocking(self.writeFd, False)
+
+    def fileno(self):
+        return self.readFd
+
+    def set(self):
+        try:
+            os.write(self.writeFd, b"\0")
+        except BlockingIOError: #Pipe is full, so a wake-up is already waiting
+            pass
+
+    def clear(self):
+        try:
+            while os.read(self.readFd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.readFd)
+        os.close(self.writeFd)
+
+class InterruptCapture:
+    #Edge capture using RPi.GPIO event callbacks - each edge is timestamped in the callback thread as soon as it fires
+    #and queued, so pulses shorter than a loop cycle are no longer lost
+    #Every edge reaches the debounce filter instead of being dropped by RPi.GPIO's bouncetime, so glitches can be counted
+    def __init__(self, pin, bounce, clock, name, ready):
+        self.pin = pin
+        self.clock = clock
+        self.level = GPIO.input(pin) #Last captured pin level
+        self.debounce = DebounceFilter(name, bounce*1e9, self.level)
+        self.queue = deque() #Captured (level, time (ns)) edges waiting to be handled by the input process
+        self.ready = ready #Set whenever an edge is queued so the loop wakes immediately - a threading.Event or an EdgeDoorbell shared by every pin
+        GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.callback)
+
+    def callback(self, channel):
+        edgeTime = self.clock.nowNs() #Timestamp first, before anything else can delay the callback
+        newState = GPIO.input(channel)
+        if newState == self.level: #Pin already flipped back before it could be read - the edge still happened
+            newState = 1 - self.level
+        self.level = newState
+        self.queue.append((newState, edgeTime))
+        self.ready.set()
+
+    def edges(self):
+        edgeList = []
+        while self.queue:
+            newState, edgeTime = self.queue.popleft()
+            edgeList += self.debounce.edge(newState, edgeTime)
+        return edgeList + self.debounce.settle(self.clock.nowNs())
+
+def mergeEdges(captures, heldEdges):
+    #Edges captured on every input in the order they happened - captures is a list of tuples that end with the capture, such as (channel code, role, capture),
+    #and each edge is returned as (time (ns), the rest of the capture's tuple, level)
+    #The captures are drained one after another, so edges newer than the start of the drain are held back in heldEdges until the next call -
+    #an older edge on a capture that was already drained could still be queued after them, which would put a quadrature encoder's channels out of order
+    cutoff = captures[0][-1].clock.nowNs() if captures else 0
+    edgeList = heldEdges[:]
+    for *channel, capture in captures:
+        edgeList += [(edgeTime, *channel, newState) for newState, edgeTime in capture.edges()]
+    edgeList.sort()
+    heldEdges[:] = [edge for edge in edgeList if edge[0] > cutoff]
+    return [edge for edge in edgeList if edge[0] <= cutoff]
+
+def inputChannelCodes():
+    #Channel code of each input channel - the wheel and door keep their fixed codes, other inputs are numbered from CHANNEL_INPUT
+    global inputChannels
+    codes = []
+    nextCode = CHANNEL_INPUT
+    for channel in inputChannels:
+        if channel["role"] == "wheel":
+            codes.append(CHANNEL_WHEEL)
+        elif channel["role"] == "door":
+            codes.append(CHANNEL_DOOR)
+        else:
+            codes.append(nextCode)
+            nextCode += 1
+    return codes
+
+def checkInputChannels():
+    #Problems with the input channel table of the selected cage - returns a list of error messages, empty if the table is valid
+    #The reward logic needs exactly one "door", and exactly one "wheel" or exactly one each of "encoderA" and "encoderB"
+    global inputChannels
+    roles = [channel["role"] for channel in inputChannels]
+    errors = []
+    for role in sorted(set(roles)):
+        if role not in ["wheel", "door", "encoderA", "encoderB", "event"]:
+            errors.append("Input channel role \"" + role + "\" is not one of: wheel, door, encoderA, encoderB, event")
+    if roles.count("door") != 1:
+        errors.append("There must be exactly one \"door\" input channel, found " + str(roles.count("door")))
+    if "encoderA" in roles or "encoderB" in roles:
+        if roles.count("encoderA") != 1 or roles.count("encoderB") != 1 or "wheel" in roles:
+            errors.append("A wheel encoder needs exactly one \"encoderA\" and one \"encoderB\" input channel, and no \"wheel\" channel")
+    elif roles.count("wheel") != 1:
+        errors.append("There must be exactly one \"wheel\" input channel, found " + str(roles.count("wheel")))
+    pins = [channel["pin"] for channel in inputChannels]
+    for pin in sorted(set(pins)):
+        if pins.count(pin) > 1:
+            errors.append("Pin " + str(pin) + " is used by more than one input channel")
+    return errors
+
+def channelNames():
+    #Name of every channel code, including the extra input channels - stored in the binary log header
+    global inputChannels
+    names = dict(CHANNEL_NAMES)
+    for channel, code in zip(inputChannels, inputChannelCodes()):
+        names[code] = channel["name"]
+    return names
+
+class CageInput:
+    #Wheel and door reward logic of one cage - inputProcess runs one for every cage on the Pi, so the cages share one capture loop, and reactorProcess runs one in the same loop as the cage's CageImage
+    #link - dict of the cage's settings ("cage"), its ring to the log process ("connLog"), the flag its image process sets to stop ("stopQueue"),
+    #and dicts of the rings from and to its image process for the "wheel" and "door" roles ("fromImage", "toImage")
+    def __init__(self, link, clock):
+        cage = link["cage"]
+        self.cageNumber = cage["cageNumber"]
+        self.connLog = link["connLog"]
+        self.stopQueue = link["stopQueue"]
+        self.fromImage = link["fromImage"]
+        self.toImage = link["toImage"]
+        self.telemetry = cage["telemetry"]
+        self.pinPump = cage["pinPump"]
+        self.clock = clock
+        self.contrastProtocol = cage["protocol"].contrast
+        self.controlSet = cage["protocol"].controlImages
+
+        #Retrieve protocol parameters - times are converted to ns to match the experiment clock
+        self.wheelInterval = cage["protocol"].wheelInterval*1e9
+        self.revolutions = cycle(cage["schedule"].revolutions) #Revolutions needed for each reward, drawn up front
+        self.pumpDuration = cage["protocol"].pumpDuration*1e9
+        self.rewardDuration = cage["protocol"].rewardDuration*1e9
+
+        currentTime = clock.nowNs() #Tracker of current time point (ns)
+
+        #Wheel state
+        self.wheelRun = True #Whether wheel events count towards a reward - initialize assuming control state
+        self.wheelLevel = 0 #Wheel pin level at last state change
+        self.wheelChange = False #Single loop cycle flag if the wheel state has changed and has not yet been handled
+        self.wheelCount = 0 #Number of wheel revolutions
+        self.rewardRev = next(self.revolutions) #Number of revolutions needed to trigger a reward event
+        self.wheelEnd = currentTime #Timeout for wheel
+        self.rewardId = 0 #Correlation ID of the last reward event triggered by the wheel
+
+        #Door state
+        self.doorRun = False #Whether a door opening turns on the pump - initialize assuming control state
+        self.doorLevel = 0 #Door pin level at last state change
+        self.doorChange = False #Single loop cycle flag if the door state has changed and has not yet been handled
+        self.rewardEnd = currentTime #Track when a reward state times out
+        self.pumpOn = False
+
+        self.captures = [] #(channel code, role, capture) of every input channel of the cage
+        self.encoder = None #Quadrature decoder if the wheel has an encoder
+        self.pump = None #Scheduled pump pulses
+        self.run = True #Cleared once the cage's image process has stopped
+
+    def start(self, captures):
+        #Set up the pump and take the starting level of each input - captures is a list of (channel code, role, capture)
+        global encoderCountsPerRev
+        global encoderBinInterval
+        GPIO.setup(self.pinPump, GPIO.OUT)
+        GPIO.output(self.pinPump, GPIO.LOW) #Initialize with pump low
+        self.pump = PumpPulse(self.pinPump, self.clock, threaded=not self.clock.virtual) #On a virtual clock the input loop switches the pump off at its deadline
+        self.connLog.send((EVENT_START, CHANNEL_WHEEL, 0, self.clock.nowNs(), 0, 0))
+        self.connLog.send((EVENT_POWER, CHANNEL_MONITOR, 1, self.clock.nowNs(), 0, 0))
+        self.connLog.send((EVENT_START, CHANNEL_DOOR, 0, self.clock.nowNs(), 0, 0))
+        self.captures = captures
+        levels = {capture[1]: capture[2].level for capture in captures} #Starting level of each role
+        self.wheelLevel = levels.get("wheel", 0)
+        self.doorLevel = levels.get("door", 0)
+        if "encoderA" in levels:
+            self.encoder = QuadratureDecoder(encoderCountsPerRev, encoderBinInterval*1e9, levels["encoderA"], levels["encoderB"])
+
+    def sendControl(self, role, value, timeNs, rewardId=0):
+        self.toImage[role].send((EVENT_CONTROL, CHANNEL_WHEEL if role == "wheel" else CHANNEL_DOOR, value, timeNs, rewardId, 0))
+
+    def logPulse(self):
+        #Log the end of a pump pulse once the timer has switched the pump off
+        pulse = self.pump.finished()
+        if pulse:
+            onNs, offNs, requestedNs = pulse
+            self.connLog.send((EVENT_OUTPUT, CHANNEL_PUMP, 0, offNs, 0, 0))
+            self.connLog.send((EVENT_PULSE, CHANNEL_PUMP, 0, onNs, requestedNs, offNs - onNs))
+
+    def logBins(self, completed):
+        for startNs, forward, backward, peakSpeed in completed:
+            self.connLog.send((EVENT_ENCODER, CHANNEL_WHEEL, round(peakSpeed*1000), startNs, forward, backward))
+
+    def wheelStateChange(self, eventTime):
+        #Take action if the wheel is counting and a new state change occured - check if the wheel has triggered a reward event
+        if self.wheelRun and self.wheelChange:
+            self.wheelChange = False #Clear the state change flag
+            if(self.wheelLevel and self.wheelCount > 0) and self.controlSet:
+                self.connLog.send((EVENT_REVOLUTION, CHANNEL_WHEEL, 0, eventTime, self.wheelCount, self.rewardRev))
+            if(self.wheelCount == self.rewardRev):
+                self.rewardId += 1 #Correlation ID that follows this reward event through the image process and the door
+                sentTime = self.clock.nowNs()
+                self.sendControl("wheel", 1, eventTime, self.rewardId) #Tell image process that reward event has been triggered
+                self.connLog.send((EVENT_HOP, CHANNEL_WHEEL, HOP_EDGE, eventTime, self.rewardId, 0))
+                self.connLog.send((EVENT_HOP, CHANNEL_WHEEL, HOP_WHEEL_SENT, sentTime, self.rewardId, 0))
+                self.wheelRun = False
+
+    def doorStateChange(self, eventTime):
+        #If door is open and reward is active, start a pump pulse - the pump is on for one pulse per reward event
+        if self.doorRun and self.doorChange:
+            self.doorChange = False #Clear the state change flag
+            if(self.doorLevel == doorOpen and not self.pumpOn):
+                if self.controlSet:
+                    self.pump.start(self.pumpDuration)
+                else: #With no control image the pump is held on while the door is open, and switched off by update
+                    GPIO.output(self.pinPump, GPIO.HIGH)
+                self.pumpOn = True
+                self.connLog.send((EVENT_OUTPUT, CHANNEL_PUMP, 1, eventTime, 0, 0))
+                self.rewardEnd = eventTime + self.pumpDuration #Set reward to end at end of pump cycle - this will extend reward or shorten time to match pump on time
+
+    def wheelEdge(self, newState, edgeTime):
+        self.wheelChange = True
+        self.wheelLevel = newState #Update current state
+        if self.wheelLevel:
+            if self.wheelEnd > edgeTime: #If wheel event happens before timeout, add event to counter
+                self.wheelCount += 1
+            else: #If event happens after timeout, reset counter
+                self.wheelCount = 1
+                self.rewardRev = next(self.revolutions) #Reset reward revolution counter
+            self.wheelEnd = edgeTime + self.wheelInterval #Update timeout timer
+            if(not self.wheelRun and self.contrastProtocol): #if the wheel is in reward state and contrast protocol is active, report wheel events during the reward state
+                self.sendControl("wheel", 0, edgeTime)
+        self.connLog.send((EVENT_EDGE, CHANNEL_WHEEL, self.wheelLevel, edgeTime, 0, 0))
+        self.wheelStateChange(edgeTime)
+
+    def edge(self, code, role, newState, edgeTime):
+        #Log a captured edge and act on it at the time it occured
+        if role == "wheel":
+            self.wheelEdge(newState, edgeTime)
+        elif role == "encoderA" or role == "encoderB":
+            #Bin the encoder counts, and handle each whole forward revolution like a pulse from a one pulse per revolution wheel
+            completed, revolutionTimes = self.encoder.edge(role[-1], newState, edgeTime)
+            self.logBins(completed)
+            for revolutionTime in revolutionTimes:
+                self.wheelEdge(1, revolutionTime)
+                self.wheelEdge(0, revolutionTime)
+        elif role == "door":
+            self.doorChange = True
+            self.doorLevel = newState #Update current state
+            self.connLog.send((EVENT_EDGE, CHANNEL_DOOR, self.doorLevel, edgeTime, 0, 0))
+            self.doorStateChange(edgeTime)
+        else: #Other inputs are only logged
+            self.connLog.send((EVENT_EDGE, code, newState, edgeTime, 0, 0))
+
+    def readImage(self, currentTime):
+        #see if there is a state flag from the image process
+        for record in self.fromImage["wheel"].drain():
+            self.wheelRun = record[2] #Activate run state
+            self.wheelCount = 0 #Reset wheel count
+            self.wheelEnd = currentTime #Reset wheel timeout timer
+        for record in self.fromImage["door"].drain():
+            if record[4]: #Reward event triggered by the wheel - the pump is now armed
+                self.connLog.send((EVENT_HOP, CHANNEL_DOOR, HOP_PUMP_ARMED, self.clock.nowNs(), record[4], 0))
+            self.doorRun = record[2] #Activate run state
+            self.rewardEnd = currentTime + self.rewardDuration #start reward timers
+
+        #Handle any state change left over from before the run state was activated
+        self.wheelStateChange(currentTime)
+        self.doorStateChange(currentTime)
+
+    def deadline(self):
+        #Earliest time the cage needs the input loop to wake without an edge or a record (ns) - None if the cage is only waiting for edges
+        deadlines = [self.pump.endNs()] #Pump pulse due to end - normally switched off by its timer, the loop logs it
+        deadlines += [capture.debounce.pending() for code, role, capture in self.captures] #Pin still bouncing, accepted once it settles
+        if self.encoder:
+            deadlines.append(self.encoder.binEnd()) #Encoder bin to log once it ends
+        if self.doorRun:
+            deadlines.append(self.rewardEnd + 1) #Reward state ends once the time is past rewardEnd
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def update(self, currentTime):
+        if self.encoder: #Log the last encoder bin once it has ended, even if the wheel has stopped
+            self.logBins(self.encoder.bins(currentTime))
+        endNs = self.pump.endNs()
+        if endNs is not None and endNs <= currentTime: #Pulse is due to end but its timer has not fired yet
+            self.pump.stop()
+
+        #If there is no control image, leave pump on while door is open
+        if not self.controlSet:
+            if(self.doorLevel == doorOpen and not self.pumpOn):
+                GPIO.output(self.pinPump, GPIO.HIGH)
+                self.connLog.send((EVENT_OUTPUT, CHANNEL_PUMP, 1, currentTime, 0, 0))
+                self.pumpOn = True
+            elif(self.doorLevel != doorOpen and self.pumpOn):
+                GPIO.output(self.pinPump, GPIO.LOW)
+                self.connLog.send((EVENT_OUTPUT, CHANNEL_PUMP, 0, currentTime, 0, 0))
+                self.pumpOn = False
+
+        #At end of reward event, flag image process - a pump pulse still running is switched off by its own timer
+        if(self.doorRun):
+            if(self.rewardEnd < currentTime):
+                if self.pumpOn:
+                    if not self.controlSet: #A pump held on while the door is open has no timer
+                        GPIO.output(self.pinPump, GPIO.LOW)
+                        self.connLog.send((EVENT_OUTPUT, CHANNEL_PUMP, 0, currentTime, 0, 0))
+                    self.pumpOn = False
+                self.sendControl("door", 1, currentTime) #Tell image process reward state is over
+                self.doorRun = False
+        self.logPulse()
+
+        #Publish the state for the telemetry endpoint
+        self.telemetry.set("wheelCount", self.wheelCount)
+        self.telemetry.set("rewardRev", self.rewardRev)
+        self.telemetry.set("rewards", self.rewardId)
+        self.telemetry.set("pumpOn", self.pumpOn)
+        for code, role, capture in self.captures:
+            self.telemetry.set("glitches " + capture.debounce.name, capture.debounce.glitches)
+
+    def stop(self):
+        #Stop handling the cage once its image process has stopped - the pump is switched off, later edges are ignored
+        self.run = False
+        if self.pump: #Make sure the pump is off before the pins are released
+            self.pump.stop()
+            if not self.controlSet:
+                GPIO.output(self.pinPump, GPIO.LOW)
+
+    def summaries(self):
+        #Final records and status lines of the cage
+        summaries = []
+        if self.pump: #Report how closely pump pulses matched the requested on-time
+            self.logPulse()
+            summaries.append(self.pump.summary())
+        summaries += [capture.debounce.summary() for code, role, capture in self.captures] #Report how noisy each sensor was
+        if self.encoder:
+            self.logBins(self.encoder.bins(self.clock.nowNs() + self.encoder.binNs)) #Log the bin in progress
+            summaries.append(self.encoder.summary())
+        return summaries
+
+def inputProcess(links, clock):
+    #Captures the input channels of every cage run by this Pi in one process, so adding a sensor or a second cage costs no extra process
+    #The "wheel" and "door" channels of each cage run its CageInput reward logic, all other channels only log their edges
+    #links - one dict per cage, as described in CageInput
     global pinStrip
-    global wheelBounce
-    global doorBounce
-    global doorOpen
     global syncDelay
-    global parameterDict
-    global contrastProtocol
-
-    #Retrieve protocol parameters
-    wheelInterval = parameterDict["Maximum time between wheel events (seconds):"]
-    minRev = parameterDict["Minimum wheel revolutions for reward:"]
-    maxRev = parameterDict["Maximum wheel revolutions for reward:"]
-    pumpDuration = parameterDict["Duration of pump \"on\" state (seconds):"]
-    rewardDuration = parameterDict["Maximum duration of reward state (seconds):"]
-
-    delay = 0 #Debounce delay
-
-    #Set state flags
-    wheelCount = 0 #Number of wheel revolutions
-    rewardRev = 0 #Number of revolutions needed to trigger a reward event
-    currentTime = time.time() #Tracker of current time point
-    wheelEnd = currentTime #Timeout for wheel
-    rewardEnd = currentTime #Track when a reward state times out
-    runState = False #Whether to send data to the image process or to only log events
-    pinState = False #Previous state of GPIO pin at last state change
-    newState = False #Current state of GPIO pin
-    stateChange = False #Single loop cycle flag if an state has changed and has not yet been handled
+    global stopPollInterval
+    global captureMode
+    global inputChannels
+    global telemetry
+    global minPulseWidth
+    global loopProfileStream
+
+    cages = [] #CageInput of every cage
+    captures = [] #(cage index, channel code, role, capture) of every input channel
+    heldEdges = [] #Captured edges waiting for the next loop, so edges from all inputs are handled in order
+    profiler = None #Loop timing and suspect gaps
+    ready = EdgeDoorbell() #Rung by every interrupt captured channel
+    cpuStart = os.times()
+
+    def cagePrint(cage, line):
+        #Status display - lines are labelled with their cage when the Pi runs more than one
+        lxprint(("Cage " + str(cage.cageNumber) + " " if len(links) > 1 else "") + line)
+
+    try:
+        #Setup the input pins with pull-up resistors, the pump outputs, and the power strip to turn on the monitors
+        GPIO.setup(pinStrip, GPIO.OUT)
+        GPIO.output(pinStrip, GPIO.HIGH) #Turn monitor on
+
+        #Capture edges on every channel of every cage - with interrupt capture every channel wakes the same loop
+        for index, link in enumerate(links):
+            selectCage(link["cage"]) #Channel codes are numbered within each cage's results file
+            cage = CageInput(link, clock)
+            cageCaptures = []
+            for channel, code in zip(inputChannels, inputChannelCodes()):
+                GPIO.setup(channel["pin"], GPIO.IN, pull_up_down=GPIO.PUD_UP)
+                if captureMode == "poll" and not channel["role"].startswith("encoder"): #Encoder edges come faster than the poll cycle, so they are always captured by interrupt
+                    capture = PollCapture(channel["pin"], channel["bounce"]/1000, clock, channel["name"])
+                else:
+                    capture = InterruptCapture(channel["pin"], channel["bounce"]/1000, clock, channel["name"], ready)
+                cageCaptures.append((code, channel["role"], capture))
+                captures.append((index, code, channel["role"], capture))
+            cage.start(cageCaptures)
+            cages.append(cage)
+        selectCage(links[0]["cage"]) #The input process reports its own telemetry with the first cage
+        telemetry.start("Input")
+        polled = any(isinstance(capture[3], PollCapture) for capture in captures) #A polled pin is only sampled when the loop wakes
+        profiler = LoopProfiler("Input", minPulseWidth*1e9 if polled else None) #An interrupt captured pin cannot lose a pulse while the loop sleeps
+
+        while any(cage.run for cage in cages):
+            #Sleep until an edge is captured, an image process sends a record, or the nearest deadline of any cage
+            #The stop flag has no doorbell, so it is checked every stopPollInterval - on a virtual clock a stopping image process wakes the loop instead,
+            #and the next simulated edge is a deadline
+            deadlines = [cage.deadline() for cage in cages if cage.run]
+            if clock.virtual:
+                deadlines.append(GPIO.nextEventTime())
+            else:
+                deadlines.append(clock.nowNs() + stopPollInterval*1e9)
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            deadline = min(deadlines) if deadlines else None
+            timeout = None if deadline is None else max(0, (deadline - clock.nowNs())/1e9)
+            if polled and not clock.virtual: #Sample the polled pins every sync cycle
+                timeout = syncDelay if timeout is None else min(timeout, syncDelay)
+            if heldEdges: #Edges held back by the last merge are already due
+                timeout = 0
+            waitList = [ready] + [ring for cage in cages if cage.run for ring in cage.fromImage.values()] #A stopped cage's rings are no longer read
+            if clock.virtual and not heldEdges: #Simulated edges are only fired once every rig process has settled at the current time
+                clock.wait("Input", waitList, deadline)
+            else:
+                wait(waitList, timeout=timeout)
+            if clock.virtual:
+                GPIO.advance(clock.nowNs()) #Fire the simulated edges, which queue in the captures as on the Pi
+            ready.clear() #Cleared before the captures are drained, so an edge captured from here on rings it again
+            currentTime = clock.nowNs()
+            loopStart = time.monotonic_ns()
+            gap = profiler.sample(currentTime)
+            if gap and loopProfileStream:
+                for cage in cages:
+                    cage.connLog.send((EVENT_TEXT, CHANNEL_LOG, 0, currentTime, 0, 0, profiler.gapLine(gap)))
+
+            for cage in cages:
+                if cage.run:
+                    cage.readImage(currentTime)
+
+            #Edges from all channels are handled in the order they happened
+            for edgeTime, index, code, role, newState in mergeEdges(captures, heldEdges):
+                if cages[index].run:
+                    cages[index].edge(code, role, newState, edgeTime)
+
+            for cage in cages:
+                if cage.run:
+                    cage.update(currentTime)
+                    #Stop the cage on stop command from its image process
+                    if cage.stopQueue.value == 1:
+                        cage.stop()
+            loopNs = time.monotonic_ns() - loopStart
+            profiler.handling.add(loopNs)
+            telemetry.loop("Input", loopNs)
+    except Exception:
+        lxprint("GPIO Error!")
+        lxprint(traceback.format_exc())
+
+    finally:
+        GPIO.output(pinStrip, GPIO.LOW) #Turn monitor off
+        for cage in cages:
+            cage.connLog.send((EVENT_POWER, CHANNEL_MONITOR, 0, clock.nowNs(), 0, 0))
+            cage.stop()
+        GPIO.cleanup()
+        ready.close()
+        if clock.virtual: #No longer holds back the virtual time
+            clock.finish("Input")
+        profile = []
+        if profiler: #Report loop timing so pulses possibly missed by the loop can be checked against the bounce times - the loop is shared by every cage
+            profile = profiler.summary(captureMode)
+        for line in profile:
+            lxprint(line)
+        for cage in cages:
+            summaries = cage.summaries()
+            for line in summaries:
+                cagePrint(cage, line)
+            for line in profile + summaries:
+                cage.connLog.send((EVENT_TEXT, CHANNEL_LOG, 0, clock.nowNs(), 0, 0, line))
+            cage.connLog.send((EVENT_TEXT, CHANNEL_LOG, 0, clock.nowNs(), 0, 0, cpuSummary("Input", cpuStart)))
+        lxprint("Input stop at: " + str(datetime.now()))
+
+def reactorProcess(cage, clock):
+    #Single event loop rig runtime - selected with "Rig runtime: reactor" in the protocol
+    #One loop runs the cage's CageInput and CageImage and writes the results file, so a reward trigger reaches the screen without any IPC hop
+    #Edges are timestamped in the RPi.GPIO callback thread and queued for the loop, which sleeps until the next edge or deadline
+    #The reward and image logic is the same code the multiprocess runtime runs, connected by LocalRings, so the two runtimes can be benchmarked against each other
+    #cage - settings of the cage, from cageSettings()
+    global pinStrip
+    global inputChannels
+    global keyPollInterval
+    global anchorInterval
+    global protocol
+    global telemetry
+
+    connLog = LocalRing("log") #Records of the CageInput and CageImage, written to the results file by the loop
+    rings = {key: LocalRing(key.replace("_", " ")) for key in ["door_to_image", "image_to_door", "wheel_to_image", "image_to_wheel"]}
+    cageInput = CageInput({"cage": cage, "connLog": connLog, "stopQueue": None, "fromImage": {"wheel": rings["image_to_wheel"], "door": rings["image_to_door"]},
+                           "toImage": {"wheel": rings["wheel_to_image"], "door": rings["door_to_image"]}}, clock)
+    image = CageImage(connLog, rings["door_to_image"], rings["image_to_door"], rings["wheel_to_image"], rings["image_to_wheel"], clock)
+    writer = openResultsWriter()
+    rewardLatency = RewardLatency() #End-to-end latency of each reward event
+    deadlines = [] #Heap of (time (ns), kind) deadlines of the loop - stale deadlines only cause a harmless extra wake-up
+    timerLatency = LatencyHistogram() #How late the loop wakes for a deadline
+    edgeLatency = LatencyHistogram() #Time from an edge being captured to the loop handling it
+    ready = threading.Event() #Set by the capture callbacks whenever an edge is queued
+    cpuStart = os.times()
+    captures = [] #(channel code, role, capture) of every input channel
+    heldEdges = [] #Captured edges waiting for the next loop, so edges from all inputs are handled in order
     run = True
 
-    #Set output strings
-    header = '' #Device string
-    stateStr = '' #High/low string
-    stopString = '' #String to print when process stops
+    def writeLog():
+        #Write the records sent by the CageInput and CageImage to the results file - reward hops are collected into latency lines instead
+        for record in connLog.drain():
+            if record[0] == EVENT_HOP:
+                line = rewardLatency.add(record)
+                if line:
+                    writer.write((EVENT_TEXT, CHANNEL_LOG, 0, record[3], 0, 0, line))
+            else:
+                writer.write(record)
+                telemetry.countEvent(record[1])
 
-    try:
-        #Setup GPIO pin with pull-up resistor, and detection interrupts for both rising and falling events
-        #If the GPIO pin is the wheel pin, then log wheel events
-        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        if pin == pinWheel:
-            header = "Wheel - "
-            delay = wheelBounce/1000
-            stopString = "Wheel stop at: "
-            runState = True #Initialize assuming control state
-            rewardRev = random.randint(minRev, maxRev)
-            
-            #Have the wheel process also start the power strip to turn on monitors
-            GPIO.setup(pinStrip, GPIO.OUT)
-            GPIO.output(pinStrip, GPIO.HIGH) #Turn monitor on
-            
-            connLog.send("Wheel starting at: " + "{:.3f}".format(time.time()-expStart))
-            connLog.send("Monitor on at: " + "{:.3f}".format(time.time()-expStart))
-
-        #Otherwise, log all other door events, and activate pump output
-        else:
-            header = "Door - "
-            delay = doorBounce/1000
-            stopString = "Door stop at: "
-            GPIO.setup(pinPump, GPIO.OUT)
-            GPIO.output(pinPump, GPIO.LOW) #Initialize with pump low
-            runState = False #Initialize assuming control state
-            connLog.send("Door starting at: " + "{:.3f}".format(time.time()-expStart))
-
-        #Poll GPIO pin and send events to log when state changes
-        pinState = GPIO.input(pin)
-        pumpOn = False
-        currentTime = time.time()
+    def addDeadline(deadline, kind):
+        heapq.heappush(deadlines, (deadline, kind))
 
-        while run:
-            time.sleep(syncDelay)
-            currentTime = time.time()
-
-            #see if there is a state flag from the image process
-            if imagePipe.poll():
-                runState = imagePipe.recv() #Activate run state
-                wheelCount = 0 #Reset wheel count
-                wheelEnd = currentTime #Reset wheel timeout timer
-                rewardEnd = currentTime + rewardDuration #start reward timers
-
-            #Take action if state is active and new state change occured
-            if(runState and stateChange):
-                stateChange = False #Clear the stateChange flag
-
-                #Door trigger pump events
-                if(pin == pinDoor):
-                    #If door is open and reward is active, turn on pump
-                    if(pinState == doorOpen and not pumpOn):
-                        GPIO.output(pinPump, GPIO.HIGH)
-                        pumpOn = True
-                        connLog.send("Pump - State: On, Time: " + "{:.3f}".format(currentTime - expStart))
-                        rewardEnd = currentTime + pumpDuration #Set reward to end at end of pump cycle - this will extend reward or shorten time to match pump on time
-
-                #Otherwise check if wheel has triggered a reward event
-                else:
-                    if(pinState and wheelCount > 0) and parameterDict["Control image set:"]:
-                        connLog.send("Wheel revolution " + str(wheelCount) + " of " + str(rewardRev))
-                    if(wheelCount == rewardRev):
-                        imagePipe.send(1) #Tell image process that reward event has been triggered
-                        runState = False
-
-            #If there is no control image, leave pump on while door is open
-            if not parameterDict["Control image set:"]:
-                if(pin == pinDoor):
-                    if(pinState == doorOpen and not pumpOn):
-                        GPIO.output(pinPump, GPIO.HIGH)
-                        connLog.send("Pump - State: On, Time: " + "{:.3f}".format(currentTime - expStart))
-                        pumpOn = True
-                    elif(pinState != doorOpen and pumpOn):
-                        GPIO.output(pinPump, GPIO.LOW)
-                        connLog.send("Pump - State: Off, Time: " + "{:.3f}".format(currentTime - expStart))
-                        pumpOn = False
-                    else:
-                        pass
-
-            #At end of reward event, turn pump off and flag image process
-            if(pin == pinDoor):
-                if(runState):
-                    if(rewardEnd < currentTime):
-                        if pumpOn:
-                            GPIO.output(pinPump, GPIO.LOW)
-                            pumpOn = False
-                            connLog.send("Pump - State: Off, Time: " + "{:.3f}".format(currentTime - expStart))
-                        imagePipe.send(1) #Tell image process reward state is over
-                        runState = False
-
-            #If GPIO state changes, log event
-            newState = GPIO.input(pin)
-            if (newState ^ pinState):
-                stateChange = True
-                pinState = newState #Update current state
-
-                if pinState:
-                    stateStr = "State: High, Time: "
-                    if wheelEnd > currentTime: #If wheel event happens before timeout, add event to counter
-                        wheelCount += 1
-                    else: #If event happens after timeout, reset counter
-                        wheelCount = 1
-                        rewardRev = random.randint(minRev, maxRev) #Reset reward revolution counter
-                    wheelEnd = currentTime + wheelInterval #Update timeout timer
-
-                    if(pin == pinWheel and not runState and contrastProtocol): #if the wheel is in reward state and contrast protocol is active, report wheel events during the reward state
-                        imagePipe.send(0)
+    def writeAnchor():
+        expTime, wallTime = clock.anchor()
+        connLog.send((EVENT_ANCHOR, CHANNEL_LOG, 0, expTime, wallTime, 0))
+        addDeadline(expTime + anchorInterval*1e9, "anchor")
 
-                else:
-                    stateStr = "State: Low, Time: "
+    def checkKeys():
+        nonlocal run
+        for event in pygame.event.get(pygame.KEYDOWN):
+            lxprint("Key press")
+            run = False
+        if not clock.virtual: #A dry run is headless - polling keys every keyPollInterval of virtual time would only slow it down
+            addDeadline(clock.nowNs() + keyPollInterval*1e9, "keys")
 
-                connLog.send(header + stateStr + "{:.3f}".format(currentTime - expStart))
+    try:
+        telemetry.start("Reactor")
+        #Setup the input pins with pull-up resistors, and the power strip to turn on the monitor
+        for channel in inputChannels:
+            GPIO.setup(channel["pin"], GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(pinStrip, GPIO.OUT)
+        GPIO.output(pinStrip, GPIO.HIGH) #Turn monitor on
+        for channel, code in zip(inputChannels, inputChannelCodes()): #The reactor always captures edges by interrupt - it has no poll cycle
+            captures.append((code, channel["role"], InterruptCapture(channel["pin"], channel["bounce"]/1000, clock, channel["name"], ready)))
+        cageInput.start(captures)
+        image.start()
+
+        #Calculate experiment end time
+        addDeadline(clock.nowNs() + 60*60*protocol.experimentHours*1e9, "end")
+        writeAnchor()
+        image.changeToControl() #Initialize to a control image
+        checkKeys()
 
-                #Debounce delay
-                time.sleep(delay)
+        while run:
+            #Records passed between the CageInput and CageImage are handled straight away, as an image process or input process woken by its ring would
+            pending = any(ring.poll() for ring in image.waitList() + list(cageInput.fromImage.values()))
+            deadline = deadlines[0][0]
+            for cageDeadline in [cageInput.deadline(), image.deadline()]:
+                if cageDeadline is not None and cageDeadline < deadline:
+                    deadline = cageDeadline
+            if clock.virtual: #Dry run - jump straight to the next deadline or simulated edge instead of sleeping
+                if not pending:
+                    edgeTime = GPIO.nextEventTime()
+                    clock.advance(edgeTime if edgeTime is not None and edgeTime < deadline else deadline)
+                    GPIO.advance(clock.nowNs()) #Fire the simulated edges, which queue in the captures as on the Pi
+                woken = pending or ready.is_set()
+            else:
+                #Sleep until an edge is captured, the next deadline, or the results need flushing
+                timeout = 0 if pending else (deadline - clock.nowNs())/1e9
+                flushTimeout = writer.timeout()
+                if flushTimeout is not None and flushTimeout < timeout:
+                    timeout = flushTimeout
+                woken = ready.wait(max(0, timeout)) or pending
+            ready.clear()
+            currentTime = clock.nowNs()
+            loopStart = time.monotonic_ns()
+            if not woken and deadline <= currentTime: #Loop was woken by the deadline
+                timerLatency.add(currentTime - deadline)
+
+            #Handle expired deadlines of the loop
+            while deadlines and deadlines[0][0] <= currentTime:
+                deadline, kind = heapq.heappop(deadlines)
+                if kind == "keys":
+                    checkKeys()
+                elif kind == "anchor":
+                    writeAnchor()
+                elif kind == "end":
+                    run = False
+            if not run:
+                break
 
-            #Stop process on stop command from GUI process
-            if stopQueue.value == 1:
-                run = False
-    except:
-        lxprint("GPIO Error!")
+            #Run the cage for this cycle in the order of the multiprocess runtime - the input side first, then the image side
+            cageInput.readImage(currentTime)
+            for edgeTime, code, role, newState in mergeEdges(captures, heldEdges): #Edges from all inputs are handled in the order they happened
+                edgeLatency.add(clock.nowNs() - edgeTime)
+                cageInput.edge(code, role, newState, edgeTime)
+            cageInput.update(currentTime)
+            image.update(currentTime)
+            writeLog()
+            writer.poll()
+
+            #Publish the state for the telemetry endpoint - the CageInput publishes its own
+            telemetry.set("rewardState", image.rewardState)
+            telemetry.set("bytesWritten", writer.bytesWritten)
+            telemetry.set("atRisk", writer.atRisk())
+            telemetry.loop("Reactor", time.monotonic_ns() - loopStart)
 
     finally:
-        if pin == pinWheel: #Have wheel process turn off monitor at end of run
-          GPIO.output(pinStrip, GPIO.LOW) #Turn monitor off
-          connLog.send("Monitor off at: " + "{:.3f}".format(time.time()-expStart))
-        GPIO.cleanup()
-        lxprint(stopString + str(datetime.now()))
+        #Stop capturing edges before the final records are written
+        for code, role, capture in captures:
+            GPIO.remove_event_detect(capture.pin)
+        GPIO.output(pinStrip, GPIO.LOW) #Turn monitor off
+        connLog.send((EVENT_POWER, CHANNEL_MONITOR, 0, clock.nowNs(), 0, 0))
+        cageInput.stop()
+        summaries = cageInput.summaries()
+        writeAnchor()
+        for summary in [timerLatency.summary("Reactor timer wake-up latency"), edgeLatency.summary("Reactor edge handling latency")] + image.summaries() + summaries + [cpuSummary("Reactor", cpuStart)]:
+            lxprint(summary)
+            connLog.send((EVENT_TEXT, CHANNEL_LOG, 0, clock.nowNs(), 0, 0, summary))
+        writeLog()
+        for summary in rewardLatency.summary() + [writer.summary()]: #Written once every reward hop has been collected
+            lxprint(summary)
+            writer.write((EVENT_TEXT, CHANNEL_LOG, 0, clock.nowNs(), 0, 0, summary))
+        writer.write((EVENT_TERMINATE, CHANNEL_LOG, 0, clock.nowNs(), 0, 0))
+        writer.close()
+
+    lxprint("Reactor stop at: " + str(datetime.now()))
+
+def stopProcess(p, timeout):
+    #Give a process time to finish cleanly, and terminate it if it does not
+    p.join(timeout)
+    if p.is_alive():
+        p.terminate()
+        p.join() #Verify that the subprocess is successfully terminated
+
+def cageImageProcess(cage, connLog, stopQueue, fromDoor, toDoor, fromWheel, toWheel, clock):
+    #Image process of the second cage of a two-cage Pi - runs in its own process with its own PyGame display on the cage's monitor
+    selectCage(cage)
+    pygame.init() #Forked before the main process initializes PyGame, so the two displays do not share a connection to the display server
+    try:
+        imageProcess(connLog, stopQueue, fromDoor, toDoor, fromWheel, toWheel, clock)
+    finally:
+        pygame.quit()
 
-def runExperiment():
+def runExperiment(clock=None, cages=None):
+    #cages - settings of every cage run by this Pi, from cageSettings() - defaults to the one cage loaded by retrieveExperiment
+    global cageNumber
     global mountDir
     global resultsFile
-    pygame.init()
+    global ringSlots
+    global protocol
+    global telemetry
+    global telemetryPort
+    global inputChannels
 
     #Global Variables
     GPIO.setmode(GPIO.BOARD) #Sets GPIO pin numbering convention
     #GPIO.setwarnings(False) #Suppress runtime cleanup warnings
 
-    #Initialize pipe dictionary
-    pipeDict = {"door_to_log_rec": None, "door_to_log_send": None, "image_to_log_rec": None, "image_to_log_send": None, "wheel_to_log_rec": None, "wheel_to_log_send":None, "door_to_image_duplex": None, "image_to_door_duplex": None, "wheel_to_image_duplex": None, "image_to_wheel_duplex": None}
-
-    pipeDict["door_to_log_rec"], pipeDict["door_to_log_send"] = Pipe(False) #Setup a unidirectional (duplex = False) line of communication for processes to send data to log process
-    pipeDict["image_to_log_rec"], pipeDict["image_to_log_send"] = Pipe(False)
-    pipeDict["wheel_to_log_rec"], pipeDict["wheel_to_log_send"] = Pipe(False)
-
-    pipeDict["door_to_image_duplex"], pipeDict["image_to_door_duplex"] = Pipe() #Setup a duplex line of communication for coordinating rewards
-    pipeDict["wheel_to_image_duplex"], pipeDict["image_to_wheel_duplex"] = Pipe()
-    stopQueue = Value('i', 0) #Setup a shared variable to allow a keypress to flag all processes to stop
-
-    #NOTE: A pipe can only connect two processes while a queue can connect multiple processes
-    #Also, a pipe is much faster than a queue.  A SimpleQueue has a simplified instruction set
-
-    #Initialize Image, GPIO and logging sub processes
-    expStart = time.time() #Record start time for experiment
-    pLog = Process(target = logProcess, args=(pipeDict["door_to_log_rec"], pipeDict["image_to_log_rec"], pipeDict["wheel_to_log_rec"], stopQueue))
-    pDoor = Process(target = GPIOprocess, args=(pinDoor, pipeDict["door_to_log_send"], stopQueue, pipeDict["door_to_image_duplex"], expStart))
-    pWheel = Process(target = GPIOprocess, args=(pinWheel, pipeDict["wheel_to_log_send"], stopQueue, pipeDict["wheel_to_image_duplex"], expStart))
+    if cages is None:
+        cages = [cageSettings()]
+    valid = True
+    for cage in cages: #Check every cage's input channels before any process is started
+        selectCage(cage)
+        for error in checkInputChannels():
+            lxprint("ERROR: Cage " + str(cageNumber) + " - " + error)
+            valid = False
+    selectCage(cages[0])
+    if not valid:
+        return
+    reactor = protocol.runtime == "reactor" #Run the whole rig in one event loop instead of separate processes
+    if reactor and len(cages) > 1:
+        lxprint("WARNING: The reactor runtime runs a single cage, both cages will use the multiprocess runtime")
+        reactor = False
+    if clock is None:
+        clock = ExperimentClock() #Record start time for experiment
+    for cage in cages: #Created before the rig processes fork so they all share them
+        selectCage(cage)
+        cage["telemetry"] = RigTelemetry(channelNames(), [channel["name"] for channel in inputChannels])
+    selectCage(cages[0]) #The main process runs the first cage
+    ringDict = {}
+    links = [] #Settings, rings and stop flag of each cage
+    pImages = [] #Image processes of the cages after the first
+    pTelemetry = None
+    started = [] #Rig processes that have been started, so only these are stopped on exit
+
+    if not reactor:
+        #Initialize ring buffer dictionary - each ring has exactly one sending and one receiving process
+        for cage in cages:
+            prefix = "" if cage is cages[0] else "cage " + str(cage["cageNumber"]) + " " #Rings of the first cage keep their single-cage names
+            rings = {}
+            for key in ["input_to_log", "image_to_log", "door_to_image", "image_to_door", "wheel_to_image", "image_to_wheel"]:
+                rings[key] = EventRing(prefix + key.replace("_", " "), ringSlots)
+                ringDict[prefix.replace(" ", "_") + key] = rings[key]
+            stopQueue = Value('i', 0) #Setup a shared variable to allow a keypress to flag the cage to stop
+            links.append({"cage": cage, "rings": rings, "stopQueue": stopQueue, "connLog": rings["input_to_log"],
+                          "fromImage": {"wheel": rings["image_to_wheel"], "door": rings["image_to_door"]},
+                          "toImage": {"wheel": rings["wheel_to_image"], "door": rings["door_to_image"]}})
+
+        #NOTE: Rings replace pipes so that a slow USB write in the log process can never block the input process - a full ring drops and counts records instead
+
+        if clock.virtual: #Dry run - the input process and the image process of each cage share the virtual time, and it moves on once they are all waiting
+            clock.share(["Input"] + ["Image " + str(link["cage"]["cageNumber"]) for link in links],
+                        [link["rings"][key] for link in links for key in ["door_to_image", "image_to_door", "wheel_to_image", "image_to_wheel"]])
+
+        #Initialize Image, input and logging sub processes - one input process and one log process serve every input channel of every cage
+        pLog = Process(target = logProcess, args=(links, clock))
+        pInput = Process(target = inputProcess, args=(links, clock))
+        for link in links[1:]:
+            rings = link["rings"]
+            pImages.append(Process(target = cageImageProcess, args=(link["cage"], rings["image_to_log"], link["stopQueue"], rings["door_to_image"], rings["image_to_door"],
+                                                                    rings["wheel_to_image"], rings["image_to_wheel"], clock)))
+
+    if telemetryPort and not clock.virtual: #A dry run is over before anyone could look at it
+        pTelemetry = Process(target = telemetryProcess, args=(cages, ringDict, clock), daemon=True)
 
     try:
-        lxprint("Experiment start at: " + str(datetime.now()))
-        pLog.start() #Start subprocesses before continuing with main thread, otherwise main thread will be too busy to start subprocesses
-        pDoor.start()
-        pWheel.start()
-        imageProcess(pipeDict["image_to_log_send"], stopQueue, pipeDict["image_to_door_duplex"], pipeDict["image_to_wheel_duplex"], expStart) #PyGame does not support multi-processing, so it must stay in the main thread
-        pLog.terminate()
-        pDoor.terminate()
-        pWheel.terminate()
-        pLog.join() #Verify that all subprocesses are successfully terminated
-        pDoor.join()
-        pWheel.join()
-
+        lxprint("Experiment start at: " + str(datetime.now()) + " (" + ("reactor" if reactor else "multiprocess") + " runtime" + (", " + str(len(cages)) + " cages" if len(cages) > 1 else "") + ")")
+        for p in pImages: #Started before PyGame is initialized in this process
+            p.start()
+            started.append(p)
+        pygame.init()
+        if pTelemetry:
+            pTelemetry.start()
+            lxprint("Telemetry at: http://127.0.0.1:" + str(telemetryPort))
+        if reactor:
+            reactorProcess(cages[0], clock) #Wheel, door, image and log all run in the main thread, as PyGame requires
+        else:
+            pLog.start() #Start subprocesses before continuing with main thread, otherwise main thread will be too busy to start subprocesses
+            started.append(pLog)
+            pInput.start()
+            started.append(pInput)
+            rings = links[0]["rings"]
+            imageProcess(rings["image_to_log"], links[0]["stopQueue"], rings["door_to_image"], rings["image_to_door"], rings["wheel_to_image"], rings["image_to_wheel"], clock) #PyGame does not support multi-processing, so it must stay in the main thread
+            for p in pImages: #Let the other cages finish their own protocols
+                p.join()
 
     except KeyboardInterrupt:
-        pLog.terminate()
-        pDoor.terminate()
-        pWheel.terminate()
-        pLog.join() #Verify that all subprocesses are successfully terminated
-        pDoor.join()
-        pWheel.join()
+        pass
 
     finally: #Cleanup on exit
-        with open(mountDir + resultsFile, "a") as f: #Append stop time to results file
-            f.write("Successful termination at: " + str(time.time()-expStart) + "\r\n")
-        for key, value in pipeDict.items(): #Close all active pipes
-            value.close()
+        if pTelemetry and pTelemetry.is_alive():
+            pTelemetry.terminate() #Only reads shared state, so it can be stopped at any point
+            pTelemetry.join()
+        if not reactor:
+            for link in links: #Make sure all processes are flagged to stop
+                link["stopQueue"].value = 1
+                if clock.virtual: #An image process that did not reach its end no longer holds back the virtual time
+                    clock.finish("Image " + str(link["cage"]["cageNumber"]))
+            if clock.virtual and pInput not in started: #Nor does an input process that was never started
+                clock.finish("Input")
+            for p in pImages:
+                if p in started:
+                    stopProcess(p, 5)
+            if pInput in started:
+                stopProcess(pInput, 5) #Let the input process send its last events before stopping the log
+            if pLog in started:
+                for link in links: #Append stop time to each results file and stop log process - the cage's image process has stopped, so its ring is free
+                    link["rings"]["image_to_log"].send((EVENT_TERMINATE, CHANNEL_LOG, 0, clock.nowNs(), 0, 0))
+                stopProcess(pLog, 5)
+            for key, value in ringDict.items(): #Release all ring buffers
+                value.close()
 
         pygame.quit() #close pygame
 
@@ -1114,8 +2750,50 @@ def main():
     else: #If su, then only check the configuration, and then exit the program
         checkPiConfig()
 
+def dryRunProtocol(protocolDir, scriptFile=None, virtual=True):
+    #Run a whole protocol on a virtual clock against the simulated mouse, and write a complete results file to protocolDir
+    #protocolDir is laid out like the USB drive: Protocol.txt and an images folder.  The protocol file is not renamed.
+    #scriptFile optionally replaces the simulated mouse with lines of "<time (s)> <input channel name or pin> <level>"
+    #If virtual is False the protocol runs in real time instead, with the simulated mouse firing edges from its own thread
+    global mountDir
+    global imageDir
+    global resultFileBase
+    global dryRun
+    global inputChannels
+    global PIPE_PATH
+    dryRun = True
+    PIPE_PATH = "/dev/stdout" #Status messages go to the terminal
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy") #Headless display
+    mountDir = os.path.join(os.path.abspath(protocolDir), "")
+    imageDir = mountDir + "dry_run_images/" #Keep the dry run's image store out of the rig's store
+    resultFileBase = "Results - dry run.txt" if virtual else "Results - sim run.txt"
+
+    GPIO.setManual(virtual) #On a virtual clock the simulated mouse only moves when the rig advances it
+    if scriptFile:
+        pins = {channel["name"].lower(): channel["pin"] for channel in inputChannels}
+        events = []
+        with open(scriptFile, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and not line.startswith("#"):
+                    pin = pins[fields[1].lower()] if fields[1].lower() in pins else int(fields[1])
+                    events.append((float(fields[0]), pin, int(fields[2])))
+        GPIO.loadScript(sorted(events))
+
+    if retrieveExperiment(""): #An empty drive label matches any "USB drive ID:"
+        start = time.monotonic()
+        GPIO.restart() #Start the simulated mouse with the experiment
+        runExperiment(VirtualClock() if virtual else None)
+        lxprint(("Dry run" if virtual else "Simulated run") + " of " + str(protocol.experimentHours) + " hours took " + "{:.1f}".format(time.monotonic() - start) + " s: " + mountDir + resultsFile)
+        return True
+    lxprint("ERROR: Dry run could not load the protocol in " + mountDir)
+    return False
+
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 2 and sys.argv[1] in ["--dry-run", "--sim-run"]: #python3 BehaviorRig.py --dry-run|--sim-run <protocol folder> [mouse script]
+        dryRunProtocol(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None, sys.argv[1] == "--dry-run")
+    else:
+        main()
 
 
 
@@ -5,6 +5,7 @@ from statistics import mean, median
 from os import listdir
 import seaborn as sb #plot swarmplot
 from math import inf #Allow for infinity value
+from protocol_schema import readProtocol #Read the protocol from the header of results files
 
 testWindow = 25
 pumpCutoffs = [0.5, 1, inf] #Maximum duration of each event in seconds for each raster bin
@@ -55,8 +56,13 @@ for file in fileList:
     pumpEventCount = 0
     pumpEnd = 0
     pumpStart = 0
-    cageID = None
-    
+    protocol, header = readProtocol(file)
+    cageID = search(r"CAGE [1-4]", protocol.driveID or "") #Search for the cage number in the file
+    if not cageID:
+        print("Skipping " + file + " - no cage number in \"USB drive ID:\" line of header")
+        continue
+    cageID = cageID.group(0)
+
     with open(file) as f:
         for line in f:
             if line.startswith("Wheel - State: High, Time: "):
@@ -75,9 +81,6 @@ for file in fileList:
                     pumpEnd = float(search(r"\d+\.\d+", line).group(0))
                     pumpArray["Single pump event duration"].append(pumpEnd-pumpStart)
                     pumpEventCount += 1
-            elif not cageID:
-                if line.startswith("USB drive ID: CAGE "):
-                    cageID = search(r"CAGE [1-4]", line).group(0)       
             else:
                 pass
                     
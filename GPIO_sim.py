@@ -0,0 +1,325 @@
+#Simulated GPIO backend for the behavior rig - a drop-in replacement for RPi.GPIO driven by a simulated mouse
+#The mouse is a Python port of GPIO_behavior_rig_sim-random.ino: bursts of wheel pulses, door open/close delays with JITTER,
+#an occasional sleep cycle, and monitoring of the pump output.  No Arduino or Pi is needed, and it can run faster than real time.
+#Select it by starting the rig with BEHAVIOR_RIG_GPIO=sim, and tune it with BEHAVIOR_RIG_SIM="speed=20,wheelInterval=0.05,..."
+
+import threading #Fire edge callbacks from a background thread, like RPi.GPIO
+import random #Random mouse behavior
+import heapq #Queue of pending pin changes
+import time #Map simulated time to real time
+import os #Read settings from the environment
+
+#RPi.GPIO constants
+BOARD = 10
+BCM = 11
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+VERSION = "sim"
+RPI_INFO = {"TYPE": "Simulated"}
+
+#Simulated mouse settings - times in seconds of simulated time, defaults match the Arduino sketch
+settings = {"turns": 10, #Average number of wheel turns in a burst (NTURNS) - each burst is 0 to 2*turns-1 turns
+            "wheelPulseWidth": 0.01, #Time the wheel pin is high on each turn (WHEEL_PULSE_WIDTH)
+            "wheelInterval": 0.99, #Time between wheel turns (WHEEL_INTERVAL)
+            "doorOpenDelay": 5.0, #Time between the end of a burst and the door opening (DELAY_DOOR_OPEN)
+            "doorClosedDelay": 4.0, #Time the door stays open (DELAY_DOOR_CLOSED)
+            "wheelStartDelay": 5.0, #Time between the door closing and the next burst (DELAY_WHEEL_START)
+            "jitter": 0.9, #Ratio of +/- random jitter applied to the door and wheel start delays (JITTER)
+            "sleepDuration": 1800.0, #Duration of a sleep cycle (SLEEP)
+            "sleepProbability": 5.0, #Percent probability that the mouse sleeps after each cycle (SLEEP_PROBABILITY)
+            "speed": 1.0, #Simulated seconds per real second - the mouse runs this many times faster than real time
+            "seed": 0, #Random seed - every process that loads the simulator sees the same mouse
+            "wheelPin": 11, #Board pin numbers, matching BehaviorRig
+            "doorPin": 13,
+            "pumpPin": 22,
+            "doorOpen": 0, #Door pin level when the door is open
+            "wheelStart": 0, #Wheel pin level before the first turn - replayed recordings of a wheel that idles high need 1
+            "verbose": False} #Print mouse and pump events, like the sketch's serial output
+
+levels = {} #Current level of every pin that has been set up or driven
+modes = {} #Direction of every pin that has been set up
+detect = {} #pin: [edge, callback list, bounce time (simulated ns), time of last accepted edge (simulated ns)]
+stats = {"edges": 0, "dropped": 0, "wheelTurns": 0, "doorOpenings": 0, "sleeps": 0, "pumpPulses": 0, "pumpOnTime": 0.0}
+lock = threading.RLock() #Guards pin state between the simulator thread and the rig
+wake = threading.Condition(lock) #Wakes the simulator thread when it is stopped
+queue = [] #Heap of (simulated time (ns), sequence, pin, level) pin changes that have not yet happened
+sequence = 0 #Tie-breaker so pin changes at the same time happen in the order they were scheduled
+mouse = None #Generator of simulated mouse actions
+mouseNs = 0 #Simulated time the mouse has been scheduled up to (ns)
+mouseDone = False #Whether a scripted mouse has run out of actions
+script = None #Pin changes of a scripted mouse
+thread = None #Background thread firing pin changes in real time
+manual = False #If True, simulated time only advances through advance() - used by the virtual clock dry run
+epochNs = time.monotonic_ns() #Real time at simulated time 0 - set on import, so forked rig processes share it
+simNow = 0 #Simulated time of the last pin change (ns)
+pumpStart = None #Simulated time the pump was turned on (ns)
+
+def configure(**kwargs):
+    #Change the mouse settings - must be called before the first pin is set up
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise ValueError("Unknown simulator setting: " + key)
+        settings[key] = type(settings[key])(value)
+
+def configureFromEnvironment():
+    #Read "key=value,key=value" settings from BEHAVIOR_RIG_SIM
+    text = os.environ.get("BEHAVIOR_RIG_SIM", "")
+    for item in text.split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            key = key.strip()
+            value = value.strip()
+            if key in settings and isinstance(settings[key], bool):
+                value = value.lower() in ["1", "true", "yes"]
+            configure(**{key: value})
+
+def simPrint(a):
+    if settings["verbose"]:
+        print("{:.3f}".format(simNow/1e9) + " sim: " + a)
+
+#---------------------------------Simulated mouse - port of GPIO_behavior_rig_sim-random.ino-----------------------------------------------------------
+
+def jitter(rng, delay):
+    return rng.uniform(delay - delay*settings["jitter"], delay + delay*settings["jitter"])
+
+def mouseActions():
+    #Yields (delay (s), pin, level) - the pin is driven to the level after the delay, a pin of None only waits
+    rng = random.Random(settings["seed"])
+    wheelPin = settings["wheelPin"]
+    doorPin = settings["doorPin"]
+    doorOpen = settings["doorOpen"]
+    while True:
+        #Simulate wheel
+        turns = rng.randrange(0, 2*settings["turns"])
+        for a in range(turns):
+            yield 0, wheelPin, HIGH
+            yield settings["wheelPulseWidth"], wheelPin, LOW
+            stats["wheelTurns"] += 1
+            yield settings["wheelInterval"], None, None
+
+        #Simulate door open, then door closed
+        yield jitter(rng, settings["doorOpenDelay"]), doorPin, doorOpen
+        stats["doorOpenings"] += 1
+        yield jitter(rng, settings["doorClosedDelay"]), doorPin, 1 - doorOpen
+        yield jitter(rng, settings["wheelStartDelay"]), None, None
+
+        #Check if mouse sleeps - the sketch calls random(1-100), which is always below the threshold, so the intended percentage is used here
+        if rng.uniform(0, 100) < settings["sleepProbability"]:
+            stats["sleeps"] += 1
+            yield settings["sleepDuration"], None, None
+
+def scriptActions(events):
+    #Yields the actions of a scripted mouse - events is a list of (time (s), pin, level) in time order
+    lastTime = 0
+    for eventTime, pin, level in events:
+        yield max(0, eventTime - lastTime), pin, level
+        lastTime = max(lastTime, eventTime)
+
+def loadScript(events):
+    #Replace the simulated mouse with a fixed list of (time (s), pin, level) pin changes - the pins stay still once the script ends
+    global mouse
+    global mouseNs
+    global mouseDone
+    global script
+    with lock:
+        script = events
+        mouse = scriptActions(events)
+        mouseNs = 0
+        mouseDone = False
+
+def scheduleMouse(untilNs):
+    #Queue mouse actions until the mouse has been simulated past untilNs
+    global mouse
+    global sequence
+    global mouseNs
+    global mouseDone
+    if mouse is None:
+        mouse = mouseActions()
+        mouseNs = 0
+    while not mouseDone and (mouseNs <= untilNs or not queue):
+        try:
+            delay, pin, level = next(mouse)
+        except StopIteration: #End of a scripted mouse
+            mouseDone = True
+            break
+        mouseNs += round(delay*1e9)
+        if pin is not None:
+            sequence += 1
+            heapq.heappush(queue, (mouseNs, sequence, pin, level))
+
+def nextEventTime():
+    #Simulated time of the next pin change (ns) - None once a scripted mouse has finished
+    with lock:
+        scheduleMouse(simNow)
+        if queue:
+            return queue[0][0]
+        return None
+
+def advance(untilNs):
+    #Make every pin change up to the simulated time untilNs happen, firing edge callbacks as they would on the Pi
+    global simNow
+    while True:
+        with lock:
+            scheduleMouse(untilNs)
+            if not queue or queue[0][0] > untilNs:
+                simNow = max(simNow, untilNs)
+                return
+            timeNs, n, pin, level = heapq.heappop(queue)
+            simNow = timeNs
+            callbacks = drive(pin, level)
+        for callback in callbacks: #Run callbacks outside the lock, as RPi.GPIO does
+            callback(pin)
+
+def drive(pin, level):
+    #Set an input pin level - returns the callbacks to fire for the edge
+    if levels.get(pin, HIGH) == level:
+        return []
+    levels[pin] = level
+    simPrint(("Wheel" if pin == settings["wheelPin"] else "Door" if pin == settings["doorPin"] else "Pin " + str(pin)) + " " + str(level))
+    if pin not in detect:
+        return []
+    edge, callbacks, bounceNs, lastEdge = detect[pin]
+    if (edge == RISING and not level) or (edge == FALLING and level):
+        return []
+    stats["edges"] += 1
+    if lastEdge is not None and simNow - lastEdge < bounceNs: #Edge falls inside the bounce time and would be ignored by RPi.GPIO
+        stats["dropped"] += 1
+        return []
+    detect[pin][3] = simNow
+    return list(callbacks)
+
+def realTimeLoop():
+    #Background thread - fire each pin change at its real time, which is the simulated time divided by the speed
+    while True:
+        with lock:
+            if thread is None:
+                return
+            timeNs = nextEventTime()
+            if timeNs is None:
+                delay = 1
+            else:
+                delay = (epochNs + timeNs/settings["speed"] - time.monotonic_ns())/1e9
+            if delay > 0:
+                wake.wait(min(delay, 1))
+                continue
+        advance(timeNs)
+
+def currentTime():
+    #Simulated time that corresponds to the current real time (ns)
+    return round((time.monotonic_ns() - epochNs)*settings["speed"])
+
+def startThread():
+    global thread
+    with lock:
+        if thread is None and not manual:
+            advance(currentTime()) #Catch up with the mouse since import - no edges are being detected yet, so this only sets pin levels
+            thread = threading.Thread(target=realTimeLoop, daemon=True)
+            thread.start()
+
+def restart():
+    #Start the mouse again from simulated time 0 now - a loaded script is kept and replayed from its start
+    global epochNs
+    global simNow
+    global queue
+    global mouse
+    global mouseNs
+    global mouseDone
+    global script
+    with lock:
+        epochNs = time.monotonic_ns()
+        simNow = 0
+        queue = []
+        mouse = scriptActions(script) if script is not None else None
+        mouseNs = 0
+        mouseDone = False
+
+def setManual(value=True):
+    #Turn off the real-time thread so simulated time only moves with advance() - for the virtual clock dry run
+    global manual
+    manual = value
+
+#---------------------------------RPi.GPIO interface-----------------------------------------------------------------------------------------------
+
+def setmode(mode):
+    pass
+
+def setwarnings(flag):
+    pass
+
+def setup(pin, direction, pull_up_down=PUD_OFF, initial=None):
+    global thread
+    global queue
+    global simNow
+    with lock:
+        if thread is not None and not thread.is_alive(): #Thread did not survive a fork - every process runs its own copy of the same mouse
+            thread = None
+        modes[pin] = direction
+        if direction == OUT:
+            output(pin, LOW if initial is None else initial)
+        elif pin == settings["wheelPin"]:
+            levels.setdefault(pin, settings["wheelStart"])
+        elif pin == settings["doorPin"]:
+            levels.setdefault(pin, 1 - settings["doorOpen"]) #Door starts closed
+        else:
+            levels.setdefault(pin, HIGH if pull_up_down == PUD_UP else LOW)
+    startThread()
+
+def input(pin):
+    with lock:
+        return levels.get(pin, HIGH)
+
+def output(pin, value):
+    #Outputs are recorded - the pump pin is monitored like the sketch's pumpISR
+    global pumpStart
+    with lock:
+        value = HIGH if value else LOW
+        if pin == settings["pumpPin"] and levels.get(pin, LOW) != value:
+            if value:
+                stats["pumpPulses"] += 1
+                pumpStart = simNow
+                simPrint("Pump on")
+            else:
+                if pumpStart is not None:
+                    stats["pumpOnTime"] += (simNow - pumpStart)/1e9
+                pumpStart = None
+                simPrint("Pump off")
+        levels[pin] = value
+
+def add_event_detect(pin, edge, callback=None, bouncetime=0):
+    with lock:
+        scale = 1 if manual else settings["speed"] #Bounce time is real time on the Pi, so it is scaled to simulated time
+        detect[pin] = [edge, [], round(max(0, bouncetime or 0)*1e6*scale), None]
+        if callback:
+            detect[pin][1].append(callback)
+
+def add_event_callback(pin, callback):
+    with lock:
+        detect[pin][1].append(callback)
+
+def remove_event_detect(pin):
+    with lock:
+        detect.pop(pin, None)
+
+def event_detected(pin):
+    return False
+
+def cleanup(pin=None):
+    #Stop the simulator thread - unlike RPi.GPIO this keeps the pin levels so the mouse can carry on if the rig sets up the pins again
+    global thread
+    with lock:
+        if pin is None:
+            detect.clear()
+            thread = None
+            wake.notify_all()
+        else:
+            detect.pop(pin, None)
+
+configureFromEnvironment()
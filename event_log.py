@@ -0,0 +1,213 @@
+#Compact binary event log for the behavior rig
+#Every rig event is a fixed-size 32 byte record: event type, channel, auxiliary value, experiment time (ns) and a two value payload
+#The same records are formatted into the text results file, so a binary log can be converted back to the text file byte-for-byte
+
+import struct #Pack records into fixed-size binary
+import json #Store the header metadata in the binary file
+
+MAGIC = b"BRIGLOG1" #File signature and format version
+RECORD = struct.Struct("<HHiqqq") #type, channel, aux, time (ns), payload a, payload b - 32 bytes
+TEXT_DATA = struct.Struct("<H30s") #Continuation slot holding 30 bytes of a text record
+TEXT_BYTES = 30 #Number of text bytes in each continuation slot
+RECORD_SIZE = RECORD.size
+
+#Event type codes
+EVENT_TEXT = 1 #Free text line - aux = number of UTF-8 bytes, text is stored in the following EVENT_TEXT_DATA slots
+EVENT_TEXT_DATA = 2 #Continuation slot of a text record
+EVENT_START = 3 #Process start
+EVENT_EDGE = 4 #Input pin edge - aux = pin level (1 = High, 0 = Low)
+EVENT_REVOLUTION = 5 #Wheel revolution count - a = revolution, b = revolutions needed for reward
+EVENT_OUTPUT = 6 #Output switched - aux = 1 for On, 0 for Off
+EVENT_POWER = 7 #Power strip switched - aux = 1 for on, 0 for off
+EVENT_IMAGE = 8 #Image displayed - aux = index in the image table, a = frame duration (ns)
+EVENT_ANCHOR = 9 #Wall-clock anchor - a = wall-clock time (ns since the epoch)
+EVENT_TERMINATE = 10 #End of experiment
+EVENT_CONTROL = 11 #Control message between rig processes - aux = message value, never written to the log
+EVENT_FRAME = 12 #Image drawing times - aux = index in the image table, a = blit duration (ns), b = flip duration (ns)
+EVENT_HOP = 13 #Hop of a reward event between rig processes - aux = hop code, a = reward correlation ID, never written to the log directly
+EVENT_PULSE = 14 #Timed output pulse - time = when the output was switched on, a = requested on-time (ns), b = measured on-time (ns)
+EVENT_ENCODER = 15 #Wheel encoder bin - time = start of the bin, aux = peak speed (revolutions/1000 s), a = forward counts, b = backward counts
+
+#Reward event hop codes - in the order a reward event passes through the rig
+HOP_EDGE = 0 #Wheel edge that completed the revolutions needed for the reward
+HOP_WHEEL_SENT = 1 #Wheel process sent the reward to the image process
+HOP_IMAGE_RECEIVED = 2 #Image process received the reward
+HOP_IMAGE_SHOWN = 3 #First reward image is on screen
+HOP_PUMP_ARMED = 4 #Door process received the reward and armed the pump
+
+#Channel codes
+CHANNEL_LOG = 0
+CHANNEL_WHEEL = 1
+CHANNEL_DOOR = 2
+CHANNEL_PUMP = 3
+CHANNEL_MONITOR = 4
+CHANNEL_IMAGE = 5
+CHANNEL_INPUT = 6 #First code of the extra input channels, such as lick sensors - their names are stored in the log header
+CHANNEL_NAMES = {CHANNEL_LOG: "Log", CHANNEL_WHEEL: "Wheel", CHANNEL_DOOR: "Door", CHANNEL_PUMP: "Pump", CHANNEL_MONITOR: "Monitor", CHANNEL_IMAGE: "Image"}
+
+#NumPy layout of a record - kept as a plain list so NumPy is only needed to read logs
+RECORD_DTYPE = [("type", "<u2"), ("channel", "<u2"), ("aux", "<i4"), ("time", "<i8"), ("a", "<i8"), ("b", "<i8")]
+
+def makeHeader(text, images, channels=CHANNEL_NAMES):
+    #text - results file header, images - list of (name, hash) indexed by EVENT_IMAGE records, channels - dict of channel code to name
+    return {"text": text, "images": [list(i) for i in images], "channels": {str(k): v for k, v in channels.items()}}
+
+def formatTime(timeNs):
+    return "{:.3f}".format(timeNs/1e9) #"{:.3f}".format() returns three places after the decimal point
+
+def formatRecord(record, header):
+    #Format a record as a line of the text results file (without line ending) - returns None for records that are not logged
+    eventType, channel, aux, timeNs, a, b = record[:6]
+    name = header["channels"].get(str(channel), "")
+    if eventType == EVENT_EDGE:
+        return name + " - State: " + ("High" if aux else "Low") + ", Time: " + formatTime(timeNs)
+    elif eventType == EVENT_REVOLUTION:
+        return name + " revolution " + str(a) + " of " + str(b)
+    elif eventType == EVENT_OUTPUT:
+        return name + " - State: " + ("On" if aux else "Off") + ", Time: " + formatTime(timeNs)
+    elif eventType == EVENT_IMAGE:
+        image, imageHash = header["images"][aux]
+        return "Image - Name: " + image + ", Hash: " + imageHash + ", Duration: " + formatTime(a) + ", Time: " + formatTime(timeNs)
+    elif eventType == EVENT_FRAME:
+        image, imageHash = header["images"][aux]
+        return "Frame - Name: " + image + ", Blit: " + "{:.3f}".format(a/1e6) + " ms, Flip: " + "{:.3f}".format(b/1e6) + " ms, Time: " + formatTime(timeNs)
+    elif eventType == EVENT_PULSE:
+        return name + " pulse - Requested: " + "{:.3f}".format(a/1e6) + " ms, Measured: " + "{:.3f}".format(b/1e6) + " ms, Time: " + formatTime(timeNs)
+    elif eventType == EVENT_ENCODER:
+        return (name + " encoder - Forward: " + str(a) + ", Backward: " + str(b) + ", Peak speed: " + "{:.3f}".format(aux/1000) +
+                " rev/s, Time: " + formatTime(timeNs))
+    elif eventType == EVENT_START:
+        return name + " starting at: " + formatTime(timeNs)
+    elif eventType == EVENT_POWER:
+        return name + " " + ("on" if aux else "off") + " at: " + formatTime(timeNs)
+    elif eventType == EVENT_ANCHOR:
+        return "Clock anchor - Wall: " + "{:.6f}".format(a/1e9) + ", Time: " + formatTime(timeNs)
+    elif eventType == EVENT_TERMINATE:
+        return "Successful termination at: " + str(timeNs/1e9)
+    elif eventType == EVENT_TEXT:
+        return record[6]
+    return None
+
+def packRecord(record):
+    #Pack a record into bytes - text records are followed by as many continuation slots as the text needs
+    if record[0] == EVENT_TEXT:
+        data = record[6].encode("utf-8", "surrogateescape")
+        packed = RECORD.pack(EVENT_TEXT, record[1], len(data), record[3], 0, 0)
+        for i in range(0, len(data), TEXT_BYTES):
+            packed += TEXT_DATA.pack(EVENT_TEXT_DATA, data[i:i+TEXT_BYTES])
+        return packed
+    return RECORD.pack(*record[:6])
+
+def recordSlots(record):
+    #Number of fixed-size slots a record occupies
+    if record[0] == EVENT_TEXT:
+        return 1 + -(-len(record[6].encode("utf-8", "surrogateescape"))//TEXT_BYTES)
+    return 1
+
+def writeHeader(f, header):
+    data = json.dumps(header).encode()
+    size = len(MAGIC) + 4 + len(data)
+    padding = -size % RECORD_SIZE #Pad so records start on a record boundary
+    f.write(MAGIC + struct.pack("<I", len(data) + padding) + data + b" "*padding)
+
+def readHeader(f):
+    #Returns the header dict and the file offset of the first record
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a behavior rig event log")
+    size, = struct.unpack("<I", f.read(4))
+    header = json.loads(f.read(size).decode())
+    return header, len(MAGIC) + 4 + size
+
+class BinaryEventWriter:
+    #Writes records to a binary event log - data is only pushed to disk on flush() so it can follow the text writer's flush window
+    def __init__(self, path, header):
+        self.file = open(path, "wb")
+        writeHeader(self.file, header)
+        self.buffer = [] #Packed records waiting to be written
+
+    def write(self, record):
+        self.buffer.append(packRecord(record))
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(b"".join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def iterRecords(path):
+    #Yield the header, then every record in the file in order - text records are returned with their text as a 7th element
+    with open(path, "rb") as f:
+        header, offset = readHeader(f)
+        yield header
+        data = f.read()
+    nSlots = len(data)//RECORD_SIZE #Ignore a partially written record at the end of the file
+    i = 0
+    while i < nSlots:
+        record = RECORD.unpack_from(data, i*RECORD_SIZE)
+        i += 1
+        if record[0] == EVENT_TEXT:
+            nText = -(-record[2]//TEXT_BYTES)
+            text = b"".join(TEXT_DATA.unpack_from(data, (i+j)*RECORD_SIZE)[1] for j in range(nText))
+            record = record + (text[:record[2]].decode("utf-8", "surrogateescape"),)
+            i += nText
+        yield record
+
+def readEventLog(path):
+    #Memory-map a binary event log and return (header, records, texts)
+    #records - NumPy structured array with fields type, channel, aux, time (ns), a and b, with text continuation slots removed
+    #texts - dict of index in records to the text of each EVENT_TEXT record
+    import numpy as np #Only needed for analysis, so it is not required on the rig
+    with open(path, "rb") as f:
+        header, offset = readHeader(f)
+        f.seek(0, 2)
+        nSlots = (f.tell() - offset)//RECORD_SIZE
+    if nSlots == 0:
+        return header, np.zeros(0, dtype=RECORD_DTYPE), {}
+    slots = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=offset, shape=(nSlots,))
+    keep = slots["type"] != EVENT_TEXT_DATA
+    records = slots[keep]
+    texts = {}
+    textSlots = np.flatnonzero(slots["type"] == EVENT_TEXT)
+    if len(textSlots):
+        raw = np.memmap(path, dtype=np.uint8, mode="r", offset=offset, shape=(nSlots, RECORD_SIZE))
+        index = np.cumsum(keep) - 1 #Index of each slot in records
+        for s in textSlots:
+            nBytes = int(slots["aux"][s])
+            nText = -(-nBytes//TEXT_BYTES)
+            text = raw[s+1:s+1+nText, 2:].tobytes()[:nBytes]
+            texts[int(index[s])] = text.decode("utf-8", "surrogateescape")
+    return header, records, texts
+
+def eventTimes(records, eventType, channel=None, aux=None):
+    #Experiment times (s) of all records matching the event type, and optionally channel and aux value
+    mask = records["type"] == eventType
+    if channel is not None:
+        mask &= records["channel"] == channel
+    if aux is not None:
+        mask &= records["aux"] == aux
+    return records["time"][mask]/1e9
+
+def convertToText(binPath, textPath):
+    #Regenerate the text results file from a binary event log
+    records = iterRecords(binPath)
+    header = next(records)
+    with open(textPath, "wb") as f:
+        f.write(header["text"].encode("utf-8", "surrogateescape"))
+        for record in records:
+            line = formatRecord(record, header)
+            if line is not None:
+                f.write((line + "\r\n").encode("utf-8", "surrogateescape"))
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) == 3:
+        convertToText(sys.argv[1], sys.argv[2])
+    else:
+        print("Usage: python3 event_log.py <binary log> <text results file>")
@@ -14,6 +14,7 @@ import re #REGEX library
 import threading #Allow running the protocol generator as a separate thread to not lock the GUI
 import queue #Allow kill flag to be sent to threads
 from collections import OrderedDict #Create dictionaries where object order is preserved
+import protocol_schema #Protocol lines shared with the behavior rig and analysis scripts
 if os.name != 'posix':
     import win32api #Get name of USB drive - windows only
 import glob #Search for files in deirectory
@@ -566,30 +567,28 @@ def uploadProtocol(frameDict, entryDict, contrastDict, frequencyDict, imageBarDi
             if v == preset:
                 preset = k
 
-        #Build prtocol string
-        protocolString = ("Experiment preset: " + preset + "\r\n" +
-                        "USB drive ID: " + driveName + "\r\n" +
-                        "Control image set: " + re.sub("\'", "", str(controlList)) + "\r\n" +
-                        "Reward image set: " + re.sub("\'", "", str(rewardList)) + "\r\n")
+        #Collect the protocol values - GUI labels are the protocol keys, so each entry is matched to its field in the protocol schema
+        fields = protocol_schema.FIELD_KEYS
+        values = {"preset": preset, "driveID": driveName, "controlImages": controlList, "rewardImages": rewardList}
         for key, value in entryDict.items():
-            protocolString += key + str(value["var"].get()) + "\r\n"
+            values[fields[key.strip()].name] = value["var"].get()
 
         if frameDict["contrast"].grid_info(): #If contrast frame is active, add contrast data to protocol string
             for key, value in contrastDict.items():
-                protocolString += key + str(value["var"].get()) + "\r\n"
+                values[fields[key.strip()].name] = value["var"].get()
 
         if frameDict["frequency"].grid_info(): #If frequency frame is active, add frequency data with contrast keys to protocol string - workaround for contrast specific checks in the behavior protocol
             for (f_key, f_value), (c_key, c_value) in zip(frequencyDict.items(), contrastDict.items()): #Iterate over two dictionaries at the same time: https://stackoverflow.com/questions/20736709/how-to-iterate-over-two-dictionaries-at-once-and-get-a-result-using-values-and-k
-                protocolString += c_key + str(f_value["var"].get()) + "\r\n"####################################################################################################################################################################################################################################################################
+                values[fields[c_key.strip()].name] = f_value["var"].get()####################################################################################################################################################################################################################################################################
 
         #Remove the +1 adjustment
         if(presetID in (5,6)):
             contrastDict["Number of contrast steps: "]["var"].set(contrastDict["Number of contrast steps: "]["var"].get() - 1) #Add one to the number of reward images - needed for behavior protocol check ############################################################################################################################
             frequencyDict["Number of frequency steps: "]["var"].set(frequencyDict["Number of frequency steps: "]["var"].get() - 1)
 
-        protocolString += "Metadata: " + str(metadataBox.get("1.0", "end")) #"1.0" means read starting line 1 character 0, END means read to end and add newline (end-1c would remove the added newline) https://stackoverflow.com/questions/14824163/how-to-get-the-input-from-the-tkinter-text-box-widget
+        values["metadata"] = str(metadataBox.get("1.0", "end-1c")) #"1.0" means read starting line 1 character 0, end-1c means read to end without the added newline https://stackoverflow.com/questions/14824163/how-to-get-the-input-from-the-tkinter-text-box-widget
 
-        return protocolString
+        return protocol_schema.formatProtocol(values) #Build protocol string
 
 
     def findUSB():
@@ -843,6 +842,12 @@ def uploadProtocol(frameDict, entryDict, contrastDict, frequencyDict, imageBarDi
         LUTdic = importLUT()
         if LUTdic:
             protocolString = parseProtocol()
+            protocol = protocol_schema.parseProtocol(protocolString.splitlines()) #Check the protocol the same way the behavior rig will before it is exported
+            if protocol.errors:
+                statusLabel.config(text="ERROR: " + " ".join(protocol.errors))
+                while(killFlag.get() != 0):
+                    time.sleep(0.1)
+                return
             exportFiles(protocolString, mountDir)
         else:
             while(killFlag.get() is not 0):
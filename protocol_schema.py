@@ -0,0 +1,206 @@
+#Protocol schema for the behavior rig
+#Every protocol line is defined once here - the rig, the protocol generators and the analysis scripts all read and write protocols through this module
+#A protocol file, or the header of a results file, is parsed in a single pass into a Protocol object, and every problem found is kept so they can be reported at once
+
+import re #Find numbers, image lists and image hashes in protocol lines
+import random #Draw the reward schedule
+
+IMAGE_EXT = ".png" #File extension of valid protocol images
+HEADER_END = "-------------------------------Start of experiment" #Line that ends the header of a results file
+NUMBER = re.compile(r"[-+]? (?: (?: \d* \. \d+ ) | (?: \d+ \.? ) )(?: [Ee] [+-]? \d+ ) ?", re.VERBOSE) #Float search string from: https://stackoverflow.com/questions/4703390/how-to-extract-a-floating-number-from-a-string
+IMAGE_LIST = re.compile(r"\[(.*)\]")
+IMAGE_HASH = re.compile(r"(.+) - ([0-9a-f]{32})$") #"<image> - <hash>" lines following "Image hashes:" in a results file
+
+#Field sections
+SECTION_PARAMETER = "parameter" #Required in every protocol
+SECTION_CONTRAST = "contrast" #Contrast series - either every contrast line is in the protocol or none are
+SECTION_OPTION = "option" #Optional - a line left out of the protocol keeps its default value
+SECTION_INFO = "info" #Describes the protocol, kept as text and not used by the rig
+SECTION_RESULTS = "results" #Added to the protocol by the rig in the header of the results file
+
+class Field:
+    #One protocol line - "key" is the text before the value, up to and including the ":", "name" is the attribute of the Protocol object holding the value
+    #kind - "text", "images" (list of image files), "number" (float >= 0), "integer" (whole number >= 0), "choice" (one of choices), "hashes" (image hash table)
+    __slots__ = ("name", "key", "kind", "section", "default", "choices")
+
+    def __init__(self, name, key, kind, section, default=None, choices=None):
+        self.name = name
+        self.key = key
+        self.kind = kind
+        self.section = section
+        self.default = default
+        self.choices = choices
+
+    def parse(self, text, errors):
+        #Parse the text after the key - returns the typed value, or None with the problem added to errors
+        if self.kind == "number" or self.kind == "integer":
+            match = NUMBER.search(text)
+            if not match:
+                errors.append("\"" + self.key[:-1] + "\" cannot be parsed...")
+                return None
+            number = float(match.group(0))
+            if number < 0:
+                errors.append(self.key + " \"" + text + "\" is less than 0.")
+                return None
+            if self.kind == "integer":
+                if not number.is_integer():
+                    errors.append(self.key + " \"" + text + "\" is not a whole number.")
+                    return None
+                return int(number)
+            return number
+        elif self.kind == "images":
+            match = IMAGE_LIST.search("".join(text.split())) #Image names cannot hold white space, so it is all removed
+            if not match:
+                errors.append(self.key + " \"" + text + "\" is not a list of images - [image 1, image 2, ...].")
+                return None
+            images = [i for i in match.group(1).split(",") if i]
+            for i in images:
+                if not i.endswith(IMAGE_EXT):
+                    errors.append("Invalid extension in " + self.key[:-1] + ", \"" + i + "\" is not \"" + IMAGE_EXT + "\"...")
+                    return None
+            return images
+        elif self.kind == "choice":
+            choice = text.split()[0].lower() if text.split() else ""
+            if choice not in self.choices:
+                errors.append(self.key + " \"" + text + "\" is not one of: " + ", ".join(self.choices))
+                return None
+            return choice
+        elif self.kind == "hashes":
+            return {} #Filled from the lines that follow
+        return text
+
+    def format(self, value):
+        #Text of the protocol line holding value
+        if self.kind == "images":
+            return self.key + " [" + ", ".join(value) + "]"
+        return self.key + " " + str(value)
+
+#Every protocol line, in the order the protocol generators write them
+FIELDS = [Field("date", "Date:", "text", SECTION_RESULTS),
+          Field("preset", "Experiment preset:", "text", SECTION_INFO),
+          Field("driveID", "USB drive ID:", "text", SECTION_PARAMETER),
+          Field("controlImages", "Control image set:", "images", SECTION_PARAMETER),
+          Field("rewardImages", "Reward image set:", "images", SECTION_PARAMETER),
+          Field("minRevolutions", "Minimum wheel revolutions for reward:", "integer", SECTION_PARAMETER),
+          Field("maxRevolutions", "Maximum wheel revolutions for reward:", "integer", SECTION_PARAMETER),
+          Field("rewardDuration", "Maximum duration of reward state (seconds):", "number", SECTION_PARAMETER),
+          Field("pumpDuration", "Duration of pump \"on\" state (seconds):", "number", SECTION_PARAMETER),
+          Field("wheelInterval", "Maximum time between wheel events (seconds):", "number", SECTION_PARAMETER),
+          Field("experimentHours", "Total duration of the experiment (hours):", "number", SECTION_PARAMETER),
+          Field("patternFrequency", "Pattern frequency for images:", "text", SECTION_INFO),
+          Field("rewardFrameDuration", "Duration of each reward frame (seconds):", "number", SECTION_PARAMETER),
+          Field("contrastSteps", "Number of contrast steps:", "integer", SECTION_CONTRAST),
+          Field("minContrastTime", "Minimum time between contrast increments:", "number", SECTION_CONTRAST),
+          Field("maxContrastTime", "Maximum time between contrast increments:", "number", SECTION_CONTRAST),
+          Field("minContrast", "Minimum contrast ratio (0-100):", "number", SECTION_CONTRAST),
+          Field("maxContrast", "Maximum contrast ratio (0-100):", "number", SECTION_CONTRAST),
+          Field("contrastStepRatio", "Calculated contrast step ratio:", "text", SECTION_INFO),
+          Field("runtime", "Rig runtime:", "choice", SECTION_OPTION, "multiprocess", ["multiprocess", "reactor"]), #"multiprocess" runs the wheel, door, image and log as separate processes, "reactor" runs them in one event loop
+          Field("scheduleSeed", "Reward schedule seed:", "integer", SECTION_OPTION), #Seed of the RewardSchedule - the rig draws one and writes it to the results file if the protocol has none
+          Field("scheduleLength", "Reward schedule length:", "integer", SECTION_OPTION), #Draws in each list of the RewardSchedule - the rig writes its default to the results file if the protocol has none
+          Field("metadata", "Metadata:", "text", SECTION_INFO),
+          Field("protocolHash", "Protocol hash:", "text", SECTION_RESULTS),
+          Field("imageHashes", "Image hashes:", "hashes", SECTION_RESULTS)]
+FIELD_KEYS = {field.key: field for field in FIELDS} #Every key ends at the first ":" of its line, so a line is matched with one lookup
+
+class Protocol:
+    #Parsed protocol - one attribute per field, None if the line was not in the protocol (options hold their default instead)
+    __slots__ = [field.name for field in FIELDS] + ["contrast", "errors"]
+
+    def __init__(self):
+        for field in FIELDS:
+            setattr(self, field.name, field.default)
+        self.contrast = False #Whether the protocol is a contrast series
+        self.errors = [] #Every problem found while parsing, in the order found
+
+    def images(self):
+        #All unique images in the protocol
+        return sorted(set((self.controlImages or []) + (self.rewardImages or [])))
+
+def parseProtocol(lines, driveID=None):
+    #Parse the lines of a protocol file or results file in a single pass - a results file is parsed up to the end of its header
+    #lines can hold more than one line each - the rig writes the protocol lines of a results header with "\n" endings and the rest of the file with "\r\n",
+    #so a file split on "\r\n" holds the whole header in one element
+    #driveID - label of the USB drive the protocol was read from, which must be in the protocol's "USB drive ID:" line
+    #Returns a Protocol - the protocol is valid if protocol.errors is empty
+    protocol = Protocol()
+    errors = protocol.errors
+    found = set() #Names of the fields found
+    field = None #Field of the previous protocol line
+    for line in (line for chunk in lines for line in chunk.splitlines()):
+        if line.startswith(HEADER_END):
+            break
+        key, colon, text = line.partition(":")
+        lineField = FIELD_KEYS.get(key + colon)
+        if lineField is None:
+            if field is None:
+                pass
+            elif field.kind == "hashes":
+                match = IMAGE_HASH.match(line)
+                if match:
+                    protocol.imageHashes[match.group(1)] = match.group(2)
+            elif field.name == "metadata" and line.strip():
+                protocol.metadata += "\n" + line #Metadata is free text and can run over several lines
+            continue
+        field = lineField
+        if field.name in found:
+            errors.append("\"" + field.key + "\" is in the protocol more than once...")
+            continue
+        found.add(field.name)
+        setattr(protocol, field.name, field.parse(text.strip(), errors))
+    return checkProtocol(protocol, found, driveID)
+
+def checkProtocol(protocol, found, driveID):
+    #Checks between fields, and for missing lines, once the whole protocol has been read
+    errors = protocol.errors
+    for field in FIELDS:
+        if field.section == SECTION_PARAMETER and field.name not in found:
+            errors.append("Cannot find: \"" + field.key + "\" in protocol file...")
+    contrastFields = [field for field in FIELDS if field.section == SECTION_CONTRAST]
+    protocol.contrast = any(field.name in found for field in contrastFields)
+    if protocol.contrast: #If there is a contrast portion, make sure it is complete
+        for field in contrastFields:
+            if field.name not in found:
+                errors.append("Cannot find: \"" + field.key + "\" in contrast section of protocol file...")
+
+    if driveID is not None and protocol.driveID is not None and driveID not in protocol.driveID:
+        errors.append("USB drive ID: reference \"" + driveID + "\" does not match protocol \"" + protocol.driveID + "\"...")
+    if protocol.rewardImages == []:
+        errors.append("No reward images found, there must be at least one reward image specified...")
+    if protocol.minRevolutions is not None and protocol.maxRevolutions is not None and protocol.minRevolutions > protocol.maxRevolutions:
+        errors.append("Minimum wheel revolutions for reward (" + str(protocol.minRevolutions) + ") is greater than the maximum (" + str(protocol.maxRevolutions) + ").")
+    if protocol.contrast and protocol.contrastSteps is not None and protocol.rewardImages and protocol.contrastSteps != len(protocol.rewardImages):
+        errors.append(str(protocol.contrastSteps) + " contrast steps not equal to " + str(len(protocol.rewardImages)) + " reward images.")
+    if protocol.scheduleLength == 0:
+        errors.append("Reward schedule length must be at least 1.")
+    return protocol
+
+class RewardSchedule:
+    #Every random draw of an experiment, made up front from the protocol's reward schedule seed and length, so the rig only steps through lists while
+    #it runs and the schedule of any results file can be rebuilt from its header.  Each list is stepped through by the part of the rig that uses it,
+    #and starts again from the beginning if an experiment outlasts it
+    def __init__(self, protocol):
+        rng = random.Random(protocol.scheduleSeed)
+        length = protocol.scheduleLength
+        self.revolutions = [rng.randint(protocol.minRevolutions, protocol.maxRevolutions) for i in range(length)] #Revolutions needed for a reward - one each time the wheel count resets
+        self.controlImages = [rng.choice(protocol.controlImages or protocol.rewardImages) for i in range(length)] #Image shown each time the rig returns to the control state - a reward image if there are no control images
+        if protocol.contrast:
+            self.framePeriods = [rng.uniform(protocol.minContrastTime, protocol.maxContrastTime) for i in range(length)] #Duration of each contrast step (s)
+            self.rewardOrders = [rng.sample(protocol.rewardImages, len(protocol.rewardImages)) for i in range(length)] #Order of the contrast steps in each reward
+        else:
+            self.framePeriods = [protocol.rewardFrameDuration]
+            self.rewardOrders = [protocol.rewardImages]
+
+def readProtocol(path, driveID=None):
+    #Parse a protocol file, or the header of a results file - returns (Protocol, lines of the file up to the end of the header)
+    lines = []
+    with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        for line in f:
+            if line.startswith(HEADER_END):
+                break
+            lines.append(line)
+    return parseProtocol(lines, driveID), lines
+
+def formatProtocol(values):
+    #Protocol file text from a dict of field name to value - lines are written in the order of FIELDS
+    return "".join(field.format(values[field.name]) + "\r\n" for field in FIELDS if field.name in values)
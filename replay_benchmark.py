@@ -0,0 +1,266 @@
+#Replay benchmark for the behavior rig
+#Extracts the wheel and door edge timeline from a recorded Results file, and replays it through BehaviorRig using the simulated GPIO backend.
+#Reports end-to-end events/s, reward trigger latency, dropped edges and CPU time per process, then diffs the new Results file against the original.
+#Usage: python3 replay_benchmark.py "<Results file>" [--speed 1|10|max] [--runtime multiprocess|reactor] [--hours N] [--baseline "<Results file>"]
+#--speed max replays on the rig's virtual clock (dry run) - latencies are then zero and only throughput and behavior are meaningful
+#Other speeds run the rig in real time with all protocol times divided by the speed - edges closer than the rig's bounce time are dropped, as on a real rig
+#A Results file with a "Reward schedule seed:" line is replayed with the same reward schedule, so rewards, images and pump pulses match the original -
+#older Results files get a new schedule, so image and pump counts only match the original where its draws do
+
+import argparse #Command line options
+import os #Paths and environment for the rig
+import re #Parse Results files
+import subprocess #Run the rig
+import sys #Python interpreter for the rig
+import tempfile #Protocol folder for the replay
+import shutil #Remove the protocol folder afterwards
+import time #Measure the run time
+import json #Optional machine readable report
+import struct #Write placeholder PNG images
+import zlib #Write placeholder PNG images
+import glob #Find the Results file written by the rig
+
+rigScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BehaviorRig.py")
+edgePattern = re.compile(r"^(Wheel|Door) - State: (High|Low), Time: ([0-9.]+)")
+timePattern = re.compile(r"Time: ([0-9.]+)")
+#Protocol lines holding times, which are divided by the replay speed so the rig's timers keep pace with the compressed edge timeline
+scaledKeys = ["Maximum duration of reward state (seconds):", "Duration of pump \"on\" state (seconds):", "Maximum time between wheel events (seconds):",
+              "Duration of each reward frame (seconds):", "Minimum time between contrast increments:", "Maximum time between contrast increments:"]
+hoursKey = "Total duration of the experiment (hours):"
+matchWindow = 0.5 #Largest difference (s, original time base) between an original edge and its replayed edge
+
+def readResults(path):
+    #Returns the protocol lines, the list of (time (s), "wheel"|"door", level) edges, and the event lines of a Results file
+    with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        lines = f.read().splitlines()
+    protocol = []
+    events = []
+    edges = []
+    inHeader = True
+    for line in lines:
+        if inHeader:
+            if line.startswith("-------------------------------Start of experiment"):
+                inHeader = False
+            elif line.startswith("Protocol hash:"):
+                inHeader = None #Image hashes and the rest of the header are not part of the protocol
+            elif inHeader and not line.startswith("Date:"):
+                protocol.append(line)
+            continue
+        if not line:
+            continue
+        events.append(line)
+        match = edgePattern.match(line)
+        if match:
+            edges.append((float(match.group(3)), match.group(1).lower(), 1 if match.group(2) == "High" else 0))
+    return protocol, edges, events
+
+def parseImageList(line):
+    match = re.search(r"\[(.*)\]", line)
+    if not match:
+        return []
+    return [i.strip() for i in match.group(1).split(",") if i.strip()]
+
+def writePng(path, size=8, gray=128):
+    #Minimal solid gray PNG - the replay only needs images with the right names
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    rows = b"".join(b"\0" + bytes([gray])*size*3 for i in range(size))
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)) +
+                chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+def buildProtocolFolder(folder, protocol, edges, speed, hours, runtime):
+    #Write Protocol.txt, placeholder images and the mouse script for the replay - returns the number of edges injected
+    os.makedirs(folder + "/images", exist_ok=True)
+    scale = 1 if speed is None else 1/speed
+    lines = []
+    for line in protocol:
+        key = next((k for k in scaledKeys + [hoursKey] if line.startswith(k)), None)
+        if line.startswith("Rig runtime:"):
+            continue
+        if key == hoursKey:
+            line = key + " " + repr(hours*scale)
+        elif key:
+            value = float(line.split(key, 1)[1].split()[0])
+            line = key + " " + repr(value*scale)
+        elif line.startswith("Control image set:") or line.startswith("Reward image set:"):
+            for image in parseImageList(line):
+                writePng(folder + "/images/" + image)
+        lines.append(line)
+    lines.append("Rig runtime: " + runtime)
+    with open(folder + "/Protocol.txt", "w") as f:
+        f.write("\r\n".join(lines) + "\r\n")
+
+    nEdges = 0
+    with open(folder + "/mouse.txt", "w") as f:
+        f.write("#Edge timeline replayed from a Results file - <time (s)> <wheel|door> <level>\n")
+        for edgeTime, pin, level in edges:
+            if edgeTime <= hours*3600:
+                f.write(repr(edgeTime*scale) + " " + pin + " " + str(level) + "\n")
+                nEdges += 1
+    return nEdges
+
+def startLevels(edges):
+    #Simulator settings that put each pin at the level it had before its first recorded edge
+    settings = []
+    wheel = next((level for edgeTime, pin, level in edges if pin == "wheel"), None)
+    door = next((level for edgeTime, pin, level in edges if pin == "door"), None)
+    if wheel is not None:
+        settings.append("wheelStart=" + str(1 - wheel))
+    if door is not None:
+        settings.append("doorOpen=" + str(door)) #The door starts closed, so its first edge is to the open level
+    return ",".join(settings)
+
+def cutEvents(events, hours):
+    #Event lines up to the end of the replayed window
+    end = hours*3600
+    for i, line in enumerate(events):
+        match = timePattern.search(line)
+        if match and float(match.group(1)) > end:
+            return events[:i]
+    return events
+
+def runRig(folder, speed, edges):
+    #Run the rig on the protocol folder - returns the path of the Results file and the wall time of the run (s)
+    env = dict(os.environ)
+    env["BEHAVIOR_RIG_GPIO"] = "sim"
+    env["BEHAVIOR_RIG_SIM"] = ",".join(s for s in [env.get("BEHAVIOR_RIG_SIM", ""), startLevels(edges)] if s)
+    env["SDL_VIDEODRIVER"] = "dummy"
+    mode = "--dry-run" if speed is None else "--sim-run"
+    start = time.monotonic()
+    subprocess.run([sys.executable, rigScript, mode, folder, folder + "/mouse.txt"], env=env, check=True)
+    wallTime = time.monotonic() - start
+    results = sorted(glob.glob(folder + "/Results - * run - *.txt"), key=os.path.getmtime)
+    if not results:
+        raise RuntimeError("The rig did not write a Results file")
+    return results[-1], wallTime
+
+def eventType(line):
+    #Category of a Results line for the behavioral diff
+    if line.startswith("Wheel revolution "):
+        return "Wheel revolution"
+    if line.startswith("Image - Name: "):
+        return "Image " + line.split("Image - Name: ", 1)[1].split(",")[0]
+    for prefix in ["Wheel - State: High", "Wheel - State: Low", "Door - State: High", "Door - State: Low", "Pump - State: On", "Pump - State: Off"]:
+        if line.startswith(prefix):
+            return prefix
+    return None
+
+def diffResults(original, replay, timeScale):
+    #Compare the behavior in two Results files - replay times are multiplied by timeScale to put them on the original time base
+    report = {"counts": {}, "edges": {}, "firstDivergence": None}
+    counts = {}
+    for name, events in [("original", original), ("replay", replay)]:
+        for line in events:
+            kind = eventType(line)
+            if kind:
+                counts.setdefault(kind, {"original": 0, "replay": 0})[name] += 1
+    report["counts"] = counts
+
+    #Edge timing - each original edge is matched to the next replayed edge of the same level within matchWindow
+    for pin in ["Wheel", "Door"]:
+        a = [(float(timePattern.search(l).group(1)), "High" in l) for l in original if l.startswith(pin + " - State: ")]
+        b = [(float(timePattern.search(l).group(1))*timeScale, "High" in l) for l in replay if l.startswith(pin + " - State: ")]
+        offsets = []
+        j = 0
+        for edgeTime, level in a:
+            while j < len(b) and b[j][0] < edgeTime - matchWindow:
+                j += 1
+            if j < len(b) and b[j][1] == level and abs(b[j][0] - edgeTime) <= matchWindow:
+                offsets.append(b[j][0] - edgeTime)
+                j += 1
+        mean = sum(offsets)/len(offsets) if offsets else 0
+        report["edges"][pin] = {"matched": len(offsets), "missing": len(a) - len(offsets), "extra": len(b) - len(offsets),
+                                "meanOffset": mean, "maxJitter": max([abs(o - mean) for o in offsets] or [0])}
+
+    #First point where the sequence of reward related events differs
+    a = [k for k in map(eventType, original) if k and not k.startswith("Wheel")]
+    b = [k for k in map(eventType, replay) if k and not k.startswith("Wheel")]
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            report["firstDivergence"] = {"index": i, "original": x, "replay": y}
+            break
+    else:
+        if len(a) != len(b):
+            report["firstDivergence"] = {"index": min(len(a), len(b)), "original": a[len(b)] if len(a) > len(b) else None, "replay": b[len(a)] if len(b) > len(a) else None}
+    return report
+
+def readRigSummaries(events):
+    #Pull the rig's own summary lines out of a Results file
+    summary = {"rewardLatency": {}, "cpu": {}, "ringOverflows": 0}
+    for line in events:
+        if line.startswith("Reward latency, wheel edge to "):
+            name, values = line[len("Reward latency, wheel edge to "):].split(" (ms) - ", 1) if " (ms) - " in line else (line, "")
+            summary["rewardLatency"][name] = dict((k, float(v)) for k, v in re.findall(r"(Mean|p50|p95|p99|Max): ([0-9.]+)", values))
+        elif line.startswith("CPU time - Process: "):
+            match = re.match(r"CPU time - Process: (\w+), User: ([0-9.]+) s, System: ([0-9.]+) s", line)
+            if match:
+                summary["cpu"][match.group(1)] = float(match.group(2)) + float(match.group(3))
+        elif line.startswith("Ring - "):
+            summary["ringOverflows"] += int(line.rsplit("Overflows: ", 1)[1])
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded Results file through the behavior rig")
+    parser.add_argument("results", help="Recorded Results file to replay")
+    parser.add_argument("--speed", default="max", help="Replay speed: 1, 10, any other factor, or max for the virtual clock (default)")
+    parser.add_argument("--runtime", default="reactor", choices=["multiprocess", "reactor"], help="Rig runtime to replay on (default: reactor)")
+    parser.add_argument("--hours", type=float, default=None, help="Only replay the first N hours of the file (default: the whole experiment)")
+    parser.add_argument("--baseline", default=None, help="Results file to diff against (default: the replayed file)")
+    parser.add_argument("--json", default=None, help="Also write the report to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="Keep the replay folder")
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    protocol, edges, originalEvents = readResults(args.results)
+    hours = args.hours
+    if hours is None:
+        line = next((l for l in protocol if l.startswith(hoursKey)), None)
+        hours = float(line.split(hoursKey, 1)[1].split()[0]) if line else edges[-1][0]/3600
+    if speed is not None:
+        print("Replaying " + "{:.2f}".format(hours) + " hours at " + args.speed + "x will take about " + "{:.1f}".format(hours*3600/speed) + " s")
+
+    folder = tempfile.mkdtemp(prefix="replay_")
+    try:
+        nEdges = buildProtocolFolder(folder, protocol, edges, speed, hours, args.runtime)
+        resultsPath, wallTime = runRig(folder, speed, edges)
+        protocolReplay, edgesReplay, replayEvents = readResults(resultsPath)
+        baselineEvents = readResults(args.baseline)[2] if args.baseline else cutEvents(originalEvents, hours)
+
+        rig = readRigSummaries(replayEvents)
+        report = {"speed": args.speed, "runtime": args.runtime, "hours": hours, "wallTime": wallTime,
+                  "eventsPerSecond": len(replayEvents)/wallTime, "edgesInjected": nEdges, "edgesLogged": len(edgesReplay),
+                  "droppedEdges": nEdges - len(edgesReplay), "ringOverflows": rig["ringOverflows"], "rewardLatency": rig["rewardLatency"],
+                  "cpu": rig["cpu"], "diff": diffResults(baselineEvents, replayEvents, 1 if speed is None else speed), "results": resultsPath}
+
+        print("Replay of " + args.results)
+        print("Speed: " + report["speed"] + ", Runtime: " + report["runtime"] + ", Hours: " + "{:.2f}".format(hours) + ", Wall time: " + "{:.2f}".format(wallTime) + " s")
+        print("Events/s: " + "{:.0f}".format(report["eventsPerSecond"]) + ", Edges injected: " + str(nEdges) + ", logged: " + str(len(edgesReplay)) +
+              ", dropped: " + str(report["droppedEdges"]) + ", Ring overflows: " + str(report["ringOverflows"]))
+        for name, values in rig["rewardLatency"].items():
+            print("Reward latency to " + name + " (ms) - " + ", ".join(k + ": " + "{:.3f}".format(v) for k, v in values.items()))
+        for name, value in rig["cpu"].items():
+            print("CPU - " + name + ": " + "{:.3f}".format(value) + " s")
+        print("Diff against " + (args.baseline or "the replayed file") + ":")
+        for kind, count in sorted(report["diff"]["counts"].items()):
+            flag = "" if count["original"] == count["replay"] else "  <-- differs"
+            print("  " + kind + ": " + str(count["original"]) + " -> " + str(count["replay"]) + flag)
+        for pin, values in report["diff"]["edges"].items():
+            print("  " + pin + " edges - matched: " + str(values["matched"]) + ", missing: " + str(values["missing"]) + ", extra: " + str(values["extra"]) +
+                  ", mean offset: " + "{:.3f}".format(values["meanOffset"]) + " s, max jitter: " + "{:.3f}".format(values["maxJitter"]) + " s")
+        if report["diff"]["firstDivergence"]:
+            d = report["diff"]["firstDivergence"]
+            print("  Reward events first differ at event " + str(d["index"]) + ": " + str(d["original"]) + " -> " + str(d["replay"]))
+        else:
+            print("  Reward events match")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        if args.keep:
+            print("Replay folder kept: " + folder)
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+#Tests for protocol_schema - run with: python -m pytest
+
+import os
+
+from protocol_schema import parseProtocol, readProtocol
+
+SAMPLE_RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Results - 2019-03-15 d3dbcaee91b239098672c980f80e0dcf.txt") #Results file bundled with the repo
+
+def checkSampleHeader(protocol):
+    assert protocol.errors == []
+    assert protocol.driveID == "CAGE 1A"
+    assert protocol.controlImages == ["Solid.png"]
+    assert protocol.rewardImages == ["Checkerboard.png"]
+    assert protocol.rewardDuration == 15.0
+    assert protocol.minRevolutions == 2
+    assert protocol.maxRevolutions == 20
+    assert protocol.imageHashes == {"Checkerboard.png": "d21813f3c912d10006dbc7485a7bc383", "Solid.png": "149716097e046e739f81634dac1868d1"}
+
+def test_read_sample_results():
+    #Results file read line by line, as the rig and Day 1 data analysis do
+    protocol, header = readProtocol(SAMPLE_RESULTS)
+    checkSampleHeader(protocol)
+
+def test_parse_sample_results_split_on_crlf():
+    #Results file split on "\r\n", as Automatic_analysis does with files downloaded from Google Drive - the "\n" ended header lines arrive as one element
+    with open(SAMPLE_RESULTS, "r", newline="") as f:
+        lines = f.read().split("\r\n")
+    assert any("\n" in line for line in lines)
+    checkSampleHeader(parseProtocol(lines))